@@ -0,0 +1,67 @@
+-- Declarative partitioning (PostgreSQL 11+), use with `pg-nel-store --partitioned`.
+-- Daily partitions nfcollect.log_items_YYYYMMDD are created by the daemon
+-- ahead of time and batches are COPYed straight into them, no trigger involved.
+CREATE schema IF NOT EXISTS nfcollect;
+
+--DROP TABLE nfcollect.log_items;
+-- Upgrading an older schema (IPv6/NAT64 support):
+-- ALTER TABLE nfcollect.log_items ADD COLUMN xlate_dst_addr inet;
+-- and VRF names from exporter options:
+-- ALTER TABLE nfcollect.log_items ADD COLUMN vrf_name text;
+CREATE TABLE IF NOT EXISTS nfcollect.log_items (
+ event_time         bigint
+,src_addr           inet
+,dst_addr           inet
+,dst_port           integer
+,xlate_src_addr     inet
+,xlate_src_port     integer
+,protocol           integer
+,xlate_dst_addr     inet
+,vrf_name           text
+) PARTITION BY RANGE (event_time);
+
+-- Indexes are created on every partition automatically. Rows come in time order:
+-- a BRIN index covers time ranges at a fraction of btree size, public address, port
+-- and time in one btree answer nfc-lookup with a single index probe per partition.
+-- Upgrading an older schema:
+-- DROP INDEX nfcollect.log_items_indx1, nfcollect.log_items_indx2;
+CREATE INDEX IF NOT EXISTS log_items_indx1 ON nfcollect.log_items USING brin (event_time);
+CREATE INDEX IF NOT EXISTS log_items_indx2 ON nfcollect.log_items (xlate_src_addr, xlate_src_port, event_time);
+CREATE INDEX IF NOT EXISTS log_items_indx3 ON nfcollect.log_items (dst_addr);
+
+-- Port block intervals and aggregated session port ranges (`--events port-blocks`),
+-- partitioned by end_time. start_time 0: the allocation wasn't seen.
+CREATE TABLE IF NOT EXISTS nfcollect.port_blocks (
+ start_time         bigint
+,end_time           bigint
+,src_addr           inet
+,xlate_src_addr     inet
+,port_start         integer
+,port_end           integer
+) PARTITION BY RANGE (end_time);
+
+CREATE INDEX IF NOT EXISTS port_blocks_indx1 ON nfcollect.port_blocks (xlate_src_addr, end_time);
+CREATE INDEX IF NOT EXISTS port_blocks_indx2 ON nfcollect.port_blocks (src_addr);
+
+-- Session create and delete events paired into one row (`--events sessions`).
+-- start_time 0: the create wasn't seen; deleted 0: no delete came, end_time
+-- is when the collector gave up on the session (timeout, overflow, shutdown).
+CREATE TABLE IF NOT EXISTS nfcollect.sessions (
+ start_time         bigint
+,end_time           bigint
+,src_addr           inet
+,dst_addr           inet
+,dst_port           integer
+,xlate_src_addr     inet
+,xlate_src_port     integer
+,protocol           integer
+,deleted            integer
+) PARTITION BY RANGE (end_time);
+
+-- Upgrading from the (xlate_src_addr, end_time) index: DROP INDEX nfcollect.sessions_indx1;
+CREATE INDEX IF NOT EXISTS sessions_indx1 ON nfcollect.sessions (xlate_src_addr, xlate_src_port, end_time);
+CREATE INDEX IF NOT EXISTS sessions_indx2 ON nfcollect.sessions (src_addr);
+
+-- Old data is dropped by detaching partitions, e.g.:
+-- ALTER TABLE nfcollect.log_items DETACH PARTITION nfcollect.log_items_20160817;
+-- DROP TABLE nfcollect.log_items_20160817;
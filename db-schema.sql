@@ -1,6 +1,10 @@
 CREATE schema nfcollect;
 
 --DROP TABLE nfcollect.log_items;
+-- Upgrading an older schema (IPv6/NAT64 support):
+-- ALTER TABLE nfcollect.log_items ADD COLUMN xlate_dst_addr inet;
+-- and VRF names from exporter options:
+-- ALTER TABLE nfcollect.log_items ADD COLUMN vrf_name text;
 CREATE TABLE IF NOT EXISTS nfcollect.log_items (
  event_time         bigint
 ,src_addr           inet
@@ -9,6 +13,8 @@ CREATE TABLE IF NOT EXISTS nfcollect.log_items (
 ,xlate_src_addr     inet
 ,xlate_src_port     integer
 ,protocol           integer
+,xlate_dst_addr     inet
+,vrf_name           text
 );
 
 CREATE OR REPLACE FUNCTION
@@ -50,9 +56,11 @@ $BODY$
     EXECUTE 'ALTER TABLE nfcollect.' || quote_ident(_tablename) || ' OWNER TO nfcollect';
     EXECUTE 'GRANT ALL ON TABLE nfcollect.' || quote_ident(_tablename) || ' TO nfcollect';
 
-    -- Indexes are defined per child, so we assign a default index that uses the partition columns
-    EXECUTE 'CREATE INDEX ' || quote_ident(_tablename||'_indx1') || ' ON nfcollect.' || quote_ident(_tablename) || ' (event_time)';
-    EXECUTE 'CREATE INDEX ' || quote_ident(_tablename||'_indx2') || ' ON nfcollect.' || quote_ident(_tablename) || ' (xlate_src_addr)';
+    -- Indexes are defined per child, so we assign a default index that uses the partition columns.
+    -- Rows come in time order: a BRIN index covers time ranges at a fraction of btree size,
+    -- public address, port and time in one btree answer nfc-lookup with a single index probe.
+    EXECUTE 'CREATE INDEX ' || quote_ident(_tablename||'_indx1') || ' ON nfcollect.' || quote_ident(_tablename) || ' USING brin (event_time)';
+    EXECUTE 'CREATE INDEX ' || quote_ident(_tablename||'_indx2') || ' ON nfcollect.' || quote_ident(_tablename) || ' (xlate_src_addr, xlate_src_port, event_time)';
     EXECUTE 'CREATE INDEX ' || quote_ident(_tablename||'_indx3') || ' ON nfcollect.' || quote_ident(_tablename) || ' (dst_addr)';
     END IF;
 
@@ -63,6 +71,43 @@ $BODY$
 $BODY$
 LANGUAGE plpgsql;
 
+-- Upgrading an older schema: day tables created before keep their single column
+-- indexes, for nfc-lookup add the composite one to each, e.g.:
+-- CREATE INDEX "log_items_2016-08-17_indx4" ON nfcollect."log_items_2016-08-17" (xlate_src_addr, xlate_src_port, event_time);
+
 CREATE TRIGGER log_items_trigger
 BEFORE INSERT ON nfcollect.log_items
 FOR EACH ROW EXECUTE PROCEDURE nfcollect.log_items_partition_function();
+
+-- Port block intervals and aggregated session port ranges (`--events port-blocks`).
+-- start_time 0: the allocation wasn't seen.
+CREATE TABLE IF NOT EXISTS nfcollect.port_blocks (
+ start_time         bigint
+,end_time           bigint
+,src_addr           inet
+,xlate_src_addr     inet
+,port_start         integer
+,port_end           integer
+);
+
+CREATE INDEX IF NOT EXISTS port_blocks_indx1 ON nfcollect.port_blocks (xlate_src_addr, end_time);
+CREATE INDEX IF NOT EXISTS port_blocks_indx2 ON nfcollect.port_blocks (src_addr);
+
+-- Session create and delete events paired into one row (`--events sessions`).
+-- start_time 0: the create wasn't seen; deleted 0: no delete came, end_time
+-- is when the collector gave up on the session (timeout, overflow, shutdown).
+CREATE TABLE IF NOT EXISTS nfcollect.sessions (
+ start_time         bigint
+,end_time           bigint
+,src_addr           inet
+,dst_addr           inet
+,dst_port           integer
+,xlate_src_addr     inet
+,xlate_src_port     integer
+,protocol           integer
+,deleted            integer
+);
+
+-- Upgrading from the (xlate_src_addr, end_time) index: DROP INDEX nfcollect.sessions_indx1;
+CREATE INDEX IF NOT EXISTS sessions_indx1 ON nfcollect.sessions (xlate_src_addr, xlate_src_port, end_time);
+CREATE INDEX IF NOT EXISTS sessions_indx2 ON nfcollect.sessions (src_addr);
@@ -0,0 +1,282 @@
+"""PostgreSQL writer running on the event loop, an alternative to `pgstore.StorePgThreadPool`.
+
+    Needs asyncpg. Batches stay on the loop thread from the NEL buffer to
+the socket: no queue locks and no GIL hand-offs to DB threads.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from . import pgstore
+from . import spool
+
+
+class AsyncPgStore:
+    """Binary COPY over `connections` asyncpg connections, one COPY in flight on each.
+
+        Same interface, queue limits, overflow policies and spool as
+    `pgstore.StorePgThreadPool`; batches wait in a deque and are encoded
+    when a connection takes them. A batch whose connection was lost is
+    spooled or retried once the connection is back (with backoff); with a
+    spool, batches go straight to it until the next try. One the DB
+    rejects is retried `RETRIES` times, then dropped or spooled. The
+    spool is replayed by `pgstore.SpoolReplayer`, partitions ahead are
+    created by `pgstore.PartitionMaintainer`, both threads off the hot path.
+
+        When the loop is not running (nfc-replay) `addRequest` runs it
+    until the batch fits, and `waitCompletion` until the queue is empty,
+    then closes the connections.
+    """
+    RETRIES = 3
+    BACKOFF_MAX = 60
+
+    def __init__(self, connections, dsn, table=pgstore.NEL_TABLE, partitions_ahead=None, queue_batches=16,
+                 queue_bytes=64 << 20, overflow=None, spool_dir=None, spool_fsync='interval',
+                 spool_segment_bytes=64 << 20, name='pg'):
+        import asyncpg
+        self._asyncpg = asyncpg
+        self._errors = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
+        self.connections = connections
+        self.dsn = dsn
+        self.table = table
+        self.schema, _, self.table_name = table.name.rpartition('.')
+        self.max_batches = queue_batches
+        self.max_bytes = queue_bytes
+        self.overflow = overflow or ('spill' if spool_dir else 'drop-newest')
+        self.name = name
+
+        self.spool = None
+        if spool_dir:
+            self.spool = spool.Spool(spool_dir, pgstore.BinaryCopy(table), spool_segment_bytes, spool_fsync)
+        elif overflow == 'spill':
+            raise ValueError('spill overflow policy requires a spool')
+        self.partitions = None
+        if partitions_ahead is not None:
+            self.partitions = pgstore.DailyPartitions(table, ahead=partitions_ahead)
+            pgstore.PartitionMaintainer(self.partitions, dsn)
+        self.replayer = None
+        if self.spool is not None:
+            self.replayer = pgstore.SpoolReplayer(self.spool, dsn, table, self.partitions)
+
+        self._loop = asyncio.get_event_loop()
+        self._batches = collections.deque()
+        self._bytes = 0
+        self._unfinished = 0
+        self._ready = asyncio.Event()
+        self._done = asyncio.Event()
+        self._writers = []
+        # db down: no writes before _retry_at, batches go to the spool
+        self._delay = 1
+        self._retry_at = 0
+        self.db_errors = 0
+        self._rejected = 0
+        self.dropped = 0
+        self.spilled = 0
+        self._db_errors = 0
+        self._replayed = 0
+        self._dropped = 0
+        self._spilled = 0
+
+        pgstore.QUEUE_BATCHES.set_function((name,), self.getQueueSize)
+        pgstore.QUEUE_BYTES.set_function((name,), lambda: self._bytes)
+        pgstore.DROPPED_RECORDS.set_function((name,), lambda: self.dropped)
+        pgstore.SPILLED_RECORDS.set_function((name,), lambda: self.spilled)
+        pgstore.DB_ERRORS.set_function((table.name,), lambda: self.db_errors)
+        pgstore.REJECTED_RECORDS.set_function((table.name,), lambda: self.rejected)
+        if self.spool is not None:
+            pgstore.REPLAYED_RECORDS.set_function((table.name,), lambda: self.replayer.replayed)
+            pgstore.SPOOL_BYTES.set_function((table.name,), self.spool.pending_bytes)
+
+    def _full(self, size):
+        return len(self._batches) >= self.max_batches or self._bytes + size > self.max_bytes
+
+    def addRequest(self, records_buf):
+        """Queue a batch, False if it was dropped or spilled."""
+        size = len(records_buf) * self.table.row_bytes
+        pgstore.BATCH_RECORDS.observe(len(records_buf), (self.name,))
+        if not self._writers:
+            self._writers = [self._loop.create_task(self._writer()) for _ in range(self.connections)]
+        if self._batches and self._full(size) and not self._loop.is_running():
+            self._loop.run_until_complete(self._room(size))
+
+        if self.overflow == 'drop-oldest':
+            while self._batches and self._full(size):
+                dropped = self._batches.popleft()
+                self._bytes -= len(dropped) * self.table.row_bytes
+                self._unfinished -= 1
+                self.dropped += len(dropped)
+        if self._batches and self._full(size):
+            if self.overflow == 'spill':
+                try:
+                    self.spool.append(records_buf)
+                    self.spilled += len(records_buf)
+                except OSError as e:
+                    logging.error('AsyncPgStore: spill failed: {0}'.format(e))
+                    self.dropped += len(records_buf)
+            else:
+                self.dropped += len(records_buf)
+            return False
+
+        self._batches.append(records_buf)
+        self._bytes += size
+        self._unfinished += 1
+        self._ready.set()
+        return True
+
+    async def _room(self, size):
+        while self._batches and self._full(size):
+            self._done.clear()
+            await self._done.wait()
+
+    async def _writer(self):
+        # encoders keep a reusable buffer, one per connection
+        encoder = pgstore.BinaryCopy(self.table)
+        conn = None
+        try:
+            while True:
+                while not self._batches:
+                    self._ready.clear()
+                    await self._ready.wait()
+                records = self._batches.popleft()
+                self._bytes -= len(records) * self.table.row_bytes
+                try:
+                    conn = await self._store(conn, encoder, records)
+                except Exception:
+                    # whatever it was, the writer must go on with the next batch
+                    self._rejected += len(records)
+                    logging.exception('AsyncPgStore: dropped batch of {0} records'.format(len(records)))
+                finally:
+                    self._unfinished -= 1
+                    self._done.set()
+        finally:
+            if conn is not None:
+                conn.terminate()
+
+    async def _store(self, conn, encoder, records):
+        """Write a batch like `pgstore.StorePgThreadPool.Worker.store`, returns the connection to go on with."""
+        if self.spool is not None and time.monotonic() < self._retry_at and self._spool(records):
+            return conn
+        attempt = 0
+        while True:
+            try:
+                if conn is None or conn.is_closed():
+                    conn = await self._asyncpg.connect(**self.dsn)
+                await self._copy(conn, encoder, records)
+                self._delay = 1
+                logging.info('AsyncPgStore: data batch commited to db')
+                return conn
+            except self._errors as e:
+                self.db_errors += 1
+                attempt += 1
+                connection_lost = conn is None or conn.is_closed() or not isinstance(e, self._asyncpg.PostgresError) \
+                    or isinstance(e, self._asyncpg.PostgresConnectionError)
+                logging.error('AsyncPgStore: db write failed (attempt {0}): {1}'.format(attempt, e))
+
+            if not connection_lost and attempt < self.RETRIES:
+                await asyncio.sleep(attempt)
+                continue
+            if self.spool is not None and self._spool(records):
+                if connection_lost:
+                    conn = self._lost(conn)
+                return conn
+            if not connection_lost:
+                self._rejected += len(records)
+                logging.error('AsyncPgStore: dropped batch of {0} records rejected by db'.format(len(records)))
+                return conn
+            # no spool: keep the batch until the db is back
+            conn = await self._reconnect(conn)
+
+    async def _copy(self, conn, encoder, records):
+        started = time.monotonic()
+        rejected = encoder.rejected
+        if self.partitions is None:
+            await conn.copy_to_table(self.table_name, schema_name=self.schema, columns=self.table.columns,
+                                     source=encoder.encode(records), format='binary')
+        else:
+            by_day = self.partitions.split(records)
+            for day in by_day:
+                await self._ensure(conn, day)
+            async with conn.transaction():
+                for day, day_records in by_day.items():
+                    await conn.copy_to_table(self.partitions.name(day).rpartition('.')[2], schema_name=self.schema,
+                                             columns=self.table.columns, source=encoder.encode(day_records),
+                                             format='binary')
+        pgstore.COPY_SECONDS.observe(time.monotonic() - started, (self.table.name,))
+        self._rejected += encoder.rejected - rejected
+
+    async def _ensure(self, conn, day):
+        if day in self.partitions.known:
+            return
+        try:
+            await conn.execute(self.partitions.create_sql(day))
+        except (self._asyncpg.DuplicateTableError, self._asyncpg.UniqueViolationError):
+            # another writer created it meanwhile
+            pass
+        self.partitions.known.add(day)
+
+    def _lost(self, conn):
+        if conn is not None:
+            conn.terminate()
+        logging.error('AsyncPgStore: db is down, next try in {0} seconds'.format(self._delay))
+        self._retry_at = time.monotonic() + self._delay
+        self._delay = min(self._delay * 2, self.BACKOFF_MAX)
+        return None
+
+    async def _reconnect(self, conn):
+        if conn is not None:
+            conn.terminate()
+        delay = 1
+        while True:
+            try:
+                conn = await self._asyncpg.connect(**self.dsn)
+                logging.info('AsyncPgStore: reconnected to db')
+                return conn
+            except self._errors as e:
+                logging.error('AsyncPgStore: reconnect failed, next try in {0} seconds: {1}'.format(delay, e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.BACKOFF_MAX)
+
+    def _spool(self, records):
+        try:
+            self.spool.append(records)
+            return True
+        except OSError as e:
+            logging.error('AsyncPgStore: spool failed: {0}'.format(e))
+            return False
+
+    def waitCompletion(self):
+        if self._loop.is_running():
+            return
+        self._loop.run_until_complete(self._join())
+        for writer in self._writers:
+            writer.cancel()
+        self._loop.run_until_complete(asyncio.gather(*self._writers, return_exceptions=True))
+        self._writers = []
+
+    @property
+    def rejected(self):
+        return self._rejected + (self.spool.rejected if self.spool is not None else 0)
+
+    async def _join(self):
+        while self._unfinished > 0:
+            self._done.clear()
+            await self._done.wait()
+
+    def getQueueSize(self):
+        return len(self._batches)
+
+    def pop_stats(self):
+        replayed = self.replayer.replayed if self.replayer else 0
+        stats = {
+            'queue_bytes': self._bytes,
+            'dropped_records': self.dropped - self._dropped,
+            'spilled_records': self.spilled - self._spilled,
+            'db_errors': self.db_errors - self._db_errors,
+            'replayed_records': replayed - self._replayed,
+        }
+        self._dropped = self.dropped
+        self._spilled = self.spilled
+        self._db_errors = self.db_errors
+        self._replayed = replayed
+        return stats
@@ -0,0 +1,437 @@
+"""Benchmarks of the collector hot paths.
+
+    `nfc-bench` feeds packets from `SyntheticExporter` through the parser,
+the NEL transform, the COPY encoders, the UDP loopback path and
+optionally a real PostgreSQL, and prints one JSON document with records
+per second and traced memory of every benchmark. Given a previous
+document as `--baseline` it marks and exits non-zero on regressions.
+"""
+import asyncio
+import json
+import logging
+import platform
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+import click
+import psycopg2
+import psycopg2.extensions
+
+from . import nf
+from . import filters
+from . import pgstore
+from . import aiostore
+from . import receiver
+from . import workers
+from . import daemon
+
+
+LAYOUTS = {
+    # minimal NAT event template as exported by Cisco IOS XE
+    'nel': ('INGRESS_VRFID', 'NAT_EVENT', 'EVENT_TIME_MSEC', 'IPV4_SRC_ADDR', 'IPV4_DST_ADDR', 'L4_SRC_PORT',
+            'L4_DST_PORT', 'XLATE_SRC_ADDR_IPV4', 'XLATE_SRC_PORT', 'PROTOCOL'),
+    # same plus fields the collector doesn't store, to measure skipping them
+    'nel-wide': ('INGRESS_VRFID', 'EGRESS_VRFID', 'NAT_EVENT', 'FW_EXT_EVENT', 'EVENT_TIME_MSEC', 'IPV4_SRC_ADDR',
+                 'IPV4_DST_ADDR', 'L4_SRC_PORT', 'L4_DST_PORT', 'XLATE_SRC_ADDR_IPV4', 'XLATE_DST_ADDR_IPV4',
+                 'XLATE_SRC_PORT', 'XLATE_DST_PORT', 'PROTOCOL', 'ICMP_TYPE', 'SRC_VLAN', 'DST_VLAN'),
+    # NAT64: IPv6 inside and destination addresses, IPv4 translated ones
+    'nat64': ('NAT_EVENT', 'EVENT_TIME_MSEC', 'IPV6_SRC_ADDR', 'IPV6_DST_ADDR', 'L4_SRC_PORT', 'L4_DST_PORT',
+              'XLATE_SRC_ADDR_IPV4', 'XLATE_DST_ADDR_IPV4', 'XLATE_SRC_PORT', 'PROTOCOL'),
+    # nel plus a variable-length NAT pool name, IPFIX only: the cursor decoder path
+    'nel-pool': ('NAT_EVENT', 'EVENT_TIME_MSEC', 'IPV4_SRC_ADDR', 'IPV4_DST_ADDR', 'L4_SRC_PORT', 'L4_DST_PORT',
+                 'XLATE_SRC_ADDR_IPV4', 'XLATE_SRC_PORT', 'PROTOCOL', 'NAT_POOL_NAME'),
+}
+
+
+class SyntheticExporter:
+    """Builds NetFlow v9 or IPFIX (`version` 10) packets: a template flowset and data flowsets.
+
+        `layout` is a sequence of field names from `nf.FieldTypeTable`.
+    NAT_EVENT alternates between create (1) and delete (2), EVENT_TIME_MSEC
+    grows by a millisecond per record, other fields are random. Fields of
+    no fixed length (IF_NAME and the like) are variable-length in IPFIX,
+    their values take 1 to 32 bytes; `record_size` doesn't count them.
+    """
+    HEADERS = {9: struct.Struct('!HHIIII'), 10: struct.Struct('!HHIII')}
+    TEMPLATE_SETS = {9: 0, 10: 2}
+    FLOWSET = struct.Struct('!HH')
+
+    def __init__(self, layout, records_per_packet=20, template_id=256, source_id=0, seed=0, version=9):
+        fields = nf.FieldTypeTable()
+        self.layout = tuple(layout)
+        self.version = version
+        self.records = []
+        for name in self.layout:
+            field = fields.get_by_name(name)
+            if field is None:
+                raise ValueError('unknown field {0}'.format(name))
+            if not field[1] and version != 10:
+                raise ValueError('variable-length field {0} needs IPFIX'.format(name))
+            self.records.append((field[0], field[1] or nf.VARIABLE_LENGTH))
+        self.records_per_packet = records_per_packet
+        self.template_id = template_id
+        self.source_id = source_id
+        self.record_size = sum(length for _, length in self.records if length != nf.VARIABLE_LENGTH)
+        self._random = random.Random(seed)
+        self._seq = 0
+        self._event_time = 1600000000000
+        self._count = 0
+
+    def _packet(self, flowset_id, body, count):
+        flowset = self.FLOWSET.pack(flowset_id, self.FLOWSET.size + len(body)) + body
+        header = self.HEADERS[self.version]
+        if self.version == 10:
+            # IPFIX sequence numbers count data records
+            header = header.pack(10, header.size + len(flowset), int(time.time()), self._seq, self.source_id)
+            self._seq += count if flowset_id > 255 else 0
+        else:
+            self._seq += 1
+            header = header.pack(9, count, 1000, int(time.time()), self._seq, self.source_id)
+        return header + flowset
+
+    def template_packet(self):
+        body = self.FLOWSET.pack(self.template_id, len(self.records))
+        body += b''.join(self.FLOWSET.pack(field_type, length) for field_type, length in self.records)
+        return self._packet(self.TEMPLATE_SETS[self.version], body, 1)
+
+    def _record(self):
+        self._count += 1
+        self._event_time += 1
+        values = []
+        for name, (_, length) in zip(self.layout, self.records):
+            if name == 'NAT_EVENT':
+                value = 1 if self._count % 2 else 2
+            elif name == 'EVENT_TIME_MSEC':
+                value = self._event_time
+            elif length == nf.VARIABLE_LENGTH:
+                value = bytes(self._random.randrange(97, 123) for _ in range(self._random.randint(1, 32)))
+                values.append(bytes((len(value),)) + value)
+                continue
+            else:
+                value = self._random.getrandbits(length * 8)
+            values.append(value.to_bytes(length, 'big'))
+        return b''.join(values)
+
+    def data_packet(self):
+        body = b''.join(self._record() for _ in range(self.records_per_packet))
+        # flowsets are padded to 4 bytes
+        body += b'\x00' * (-len(body) % 4)
+        return self._packet(self.template_id, body, self.records_per_packet)
+
+    def packets(self, count):
+        """Template packet followed by `count` data packets."""
+        return [self.template_packet()] + [self.data_packet() for _ in range(count)]
+
+
+class NullSink(daemon.NelProtocol):
+    """NEL protocol throwing batches away, only counts records."""
+    # every record, as the receive path delivers them
+    FILTER = None
+
+    def __init__(self, buffer_size=1000):
+        daemon.NelProtocol.__init__(self, buffer_size, flush_interval=0)
+        self.written = 0
+
+    def write_batch(self, records):
+        self.written += len(records)
+
+
+ADDR = ('192.0.2.1', 2055)
+
+
+def bench_parse_full(packets):
+    parser = nf.Parser(version=nf.VERSIONS)
+    return lambda: sum(1 for packet in packets for _ in parser.parse(packet, ADDR))
+
+
+def nel_parser(record_filter=daemon.NelProtocol.FILTER):
+    routes = filters.compile_routes([filters.Filter(record_filter)])
+    return nf.Parser(version=nf.VERSIONS, fields=daemon.NelProtocol.FIELDS, required=daemon.NelProtocol.REQUIRED,
+                     routes=routes)
+
+
+def bench_parse_projection(packets):
+    parser = nel_parser()
+    return lambda: sum(1 for packet in packets for _ in parser.parse(packet, ADDR))
+
+
+def bench_parse_filter(record_filter):
+    """Routing with a filter, counts records examined: kept and filtered out."""
+    def bench(packets):
+        parser = nel_parser(record_filter)
+
+        def run():
+            kept = sum(len(records) for packet in packets for records in parser.route(packet, ADDR))
+            return kept + parser.pop_stats()['filtered']
+        return run
+    return bench
+
+
+def bench_parse_batch(packets):
+    parser = nel_parser()
+    return lambda: sum(batch.count for packet in packets for batch in parser.parse_batch(packet, ADDR))
+
+
+def bench_transform(packets):
+    sink = NullSink()
+    parser = nel_parser()
+    flow_sets = [item for packet in packets for item in parser.route(packet, ADDR)[0]]
+
+    def run():
+        for header, fs in flow_sets:
+            sink._handle_flow_set(ADDR, header, fs)
+        sink.buffer = []
+        return len(flow_sets)
+    return run
+
+
+def nel_batches(packets, batch_size):
+    sink = NullSink(buffer_size=sys.maxsize)
+    parser = nel_parser()
+    for packet in packets:
+        sink.flow_sets_received(ADDR, parser.route(packet, ADDR)[0])
+    records = sink.buffer
+    return [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+
+
+def bench_copy(encoder):
+    def bench(packets, batch_size):
+        batches = nel_batches(packets, batch_size)
+        return lambda: sum(len(batch) for batch in batches if encoder.encode(batch) is not None)
+    return bench
+
+
+def bench_udp_loopback(recv_batch=0):
+    """Sends packets over loopback to the real listener, counts decoded records.
+
+        `recv_batch` selects the receiver, see `receiver.listen`. Lost
+    datagrams are not resent, a run ends once the sender is done and
+    nothing has arrived for 50 ms.
+    """
+    return lambda packets: _udp_loopback(packets, recv_batch)
+
+
+def _udp_loopback(packets, recv_batch):
+    loop = asyncio.new_event_loop()
+    sink = NullSink()
+    protocol = daemon.MultiProtocol([sink], report=lambda seconds, stats: None)
+    sock = workers.bind_udp('127.0.0.1', 0)
+    receiver.set_receive_buffer(sock, 16 << 20)
+    receiver.listen(loop, sock, protocol, recv_batch)
+    out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    out.connect(sock.getsockname())
+
+    def wait(sender, expected, idle=0.05):
+        done = loop.create_future()
+        progress = [-1, 0]
+
+        def check():
+            if sink._stat_dgrams != progress[0]:
+                progress[:] = [sink._stat_dgrams, time.monotonic()]
+            if sink._stat_dgrams >= expected or (not sender.is_alive() and time.monotonic() - progress[1] > idle):
+                done.set_result(None)
+            else:
+                loop.call_later(0.001, check)
+        loop.call_soon(check)
+        loop.run_until_complete(done)
+
+    # template must be known before the flood
+    sender = threading.Thread(target=out.send, args=(packets[0],))
+    sender.start()
+    wait(sender, 1, idle=1)
+
+    def run():
+        sink._stat_dgrams = sink._stat_records = 0
+        sender = threading.Thread(target=lambda: [out.send(packet) for packet in packets[1:]])
+        sender.start()
+        wait(sender, len(packets) - 1)
+        sender.join()
+        sink.flush()
+        return sink._stat_records
+    return run
+
+
+def bench_pg_copy(dsn, copy_format):
+    def bench(packets, batch_size):
+        batches = nel_batches(packets, batch_size)
+        table = pgstore.Table('nfc_bench_log_items', tuple(zip(pgstore.NEL_TABLE.columns, pgstore.NEL_TABLE.types)))
+        writer = pgstore.PgWriter({'dsn': dsn}, pgstore.COPY_FORMATS[copy_format](table))
+        writer.db_conn = psycopg2.connect(dsn)
+        cur = writer.db_conn.cursor()
+        cur.execute('DROP TABLE IF EXISTS nfc_bench_log_items')
+        cur.execute('CREATE UNLOGGED TABLE nfc_bench_log_items (event_time int8, src_addr inet, dst_addr inet, '
+                    'dst_port int4, xlate_src_addr inet, xlate_src_port int4, protocol int4, xlate_dst_addr inet, '
+                    'vrf_name text)')
+        writer.db_conn.commit()
+
+        def run():
+            for batch in batches:
+                writer.write(batch)
+            cur.execute('TRUNCATE nfc_bench_log_items')
+            writer.db_conn.commit()
+            return sum(len(batch) for batch in batches)
+        return run
+    return bench
+
+
+def bench_pg_store(dsn, writer, connections=4):
+    """Batches through a whole pg-nel-store writer, `daemon.WRITERS`, until all are committed."""
+    def bench(packets, batch_size):
+        batches = nel_batches(packets, batch_size)
+        params = psycopg2.extensions.parse_dsn(dsn)
+        if 'dbname' in params:
+            params['database'] = params.pop('dbname')
+        table = pgstore.Table('nfc_bench_log_items', tuple(zip(pgstore.NEL_TABLE.columns, pgstore.NEL_TABLE.types)))
+        db_conn = psycopg2.connect(dsn)
+        cur = db_conn.cursor()
+        cur.execute('DROP TABLE IF EXISTS nfc_bench_log_items')
+        cur.execute('CREATE UNLOGGED TABLE nfc_bench_log_items (event_time int8, src_addr inet, dst_addr inet, '
+                    'dst_port int4, xlate_src_addr inet, xlate_src_port int4, protocol int4, xlate_dst_addr inet, '
+                    'vrf_name text)')
+        db_conn.commit()
+        # the asyncio writer runs the loop itself while its queue is full
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        queue_batches = len(batches) if writer == 'threads' else connections * 2
+        if writer == 'asyncio':
+            store = aiostore.AsyncPgStore(connections, params, table, queue_batches=queue_batches, queue_bytes=1 << 40)
+        else:
+            store = pgstore.StorePgThreadPool(connections, params, table, 'binary', queue_batches=queue_batches,
+                                              queue_bytes=1 << 40)
+
+        def run():
+            for batch in batches:
+                store.addRequest(batch)
+            store.waitCompletion()
+            cur.execute('TRUNCATE nfc_bench_log_items')
+            db_conn.commit()
+            return sum(len(batch) for batch in batches)
+        return run
+    return bench
+
+
+def measure(run, repeat):
+    """Best time of `repeat` runs, then traced memory of one more run."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        records = run()
+        seconds = time.perf_counter() - started
+        best = seconds if best is None else min(best, seconds)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'records': records,
+        'seconds': round(best, 6),
+        'records_per_sec': round(records / best) if best else None,
+        'ns_per_record': round(best * 1e9 / records, 1) if records else None,
+        'alloc_peak_bytes': peak - before,
+        'retained_bytes': current - before,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Mark results slower than baseline by more than `tolerance`, return their names."""
+    previous = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(result['name'])
+        if not old or not old.get('records_per_sec') or not result['records_per_sec']:
+            continue
+        result['baseline_records_per_sec'] = old['records_per_sec']
+        result['change'] = round(result['records_per_sec'] / old['records_per_sec'] - 1, 3)
+        result['regression'] = result['change'] < -tolerance
+        if result['regression']:
+            regressions.append(result['name'])
+    return regressions
+
+
+@click.command()
+@click.option('-l', '--layout', default='nel', metavar='<name|field,...>',
+              help='Template layout: {0} or comma separated field names.'.format(', '.join(sorted(LAYOUTS))))
+@click.option('-n', '--packets', default=2000, help='Data packets per run.')
+@click.option('-r', '--records-per-packet', default=20)
+@click.option('--ipfix', is_flag=True, help='Export IPFIX instead of NetFlow v9.')
+@click.option('--batch-size', default=1000, help='Records per COPY batch.')
+@click.option('--repeat', default=5, help='Runs per benchmark, the best one is reported.')
+@click.option('-b', '--bench', 'selected', multiple=True, help='Run only these benchmarks, may be repeated.')
+@click.option('--dsn', help='libpq connection string, enables PostgreSQL COPY benchmarks (table nfc_bench_log_items).')
+@click.option('-o', '--output', type=click.File('w'), default='-', help='Where to write the JSON results.')
+@click.option('--baseline', type=click.File('r'), help='Previous results to compare with.')
+@click.option('--tolerance', default=0.1, help='Relative slowdown against baseline reported as regression.')
+def main(layout, packets, records_per_packet, ipfix, batch_size, repeat, selected, dsn, output, baseline, tolerance):
+    logging.basicConfig(level=logging.WARNING)
+
+    exporter = SyntheticExporter(LAYOUTS.get(layout) or layout.split(','), records_per_packet,
+                                 version=10 if ipfix else 9)
+    data = exporter.packets(packets)
+
+    benchmarks = [
+        ('parse-full', bench_parse_full),
+        ('parse-projection', bench_parse_projection),
+        ('parse-filter', bench_parse_filter(daemon.NelProtocol.FILTER)),
+        ('parse-filter-prefix', bench_parse_filter('NAT_EVENT in (1, 2) and XLATE_SRC_ADDR_IPV4 in 100.64.0.0/10')),
+        ('parse-batch', bench_parse_batch),
+        ('transform', bench_transform),
+        ('copy-text', bench_copy(pgstore.TextCopy(pgstore.NEL_TABLE))),
+        ('copy-binary', bench_copy(pgstore.BinaryCopy(pgstore.NEL_TABLE))),
+        ('udp-loopback', bench_udp_loopback()),
+        ('udp-loopback-recvmmsg', bench_udp_loopback(64)),
+    ]
+    if dsn:
+        benchmarks += [('pg-copy-' + fmt, bench_pg_copy(dsn, fmt)) for fmt in sorted(pgstore.COPY_FORMATS)]
+        benchmarks.append(('pg-store-threads', bench_pg_store(dsn, 'threads')))
+        try:
+            import asyncpg  # noqa: F401
+            benchmarks.append(('pg-store-asyncio', bench_pg_store(dsn, 'asyncio')))
+        except ImportError:
+            logging.warning('asyncpg is not installed, skipping pg-store-asyncio')
+
+    results = []
+    for name, bench in benchmarks:
+        if selected and name not in selected:
+            continue
+        run = bench(data, batch_size) if name.startswith(('copy-', 'pg-')) else bench(data)
+        result = {'name': name}
+        result.update(measure(run, repeat))
+        results.append(result)
+        click.echo('{0:>22}: {1:>10} records/s'.format(name, result['records_per_sec']), err=True)
+
+    regressions = compare(results, json.load(baseline), tolerance) if baseline else []
+
+    json.dump({
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'numpy': nf.numpy is not None,
+            'layout': list(exporter.layout),
+            'version': exporter.version,
+            'record_size': exporter.record_size,
+            'records_per_packet': records_per_packet,
+            'packets': packets,
+            'batch_size': batch_size,
+            'repeat': repeat,
+            'time': int(time.time()),
+        },
+        'results': results,
+    }, output, indent=2)
+    output.write('\n')
+
+    if regressions:
+        click.echo('Regressions: {0}'.format(', '.join(regressions)), err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,125 +2,289 @@
 
 import time
 import asyncio
+import functools
 import ipaddress
-import queue
 import threading
-import io
 import logging
+import signal
 
 import click
-import psycopg2
 
-from . import util
 from . import nf
+from . import nat
 from . import pcap
+from . import workers
+from . import tplstore
+from . import pgstore
+from . import aiostore
+from . import spool
+from . import filestore
+from . import filters
+from . import metrics
+from . import receiver
 
 
-class StorePgThreadPool:
-    class Worker(threading.Thread):
-        def __init__(self, requests, dsn):
-            threading.Thread.__init__(self)
-            self.requests = requests
+DATAGRAMS = metrics.REGISTRY.counter('nfc_datagrams_total', 'Datagrams received.', ('exporter',))
+DATAGRAM_BYTES = metrics.REGISTRY.counter('nfc_datagram_bytes_total', 'Size of datagrams received.', ('exporter',))
 
-            self.db_conn = psycopg2.connect(**dsn)
+# pg-nel-store writers: pgstore.StorePgThreadPool, aiostore.AsyncPgStore
+WRITERS = ('threads', 'asyncio')
 
-            self.setDaemon(True)
-            self.start()
 
-        def run(self):
-            while True:
-                records = self.requests.get()
-                data = '\n'.join(
-                    ['\t'.join(
-                        [str(i) for i in rec]
-                    ) for rec in records]
-                )
-                f = io.StringIO(data)
-                cur = self.db_conn.cursor()
-                cur.copy_from(
-                    f, 'nfcollect.log_items',
-                    columns=('event_time', 'src_addr', 'dst_addr', 'dst_port', 'xlate_src_addr', 'xlate_src_port', 'protocol'))
-                self.db_conn.commit()
-                cur.close()
-                self.requests.task_done()
-                logging.info('StorePgThreadPool: data batch commited to db')
-
-    def __init__(self, num_threads, db_conn_str):
-        self.requests = queue.Queue(num_threads)
-        for _ in range(num_threads):
-            self.Worker(self.requests, db_conn_str)
-
-    def addRequest(self, records_buf):
-        self.requests.put(records_buf)
-
-    def waitCompletion(self): self.requests.join()
-
-    def getQueueSize(self):
-        return self.requests.qsize()
+class MirrorProtocol:
+    """Forwards datagrams unchanged to one or more targets.
+
+        With `exporters` (ipaddress networks) only datagrams from them are
+    forwarded, with `templates` only datagrams carrying a data flowset of
+    one of them; template flowsets always pass so targets can decode.
+    Buffers are sent as they came, memoryviews included. While more than
+    `queue_bytes` wait in a target's send buffer, datagrams for it are
+    dropped.
+    """
+    STATS_FORMAT = 'forwarded {forwarded} datagrams, filtered out {filtered}, dropped {dropped} on full send queues'
+
+    class Target(asyncio.DatagramProtocol):
+        def __init__(self, addr):
+            self.addr = addr
+
+        def error_received(self, exc):
+            logging.error('mirror: {0}:{1}: {2}'.format(self.addr[0], self.addr[1], exc))
+
+        def connection_lost(self, exc):
+            logging.info('mirror: {0}:{1}: socket closed'.format(self.addr[0], self.addr[1]))
+
+    def __init__(self, transports, exporters=(), templates=(), queue_bytes=1 << 20):
+        self.transports = transports
+        self.exporters = tuple(exporters)
+        self.templates = frozenset(templates)
+        self.queue_bytes = queue_bytes
+        self._allowed = {}
+        self._forwarded = 0
+        self._filtered = 0
+        self._dropped = 0
+
+    def _exporter_allowed(self, host):
+        allowed = self._allowed.get(host)
+        if allowed is None:
+            address = ipaddress.ip_address(host)
+            allowed = self._allowed[host] = any(address in network for network in self.exporters)
+        return allowed
+
+    def _templates_allowed(self, buffer):
+        for flow_set_id in nf.flow_set_ids(buffer):
+            if flow_set_id < 256 or flow_set_id in self.templates:
+                return True
+        return False
 
+    def datagram_received(self, buffer, addr):
+        self.datagrams_received(((buffer, addr),))
+
+    def datagrams_received(self, batch):
+        for buffer, addr in batch:
+            if (self.exporters and not self._exporter_allowed(addr[0])) or \
+                    (self.templates and not self._templates_allowed(buffer)):
+                self._filtered += 1
+                continue
+            for transport in self.transports:
+                if transport.get_write_buffer_size() > self.queue_bytes:
+                    self._dropped += 1
+                else:
+                    transport.sendto(buffer)
+                    self._forwarded += 1
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+
+    def pop_stats(self):
+        stats = {'forwarded': self._forwarded, 'filtered': self._filtered, 'dropped': self._dropped}
+        self._forwarded = self._filtered = self._dropped = 0
+        return stats
+
+
+class NelProtocol:
+    """Base of NAT event (NEL) sinks: turns decoded records into rows handed over in batches.
+
+        MultiProtocol decodes `FIELDS` of every datagram once and passes
+    the records matching `FILTER` (see `filters`) to `flow_sets_received`.
+    By default session create events become `TABLE` rows: (event_time, src_addr, dst_addr, dst_port,
+    xlate_src_addr, xlate_src_port, protocol, xlate_dst_addr, vrf_name)
+    tuples with IPv4 addresses as ints and IPv6 ones as 16 bytes. An `events` mode (see `nat.MODES`) brings fields, table and
+    record handling of its own. Subclasses implement `write_batch` and
+    `pop_sink_stats`.
+    """
+    # NEL columns decoded by the compiled template projection, in unpack order.
+    # NAT64 templates carry IPv6 inside addresses, xlate_dst_addr is optional.
+    # VRF names come from exporter options by the VRF ID (nf.ENRICHED).
+    FIELDS = ('NAT_EVENT', 'EVENT_TIME_MSEC', ('IPV4_SRC_ADDR', 'IPV6_SRC_ADDR'), ('IPV4_DST_ADDR', 'IPV6_DST_ADDR'),
+              'L4_DST_PORT', ('XLATE_SRC_ADDR_IPV4', 'XLATE_SRC_ADDR_IPV6'), 'XLATE_SRC_PORT', 'PROTOCOL',
+              ('XLATE_DST_ADDR_IPV4', 'XLATE_DST_ADDR_IPV6'), 'VRF_NAME')
+    REQUIRED = FIELDS[:-2]
+    FILTER = 'NAT_EVENT == 1'
+    TABLE = pgstore.NEL_TABLE
+    STATS_FORMAT = 'handled {records} records in {dgrams} datagrams, current buffer {buffer}'
+
+    def __init__(self, buffer_size=1000, flush_interval=5, events=None, record_filter=None):
+        self.events = None
+        if events is not None:
+            self.events = events(self.add_row)
+            self.FIELDS = self.events.FIELDS
+            self.REQUIRED = self.events.REQUIRED
+            # modes tell the events apart themselves
+            self.FILTER = None
+            self.TABLE = self.events.TABLE
+            self.STATS_FORMAT = self.STATS_FORMAT + ', ' + self.events.STATS_FORMAT
+            self._handle_flow_set = self.events.handle
+        if record_filter is not None:
+            self.FILTER = record_filter
+        self.buffer = []
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._buffer_started = time.monotonic()
+        self._stat_dgrams = 0
+        self._stat_records = 0
+        if flush_interval:
+            self._loop = asyncio.get_event_loop()
+            self._loop.call_later(flush_interval, self._flush_timer)
+
+    def _flush_timer(self):
+        # quiet links must not keep a partial buffer forever
+        if self.buffer and time.monotonic() - self._buffer_started >= self.flush_interval:
+            self.flush()
+        self._loop.call_later(self.flush_interval, self._flush_timer)
+
+    def flush(self):
+        if self.buffer:
+            self.write_batch(self.buffer)
+            self.buffer = []
+
+    def write_batch(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        if self.events is not None:
+            self.events.close()
+        self.flush()
+
+    def add_row(self, row):
+        if not self.buffer:
+            self._buffer_started = time.monotonic()
+        self.buffer.append(row)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flow_sets_received(self, addr, flow_sets):
+        """Records of one datagram: [(pkt_header, record), ...], shared with other sinks."""
+        self._stat_dgrams += 1
+        self._stat_records += len(flow_sets)
+        handle = self._handle_flow_set
+        for pkt_header, flow_set in flow_sets:
+            handle(addr, pkt_header, flow_set)
 
-class MirrorProtocol:
-    def __init__(self, target=None):
-        self._target = target
+    def _handle_flow_set(self, addr, header, fs):
+        nat_event, event_time_msec, src_addr, dst_addr, dst_port, xlate_src_addr, xlate_src_port, protocol, \
+            xlate_dst_addr, vrf_name = fs
+        # addresses stay ints or bytes, sinks format them
+        self.add_row((event_time_msec // 1000, src_addr, dst_addr, dst_port, xlate_src_addr, xlate_src_port, protocol,
+                      xlate_dst_addr, vrf_name))
+
+    def pop_sink_stats(self):
+        return {}
+
+    def pop_stats(self):
+        stats = {
+            'records': self._stat_records,
+            'dgrams': self._stat_dgrams,
+            'buffer': len(self.buffer),
+        }
+        self._stat_dgrams = 0
+        self._stat_records = 0
+        if self.events is not None:
+            stats.update(self.events.pop_stats())
+        stats.update(self.pop_sink_stats())
+        return stats
 
-    def connection_made(self, transport):
-        self.transport = transport
 
-    def datagram_received(self, buffer, addr):
-        self._target.transport.sendto(buffer)
+class PgNelStoreProtocol(NelProtocol):
+    STATS_FORMAT = NelProtocol.STATS_FORMAT + (
+        ', queue size {queue_size} ({queue_bytes} bytes), dropped {dropped_records} spilled {spilled_records} '
+        'replayed {replayed_records} records, db errors {db_errors}')
 
-    def error_received(self, exc):
-        print('mirror: Error received:', exc)
+    def __init__(self, dsn, workers=1, buffer_size=1000, flush_interval=5, events=None, shards=(), shard_by='xlate-addr',
+                 shard_interval=60, writer='threads', record_filter=None, **pool_options):
+        NelProtocol.__init__(self, buffer_size, flush_interval, events, record_filter)
+        pool = pgstore.StorePgThreadPool
+        if writer == 'asyncio':
+            pool = aiostore.AsyncPgStore
+            # always binary COPY
+            pool_options.pop('copy_format', None)
+        if shards:
+            self.workers_pool = pgstore.ShardedPgStore(
+                workers, shards, self.TABLE, shard_by, shard_interval, pool=pool, **pool_options)
+        else:
+            self.workers_pool = pool(workers, dsn, self.TABLE, **pool_options)
 
-    def connection_lost(self, exc):
-        print("mirror: Socket closed")
+    def write_batch(self, records):
+        self.workers_pool.addRequest(records)
 
-    def report_stats(self, seconds):
-        pass
+    def close(self):
+        NelProtocol.close(self)
+        self.workers_pool.waitCompletion()
 
+    def pop_sink_stats(self):
+        stats = {'queue_size': self.workers_pool.getQueueSize()}
+        stats.update(self.workers_pool.pop_stats())
+        return stats
 
-class PgNelStoreProtocol:
-    def __init__(self, dsn, workers=1, buffer_size=1000):
-        self.nf_parser = nf.Parser(version=9)
-        self.workers_pool = StorePgThreadPool(workers, dsn)
-        self.buffer = []
-        self.buffer_size = buffer_size
-        self._stat_dgrams = 0
-        self._stat_flowsets = 0
 
-    def datagram_received(self, buffer, addr):
-        self._stat_dgrams += 1
-        for pkt_header, flow_set in self.nf_parser.parse(buffer, addr):
-            self._stat_flowsets += 1
-            self._handle_flow_set(addr, pkt_header, flow_set)
+class FileStoreProtocol(NelProtocol):
+    STATS_FORMAT = NelProtocol.STATS_FORMAT + (
+        ', queue size {queue_size}, written {written_records} records to {files} files, dropped {dropped_records} '
+        'rejected {rejected_records} records')
+
+    def __init__(self, directory, file_format, rotate, buffer_size=1000, flush_interval=5, events=None,
+                 record_filter=None):
+        NelProtocol.__init__(self, buffer_size, flush_interval, events, record_filter)
+        self.sink = filestore.FileSink(directory, self.TABLE, file_format, rotate)
+
+    def write_batch(self, records):
+        self.sink.add(records)
+
+    def close(self):
+        NelProtocol.close(self)
+        self.sink.close()
+
+    def pop_sink_stats(self):
+        return self.sink.pop_stats()
 
-    def _handle_flow_set(self, addr, header, fs):
-        if hasattr(fs, 'IPV4_SRC_ADDR') and hasattr(fs, 'IPV4_DST_ADDR'):
-            if fs.NAT_EVENT == 1:
-                IPV4_SRC_ADDR = ipaddress.ip_address(fs.IPV4_SRC_ADDR)
-                IPV4_DST_ADDR = ipaddress.ip_address(fs.IPV4_DST_ADDR)
-                XLATE_SRC_ADDR_IPV4 = ipaddress.ip_address(fs.XLATE_SRC_ADDR_IPV4)
-
-                self.buffer.append(
-                    (int(fs.EVENT_TIME_MSEC/1000), IPV4_SRC_ADDR, IPV4_DST_ADDR, fs.L4_DST_PORT, XLATE_SRC_ADDR_IPV4, fs.XLATE_SRC_PORT, fs.PROTOCOL)
-                )
-
-                if len(self.buffer) >= self.buffer_size:
-                    self.workers_pool.addRequest(self.buffer)
-                    self.buffer = []
-
-    def report_stats(self, seconds):
-        logging.info('PgNelStoreProtocol: handled {0} flow sets in {1} datagrams for {2} seconds'.format(self._stat_flowsets, self._stat_dgrams, seconds))
-        self._stat_dgrams = 0
-        self._stat_flowsets = 0
-        logging.info('PgNelStoreProtocol: queue size {0} current buffer {1}'.format(self.workers_pool.getQueueSize(), len(self.buffer)))
+
+def report_stats(seconds, stats):
+    """Log stats collected by MultiProtocol.StatReporter: [(name, format, stats), ...]."""
+    for name, fmt, values in stats:
+        if fmt:
+            logging.info('{0}: {1} for {2} seconds'.format(name, fmt.format(**values), seconds))
 
 
 class MultiProtocol:
+    """Fans datagrams out to the protocols.
+
+        Raw consumers (`datagrams_received`, mirrors) get the datagrams
+    first and as they came, so decoding and sinks don't delay them.
+    Decoding consumers (`FIELDS` and `flow_sets_received`, NEL sinks)
+    share one parser per distinct `FIELDS` and `REQUIRED`: a datagram is parsed once and
+    the same records list goes to every consumer with the same `FILTER`,
+    the parser routes records between distinct filters.
+    """
+    PARSER_STATS_FORMAT = (
+        'pending flowsets: held {held} replayed {replayed} expired {expired} dropped {dropped} evicted {evicted}, '
+        'export packets: lost {lost} duplicate {duplicate} reordered {reordered} seq resets {seq_resets}, '
+        'options records {options}, filtered out {filtered} records, malformed flowsets {malformed}')
+
     class StatReporter(threading.Thread):
-        def __init__(self, protocols):
+        def __init__(self, collect, report):
             threading.Thread.__init__(self)
-            self.protocols = protocols
+            self.collect = collect
+            self.report = report
             self.setDaemon(True)
             self.start()
 
@@ -128,63 +292,226 @@ class MultiProtocol:
             while True:
                 period = 60
                 time.sleep(period)
-                for proto in self.protocols:
-                    proto.report_stats(period)
-
-    def __init__(self, protocols):
-        self._protocols = protocols
-        self._stat_reporter = self.StatReporter(protocols)
+                self.report(period, self.collect())
+
+    def __init__(self, protocols, report=report_stats):
+        self.protocols = protocols
+        self._raw = [proto for proto in protocols if hasattr(proto, 'datagrams_received')]
+        groups = {}
+        for proto in protocols:
+            if hasattr(proto, 'flow_sets_received'):
+                groups.setdefault((proto.FIELDS, proto.REQUIRED), []).append(proto)
+        self._decoders = []
+        for (fields, required), consumers in groups.items():
+            name = ','.join(type(consumer).__name__ for consumer in consumers)
+            routes = {}
+            for consumer in consumers:
+                routes.setdefault(getattr(consumer, 'FILTER', None), []).append(consumer.flow_sets_received)
+            compiled = filters.compile_routes([filters.Filter(text) if text else None for text in routes])
+            parser = nf.Parser(version=nf.VERSIONS, fields=fields, required=required, name=name, routes=compiled)
+            self._decoders.append((parser, list(routes.values())))
+        self._stat_reporter = self.StatReporter(self.collect_stats, report)
+
+    def collect_stats(self):
+        """[(name, format, stats), ...] of protocols and parsers since the previous call."""
+        stats = [(type(proto).__name__, proto.STATS_FORMAT, proto.pop_stats()) for proto in self.protocols]
+        stats.extend(('{0} parser'.format(parser.name), self.PARSER_STATS_FORMAT, parser.pop_stats())
+                     for parser, _ in self._decoders)
+        return stats
+
+    def parsers(self):
+        return [parser for parser, _ in self._decoders]
+
+    def close(self):
+        """Write out whatever the protocols still hold."""
+        for proto in self.protocols:
+            if hasattr(proto, 'close'):
+                proto.close()
 
     def connection_made(self, transport):
         self.transport = transport
 
+    def connection_lost(self, exc):
+        # the listener closed at shutdown, the asyncio writer runs the loop afterwards
+        pass
+
     def datagram_received(self, buffer, addr):
-        for proto in self._protocols:
-            proto.datagram_received(buffer, addr)
+        self.datagrams_received(((buffer, addr),))
+
+    def datagrams_received(self, batch):
+        """Batch of (memoryview, addr) from receiver.BatchReceiver, views are reused afterwards."""
+        for buffer, addr in batch:
+            exporter = (addr[0],)
+            DATAGRAMS.inc(exporter)
+            DATAGRAM_BYTES.inc(exporter, len(buffer))
+        for proto in self._raw:
+            proto.datagrams_received(batch)
+        for parser, routes in self._decoders:
+            route = parser.route
+            for buffer, addr in batch:
+                for flow_sets, consumers in zip(route(buffer, addr), routes):
+                    if flow_sets:
+                        for consumer in consumers:
+                            consumer(addr, flow_sets)
 
 
 @click.group(chain=True)
 @click.option('-b', '--bind', default='127.0.0.1:9999', metavar='<host:port>', help='Listen interface.')
+@click.option('-P', '--processes', default=1, help='Number of worker processes sharing the port (SO_REUSEPORT).')
+@click.option('--template-store', metavar='<path>', help='SQLite file to persist NetFlow templates in.')
+@click.option('--template-max-age', default=86400, help='Forget stored templates not seen for this many seconds.')
+@click.option('--metrics', 'metrics_bind', metavar='<host:port>',
+              help='Serve Prometheus metrics on http://<host:port>/metrics, worker N of -P uses port + N.')
+@click.option('--rcvbuf', default=0, help='Socket receive buffer size in bytes, 0 keeps the system default.')
+@click.option('--recv-batch', default=0,
+              help='Receive up to this many datagrams per system call and hand them over at once, 0 uses asyncio.')
+@click.option('--recv-engine', type=click.Choice(receiver.ENGINES),
+              help='How to receive batches, recvmmsg where available by default.')
 @click.pass_context
-def multi(ctx, bind):
+def multi(ctx, bind, processes, template_store, template_max_age, metrics_bind, rcvbuf, recv_batch, recv_engine):
     pass
 
 
-@multi.resultcallback()
-def multi_process(protocols, bind):
+def setup_logging():
     loglevel = getattr(logging, 'INFO')
     logging.basicConfig(
         level=loglevel,
         format='%(asctime)s %(name)s:%(levelname)s %(message)s',
     )
 
-    loop = asyncio.get_event_loop()
+
+def build_protocol(factories, report=report_stats, template_store=None):
+    protocol = MultiProtocol([factory() for factory in factories], report)
+    if template_store is not None:
+        template_store.attach(protocol.parsers())
+    return protocol
+
+
+@multi.resultcallback()
+def multi_process(factories, bind, processes, template_store, template_max_age, metrics_bind, rcvbuf, recv_batch,
+                  recv_engine):
+    setup_logging()
 
     host, port = bind.split(':')
     port = int(port)
-    listen = loop.create_datagram_endpoint(
-        lambda: MultiProtocol(protocols),
-        local_addr=(host, port))
-    transport, protocol = loop.run_until_complete(listen)
+
+    metrics_addr = None
+    if metrics_bind:
+        metrics_host, metrics_port = metrics_bind.rsplit(':', 1)
+        metrics_addr = (metrics_host, int(metrics_port))
+
+    store = None
+    if template_store:
+        store = tplstore.TemplateStore(template_store, max_age=template_max_age)
+
+    if processes > 1:
+        supervisor = workers.Supervisor(
+            (host, port), processes,
+            lambda report: build_protocol(factories, report, store),
+            report_stats, metrics_addr, rcvbuf, recv_batch, recv_engine)
+        click.echo('Started %s with %d workers' % (bind, processes))
+        supervisor.run()
+        return
+
+    loop = asyncio.get_event_loop()
+
+    protocol = build_protocol(factories, template_store=store)
+    sock = workers.bind_udp(host, port)
+    if rcvbuf:
+        receiver.set_receive_buffer(sock, rcvbuf)
+    listener = receiver.listen(loop, sock, protocol, recv_batch, recv_engine)
+    if metrics_addr:
+        metrics.track_socket(sock, listener)
+        metrics.MetricsServer().start(loop, *metrics_addr)
 
     click.echo('Started %s' % bind)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
 
-    transport.close()
+    listener.close()
+    protocol.close()
     loop.close()
 
 
+def event_options(command):
+    """NAT event mode options of the NEL sink commands, see `events_mode`."""
+    options = [
+        click.option('--events', type=click.Choice(sorted(nat.MODES)),
+                     help='Store NAT events this way instead of session create events into log_items.'),
+        click.option('--aggregate-sessions', default=0, metavar='<seconds>',
+                     help='With port-blocks: also fold session create events into port ranges '
+                          'per inside and public address over this window.'),
+        click.option('--session-timeout', default=86400,
+                     help='With sessions: give up sessions without delete after this many seconds.'),
+        click.option('--max-sessions', default=1 << 22,
+                     help='With sessions: most open sessions kept, about 130 bytes each.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def check_filter(ctx, param, value):
+    if value:
+        try:
+            filters.Filter(value)
+        except filters.FilterError as e:
+            raise click.BadParameter(str(e))
+    return value
+
+
+filter_option = click.option(
+    '--filter', 'record_filter', callback=check_filter, metavar='<expression>',
+    help='Only records matching this, e.g. "NAT_EVENT in (1,2) and XLATE_SRC_ADDR_IPV4 in 100.64.0.0/10"; '
+         'session creates (NAT_EVENT == 1) by default, all records with --events.')
+
+
+def events_mode(events, aggregate_sessions, session_timeout, max_sessions):
+    if aggregate_sessions and events != 'port-blocks':
+        raise click.BadParameter('needs --events port-blocks', param_hint='--aggregate-sessions')
+    if events == 'port-blocks':
+        return functools.partial(nat.PortBlocks, aggregate=aggregate_sessions)
+    if events == 'sessions':
+        return functools.partial(nat.Sessions, timeout=session_timeout, max_sessions=max_sessions)
+    return None
+
+
 @multi.command()
 @click.option('-h', '--host')
 @click.option('-p', '--port', default='5432')
 @click.option('-u', '--user', required=True)
 @click.option('-w', '--password')
 @click.option('-n', '--database', required=True)
-@click.option('-t', '--threads', default=1)
-def pg_nel_store(host, port, user, password, database, threads):
+@click.option('-t', '--threads', default=1, help='DB threads, or connections with --writer asyncio.')
+@click.option('--writer', type=click.Choice(WRITERS), default='threads',
+              help='COPY from DB threads, or from the event loop with asyncpg (binary COPY only).')
+@click.option('--copy-format', type=click.Choice(sorted(pgstore.COPY_FORMATS)), default='text',
+              help='COPY payload format, binary skips text formatting.')
+@click.option('--partitioned', is_flag=True, help='COPY into daily partitions directly (db-schema-partitioned.sql).')
+@click.option('--partitions-ahead', default=3, help='Days of partitions to create in advance.')
+@click.option('--buffer-size', default=1000, help='Records per COPY batch.')
+@click.option('--flush-interval', default=5, help='Seconds before a partial batch is flushed anyway, 0 to disable.')
+@click.option('--queue-batches', default=16, help='Max batches waiting for DB threads.')
+@click.option('--queue-bytes', default=64 << 20, help='Max size of batches waiting for DB threads.')
+@click.option('--overflow', type=click.Choice(pgstore.BatchQueue.OVERFLOW_POLICIES),
+              help='What to do with a batch when the queue is full: spill with --spool-dir, drop-newest without.')
+@click.option('--spool-dir', type=click.Path(file_okay=False),
+              help='Spool batches here while the DB is down or the queue is full, replay them later.')
+@click.option('--spool-fsync', type=click.Choice(spool.Spool.FSYNC_POLICIES), default='interval')
+@click.option('--spool-segment-size', default=64 << 20, help='Spool segment file size.')
+@click.option('--shard', 'shards', multiple=True, metavar='<host[:port][/database]>',
+              help='Split batches between databases, may be repeated; user and password are shared.')
+@click.option('--shard-by', type=click.Choice(pgstore.ShardedPgStore.SHARD_BY), default='xlate-addr',
+              help='Public address /24 or event time picks the shard.')
+@click.option('--shard-interval', default=60, help='Seconds of events going to one shard with --shard-by time.')
+@filter_option
+@event_options
+def pg_nel_store(host, port, user, password, database, threads, writer, copy_format, partitioned, partitions_ahead,
+                 buffer_size, flush_interval, queue_batches, queue_bytes, overflow, spool_dir, spool_fsync,
+                 spool_segment_size, shards, shard_by, shard_interval, record_filter, **event_mode):
     dsn = {
         'database': database,
         'user': user,
@@ -193,39 +520,180 @@ def pg_nel_store(host, port, user, password, database, threads):
         'port': port,
     }
 
-    return PgNelStoreProtocol(dsn, threads)
+    if overflow == 'spill' and not spool_dir:
+        raise click.BadParameter('--overflow spill requires --spool-dir')
+    if writer == 'asyncio':
+        try:
+            import asyncpg  # noqa: F401
+        except ImportError:
+            raise click.BadParameter('asyncio writer needs asyncpg', param_hint='--writer')
+
+    return functools.partial(
+        PgNelStoreProtocol, dsn, threads, buffer_size, flush_interval,
+        events=events_mode(**event_mode), copy_format=copy_format, partitions_ahead=partitions_ahead if partitioned else None,
+        queue_batches=queue_batches, queue_bytes=queue_bytes, overflow=overflow,
+        spool_dir=spool_dir, spool_fsync=spool_fsync, spool_segment_bytes=spool_segment_size,
+        shards=[shard_dsn(shard, dsn) for shard in shards], shard_by=shard_by, shard_interval=shard_interval,
+        writer=writer, record_filter=record_filter)
+
+
+def shard_dsn(shard, dsn):
+    """Connection parameters of a --shard: host, port and database override those of `dsn`."""
+    address, _, database = shard.partition('/')
+    if address.startswith('['):
+        host, _, port = address[1:].partition(']')
+        port = port[1:]
+    elif address.count(':') == 1:
+        host, _, port = address.partition(':')
+    else:
+        host, port = address, ''
+    params = dict(dsn, host=host)
+    if port:
+        params['port'] = port
+    if database:
+        params['database'] = database
+    return params
 
 
 @multi.command()
-@click.option('-t', '--to', required=True, metavar='<host:port>', help='Where re-send packets.')
-def mirror(to):
-    host, port = to.split(':')
-    port = int(port)
+@click.option('-t', '--to', 'targets', required=True, multiple=True, metavar='<host:port>',
+              help='Where re-send packets, may be repeated.')
+@click.option('-e', '--exporter', 'exporters', multiple=True, metavar='<network>',
+              help='Only datagrams from this exporter address or network, may be repeated.')
+@click.option('--template', 'templates', multiple=True, type=int,
+              help='Only datagrams with data of this template ID, may be repeated.')
+@click.option('--queue-bytes', default=1 << 20, help='Max bytes waiting to be sent per target, more are dropped.')
+def mirror(targets, exporters, templates, queue_bytes):
+    addrs = []
+    for target in targets:
+        host, port = target.rsplit(':', 1)
+        addrs.append((host, int(port)))
+    try:
+        networks = [ipaddress.ip_network(exporter, strict=False) for exporter in exporters]
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--exporter')
 
-    loop = asyncio.get_event_loop()
-    connect = loop.create_datagram_endpoint(
-        MirrorProtocol, remote_addr=(host, port))
-    target_trans, target_proto = loop.run_until_complete(connect)
+    def factory():
+        loop = asyncio.get_event_loop()
+        transports = []
+        for addr in addrs:
+            connect = loop.create_datagram_endpoint(
+                functools.partial(MirrorProtocol.Target, addr), remote_addr=addr)
+            target_trans, target_proto = loop.run_until_complete(connect)
+            transports.append(target_trans)
+
+        return MirrorProtocol(transports, networks, templates, queue_bytes)
 
-    return MirrorProtocol(target_proto)
+    return factory
 
 
-@click.command()
-@click.argument('input', type=click.File('rb'))
-def parse_pcap(input):
-    ipv4_header = util.structuple('ipv4_header', '!IIIII', 'field1 field2 field3 src_addr dst_addr')
-    nf_parser = nf.Parser(version=9)
+@multi.command()
+@click.option('-d', '--directory', required=True, type=click.Path(file_okay=False), help='Where to put files.')
+@click.option('-f', '--format', 'file_format', type=click.Choice(filestore.FORMATS), default='tsv.gz')
+@click.option('-r', '--rotate', default=300, help='Seconds of event time covered by one file.')
+@click.option('--buffer-size', default=10000, help='Records per write batch.')
+@click.option('--flush-interval', default=5, help='Seconds before a partial batch is flushed anyway, 0 to disable.')
+@filter_option
+@event_options
+def file_store(directory, file_format, rotate, buffer_size, flush_interval, record_filter, **event_mode):
+    try:
+        filestore.check_format(file_format)
+    except ImportError as e:
+        raise click.BadParameter('{0} format needs {1}'.format(file_format, e.name), param_hint='--format')
+
+    return functools.partial(FileStoreProtocol, directory, file_format, rotate, buffer_size, flush_interval,
+                             events_mode(**event_mode), record_filter)
+
+
+def replay_capture(protocol, capture, extractor, pacer):
+    """Feeds UDP datagrams of a mapped capture to the protocol, returns how many."""
+    count = 0
+    for timestamp, packet in capture.packets():
+        datagram = extractor.extract(packet)
+        if datagram is None:
+            continue
+        src_addr, src_port, _, payload = datagram
+        if pacer is not None:
+            pacer.wait()
+        protocol.datagram_received(payload, (src_addr, src_port))
+        count += 1
+    return count
+
+
+class Pacer:
+    """Sleeps to keep calls to `wait` at `rate` per second on average."""
+    def __init__(self, rate):
+        self.rate = rate
+        self._started = time.monotonic()
+        self._count = 0
+
+    def wait(self):
+        delay = self._started + self._count / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._count += 1
 
-    counter = 0
-    for link_type, micro_second, link_packet in pcap.get_parser(input).read_packet():
-        # print(link_type, micro_second, len(link_packet))
-        ip4 = ipv4_header(link_packet[14:14+20])
-        udp_data = link_packet[14 + 20 + 8:]  # skip Ethernet (14), IP (20) and UDP (8)
 
-        for pkt_header, fs in nf_parser.parse(udp_data, ip4.src_addr):
-            if hasattr(fs, 'IPV4_SRC_ADDR') and hasattr(fs, 'IPV4_DST_ADDR'):
-                if fs.NAT_EVENT == 1:
-                    pass
+@click.group(chain=True)
+@click.option('-r', '--read', 'captures', multiple=True, required=True, type=click.Path(exists=True, dir_okay=False),
+              help='pcap file to replay, may be repeated.')
+@click.option('-p', '--port', 'ports', multiple=True, type=int, help='Only datagrams to this UDP port, may be repeated.')
+@click.option('--rate', default=0.0, help='Datagrams per second, 0 replays as fast as possible.')
+@click.option('--batch-size', default=50000, help='Records per sink batch, overrides sink --buffer-size.')
+@click.option('--template-store', metavar='<path>', help='SQLite file with NetFlow templates seen by the daemon.')
+@click.option('--template-max-age', default=86400, help='Ignore stored templates not seen for this many seconds.')
+def replay(captures, ports, rate, batch_size, template_store, template_max_age):
+    pass
+
 
-        counter += 1
-        print('pkts: {0}'.format(counter), end='\r')
+replay.add_command(pg_nel_store)
+replay.add_command(file_store)
+replay.add_command(mirror)
+
+
+@replay.resultcallback()
+def replay_captures(factories, captures, ports, rate, batch_size, template_store, template_max_age):
+    setup_logging()
+
+    # sinks expect a loop, it is never run: batches are flushed by size and on close
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    store = None
+    if template_store:
+        store = tplstore.TemplateStore(template_store, max_age=template_max_age)
+
+    protocol = build_protocol(factories, template_store=store)
+    for proto in protocol.protocols:
+        if isinstance(proto, NelProtocol):
+            proto.buffer_size = batch_size
+            proto.flush_interval = 0
+
+    pacer = Pacer(rate) if rate else None
+    started = time.monotonic()
+    for path in captures:
+        try:
+            capture = pcap.PcapFile(path)
+        except pcap.NoDataInInputBuffer:
+            logging.warning('Replay: {0} is empty'.format(path))
+            continue
+        except pcap.UnsupportFileFormat as e:
+            raise click.BadParameter(str(e), param_hint='--read')
+
+        try:
+            extractor = pcap.UdpExtractor(capture.link_type, ports)
+            file_started = time.monotonic()
+            count = replay_capture(protocol, capture, extractor, pacer)
+        except pcap.UnsupportFileFormat as e:
+            raise click.BadParameter('{0}: {1}'.format(path, e), param_hint='--read')
+        finally:
+            capture.close()
+
+        seconds = time.monotonic() - file_started
+        logging.info(
+            'Replay: {0}: {1} datagrams in {2:.1f} seconds ({3:.0f}/s), skipped {not_udp} not UDP, '
+            '{other_port} to other ports, {fragments} fragments, {truncated} truncated of {packets} packets'.format(
+                path, count, seconds, count / seconds if seconds else 0, **extractor.stats))
+
+    protocol.close()
+
+    report_stats(round(time.monotonic() - started), protocol.collect_stats())
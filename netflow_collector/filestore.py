@@ -0,0 +1,307 @@
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from . import metrics
+from . import pgstore
+
+
+WRITTEN_RECORDS = metrics.REGISTRY.counter('nfc_file_records_total', 'Records written to files.')
+WRITTEN_FILES = metrics.REGISTRY.counter('nfc_files_total', 'Files closed and published.')
+
+
+FORMATS = ('tsv.gz', 'tsv.zst', 'parquet')
+
+
+def check_format(file_format):
+    """Raise ImportError if the optional library the format needs is missing."""
+    if file_format == 'tsv.zst':
+        import zstandard  # noqa: F401
+    elif file_format == 'parquet':
+        import pyarrow.parquet  # noqa: F401
+
+
+class TsvWriter:
+    """Compressed tab separated file, header line with column names first.
+
+        Writers count `rows` written and `rejected` ones, rows with a value
+    out of range of its column.
+    """
+    def __init__(self, path, table, file_format):
+        self._raw = open(path, 'wb')
+        if file_format == 'tsv.zst':
+            import zstandard
+            self._out = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            self._out = gzip.GzipFile(fileobj=self._raw, mode='wb')
+        self._encoder = pgstore.TextCopy(table)
+        self._block = ['\t'.join(table.columns).encode() + b'\n']
+        self._block_bytes = 0
+        self.rows = 0
+
+    @property
+    def rejected(self):
+        return self._encoder.rejected
+
+    def write(self, records, block_bytes):
+        rejected = self._encoder.rejected
+        data = self._encoder.encode(records)
+        self.rows += len(records) - (self._encoder.rejected - rejected)
+        self._block.append(data)
+        self._block.append(b'\n')
+        self._block_bytes += len(data) + 1
+        if self._block_bytes >= block_bytes:
+            self._flush()
+
+    def _flush(self):
+        self._out.write(b''.join(self._block))
+        self._block = []
+        self._block_bytes = 0
+
+    def close(self):
+        self._flush()
+        self._out.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+
+
+def _inet_bytes(value):
+    return value.to_bytes(4, 'big') if value.__class__ is int else value
+
+
+def _text(value):
+    return value if value is None else value.decode('utf-8', 'replace')
+
+
+class ParquetWriter:
+    """Parquet file, one row group per block, addresses as 4 or 16 bytes in network order."""
+    def __init__(self, path, table, file_format):
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        types = {'int8': pyarrow.int64(), 'int4': pyarrow.int32(), 'inet': pyarrow.binary(), 'text': pyarrow.string()}
+        self._schema = pyarrow.schema([(column, types[type_]) for column, type_ in zip(table.columns, table.types)])
+        converters = {'inet': _inet_bytes, 'text': _text}
+        self._converters = [converters.get(type_) for type_ in table.types]
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression='zstd')
+        self._rows = []
+        self.rows = 0
+        self.rejected = 0
+
+    def write(self, records, block_bytes):
+        self._rows.extend(records)
+        if len(self._rows) * 32 >= block_bytes:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        rows = self._rows
+        self._rows = []
+        try:
+            table = self._table(rows)
+        except pgstore.ENCODE_ERRORS:
+            # one bad row fails the row group, leave such rows out
+            good = [row for row in rows if self._converts(row)]
+            self.rejected += len(rows) - len(good)
+            if not good:
+                return
+            table = self._table(good)
+        self._writer.write_table(table)
+        self.rows += table.num_rows
+
+    def _table(self, rows):
+        columns = [[convert(value) for value in column] if convert else column
+                   for column, convert in zip(zip(*rows), self._converters)]
+        arrays = [self._pa.array(column, field.type) for column, field in zip(columns, self._schema)]
+        return self._pa.Table.from_arrays(arrays, schema=self._schema)
+
+    def _converts(self, row):
+        try:
+            self._table([row])
+        except pgstore.ENCODE_ERRORS:
+            return False
+        return True
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+class FileSink(threading.Thread):
+    """Writes records of a table to files of `rotate` seconds of event time.
+
+        Batches are handed over through a non-blocking `pgstore.BatchQueue`
+    and written by this thread in `BLOCK_BYTES` blocks. Records go to the
+    file of their event time bucket, so nfc-replay files captures by when
+    the events happened, not when they were replayed. A bucket's file is
+    closed once events two buckets later arrive or after `LATE` seconds
+    (at most `rotate`) without records; a later record of the bucket
+    opens another file. A file is written as `<name>.part` and renamed
+    when closed, then `<name>.manifest.json` describing it (rows, size,
+    sha256, event time range) appears, so whatever ships files to object
+    storage never sees partial ones.
+    """
+    BLOCK_BYTES = 4 << 20
+    LATE = 60
+    WRITERS = {
+        'tsv.gz': TsvWriter,
+        'tsv.zst': TsvWriter,
+        'parquet': ParquetWriter,
+    }
+
+    class File:
+        def __init__(self, path, name, writer):
+            self.path = path
+            self.name = name
+            self.writer = writer
+            self.opened = int(time.time())
+            self.written = time.monotonic()
+            self.first = float('inf')
+            self.last = float('-inf')
+
+    def __init__(self, directory, table, file_format='tsv.gz', rotate=300, queue_batches=64):
+        threading.Thread.__init__(self)
+        self.directory = directory
+        self.table = table
+        self.file_format = file_format
+        self.rotate = rotate
+        self.queue = pgstore.BatchQueue(queue_batches, 256 << 20, table.row_bytes, name='file')
+        self.written = 0
+        self.files = 0
+        self.rejected = 0
+        self._reported = (0, 0, 0, 0)
+        WRITTEN_RECORDS.set_function((), lambda: self.written)
+        WRITTEN_FILES.set_function((), lambda: self.files)
+        self._time_index = table.columns.index(table.time_column)
+        # open files by event time bucket
+        self._files = {}
+        self._latest = None
+        self._closing = False
+        os.makedirs(directory, exist_ok=True)
+        self.setDaemon(True)
+        self.start()
+
+    def add(self, records):
+        self.queue.put(records)
+
+    def run(self):
+        while True:
+            records = self.queue.get(timeout=1)
+            try:
+                if records:
+                    self._write(records)
+                self._close_files()
+            except OSError as e:
+                logging.error('FileSink: write failed, {0} records lost: {1}'.format(len(records or ()), e))
+            except Exception:
+                # whatever it was, the thread must go on rotating files
+                self.rejected += len(records or ())
+                logging.exception('FileSink: dropped batch of {0} records'.format(len(records or ())))
+            finally:
+                if records is not None:
+                    self.queue.task_done()
+
+    def _write(self, records):
+        index = self._time_index
+        rotate = self.rotate
+        times = [rec[index] for rec in records]
+        first = min(times)
+        last = max(times)
+        if first // rotate == last // rotate:
+            self._write_bucket(first // rotate, records, first, last)
+        else:
+            by_bucket = collections.defaultdict(list)
+            for rec, moment in zip(records, times):
+                by_bucket[moment // rotate].append(rec)
+            for bucket, bucket_records in sorted(by_bucket.items()):
+                times = [rec[index] for rec in bucket_records]
+                self._write_bucket(bucket, bucket_records, min(times), max(times))
+        if self._latest is None or last // rotate > self._latest:
+            self._latest = last // rotate
+
+    def _write_bucket(self, bucket, records, first, last):
+        out = self._files.get(bucket)
+        if out is None:
+            out = self._files[bucket] = self._open_file(bucket)
+        out.writer.write(records, self.BLOCK_BYTES)
+        out.written = time.monotonic()
+        out.first = min(out.first, first)
+        out.last = max(out.last, last)
+
+    def _open_file(self, bucket):
+        base = '{0}-{1}-{2}-{3}'.format(
+            self.table.alias, time.strftime('%Y%m%dT%H%M%S', time.gmtime(bucket * self.rotate)),
+            socket.gethostname(), os.getpid())
+        name = '{0}.{1}'.format(base, self.file_format)
+        number = 0
+        while os.path.exists(os.path.join(self.directory, name)):
+            # the bucket was closed before a late record came
+            number += 1
+            name = '{0}-{1}.{2}'.format(base, number, self.file_format)
+        path = os.path.join(self.directory, name)
+        return self.File(path, name, self.WRITERS[self.file_format](path + '.part', self.table, self.file_format))
+
+    def _close_files(self):
+        idle = time.monotonic() - min(self.LATE, self.rotate)
+        for bucket, out in list(self._files.items()):
+            if self._closing or bucket < self._latest - 1 or out.written < idle:
+                del self._files[bucket]
+                self._close_file(out)
+
+    def _close_file(self, out):
+        out.writer.close()
+        os.rename(out.path + '.part', out.path)
+
+        sha256 = hashlib.sha256()
+        with open(out.path, 'rb') as f:
+            for block in iter(lambda: f.read(self.BLOCK_BYTES), b''):
+                sha256.update(block)
+        manifest = {
+            'file': out.name,
+            'format': self.file_format,
+            'columns': list(self.table.columns),
+            'rows': out.writer.rows,
+            'bytes': os.path.getsize(out.path),
+            'sha256': sha256.hexdigest(),
+            'first_event_time': out.first,
+            'last_event_time': out.last,
+            'opened': out.opened,
+            'closed': int(time.time()),
+        }
+        manifest_path = out.path + '.manifest.json'
+        with open(manifest_path + '.part', 'w') as f:
+            json.dump(manifest, f)
+        os.rename(manifest_path + '.part', manifest_path)
+
+        self.written += out.writer.rows
+        self.rejected += out.writer.rejected
+        self.files += 1
+        logging.info('FileSink: {0} closed with {1} records'.format(out.name, out.writer.rows))
+
+    def close(self):
+        """Write everything queued and close the current file."""
+        self.queue.join()
+        self._closing = True
+        self.queue.put([])
+        self.queue.join()
+        self._closing = False
+
+    def pop_stats(self):
+        totals = (self.written, self.files, self.queue.dropped, self.rejected)
+        written, files, dropped, rejected = [total - reported for total, reported in zip(totals, self._reported)]
+        self._reported = totals
+        return {
+            'queue_size': self.queue.qsize(),
+            'written_records': written,
+            'files': files,
+            'dropped_records': dropped,
+            'rejected_records': rejected,
+        }
@@ -0,0 +1,273 @@
+"""Record filters: small expressions over template field names.
+
+    NAT_EVENT in (1, 2) and XLATE_SRC_ADDR_IPV4 in 100.64.0.0/10
+    PROTOCOL == 6 and not L4_DST_PORT in (25, 465, 587)
+    VRF_NAME == "cust-a" or INGRESS_VRFID >= 100
+
+Fields are compared with ==, !=, <, <=, > and >=, or tested with
+`in` / `not in` against a parenthesized list (a single prefix needs no
+parentheses). Values are integers, IPv4 and IPv6 addresses and prefixes
+and quoted strings (matched as UTF-8 bytes), conditions combine with
+`and`, `or`, `not` and parentheses. A field the template lacks is None:
+only `!=` and `not in` match it, `not` before a comparison doesn't make
+it match (`not (...)` negates the whole group as is).
+
+    Filters are compiled once per template (see `nf.Template`): a struct
+projection of just the fields they use and one generated function, so a
+record failing them is never decoded into a tuple. Prefix lists are
+tested with integer masks and shifts, IPv6 addresses as 128-bit ints.
+"""
+import collections
+import ipaddress
+import re
+
+from . import nf
+
+
+class FilterError(ValueError):
+    pass
+
+
+# compiled routes, see `compile_routes`
+Routes = collections.namedtuple('Routes', 'count fields make')
+
+
+TOKENS = re.compile(r'''\s*(?:("[^"]*"|'[^']*')|(==|!=|<=|>=|<|>|\(|\)|,)|([^\s(),=!<>"']+))''')
+COMPARISONS = ('==', '!=', '<', '<=', '>', '>=')
+KEYWORDS = ('and', 'or', 'not', 'in')
+FIELD_NAME = re.compile(r'FIELD_\d+(_\d+)?$')
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKENS.match(text, position)
+        if match is None or match.end() == position:
+            raise FilterError('unexpected {0!r}'.format(text[position:]))
+        tokens.append(next(group for group in match.groups() if group is not None))
+        position = match.end()
+    return tokens
+
+
+def parse_value(token):
+    """Constant of a token: int, IPv4 address as int, IPv6 address as 16 bytes, string as UTF-8 bytes."""
+    if token[0] in '"\'':
+        return token[1:-1].encode()
+    try:
+        return int(token, 0)
+    except ValueError:
+        pass
+    try:
+        addr = ipaddress.ip_address(token)
+    except ValueError:
+        raise FilterError('bad value {0!r}'.format(token))
+    return int(addr) if addr.version == 4 else addr.packed
+
+
+def prefix_matcher(networks):
+    """Function telling whether an address (IPv4 int, IPv6 bytes) is in any of `networks`.
+
+        Networks of one length are a set of their address bits: one shift
+    and a set lookup per distinct length.
+    """
+    by_length = {4: {}, 6: {}}
+    for network in networks:
+        shift = network.max_prefixlen - network.prefixlen
+        by_length[network.version].setdefault(shift, set()).add(int(network.network_address) >> shift)
+    ipv4 = tuple((shift, frozenset(nets)) for shift, nets in sorted(by_length[4].items()))
+    ipv6 = tuple((shift, frozenset(nets)) for shift, nets in sorted(by_length[6].items()))
+
+    def match(value):
+        if value.__class__ is int:
+            shifts = ipv4
+        elif value.__class__ is bytes and len(value) == 16:
+            shifts = ipv6
+            value = int.from_bytes(value, 'big')
+        else:
+            return False
+        for shift, nets in shifts:
+            if value >> shift in nets:
+                return True
+        return False
+    return match
+
+
+class Filter:
+    """Parsed filter expression.
+
+        `fields` are the field names it uses, `source` a Python expression
+    over `v[{fN}]` placeholders (value of fields[N]) and `{cN}` ones
+    (constants[N]), see `compile_routes`.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.fields = []
+        self.constants = []
+        self._tokens = tokenize(text)
+        self._position = 0
+        if not self._tokens:
+            raise FilterError('empty filter')
+        self.source = self._or()
+        if self._position < len(self._tokens):
+            raise FilterError('unexpected {0!r}'.format(self._tokens[self._position]))
+        self.fields = tuple(self.fields)
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise FilterError('unexpected end of filter')
+        self._position += 1
+        return token
+
+    def _expect(self, token):
+        if self._next() != token:
+            raise FilterError('expected {0!r} at {1!r}'.format(token, ' '.join(self._tokens[self._position - 1:])))
+
+    def _or(self):
+        terms = [self._and()]
+        while self._peek() == 'or':
+            self._position += 1
+            terms.append(self._and())
+        return terms[0] if len(terms) == 1 else '(' + ' or '.join(terms) + ')'
+
+    def _and(self):
+        factors = [self._not()]
+        while self._peek() == 'and':
+            self._position += 1
+            factors.append(self._not())
+        return factors[0] if len(factors) == 1 else '(' + ' and '.join(factors) + ')'
+
+    def _not(self):
+        if self._peek() == 'not':
+            self._position += 1
+            if self._peek() == 'not':
+                # double negation cancels, a missing field still fails
+                self._position += 1
+                return self._not()
+            if self._peek() == '(':
+                return '(not ' + self._not() + ')'
+            value, source = self._comparison()
+            return '({0} is not None and not {1})'.format(value, source)
+        if self._peek() == '(':
+            self._position += 1
+            source = self._or()
+            self._expect(')')
+            return source
+        return self._comparison()[1]
+
+    def _field(self):
+        name = self._next()
+        if name in KEYWORDS or (nf.Template.FIELDS.get_by_name(name) is None and not FIELD_NAME.match(name)):
+            raise FilterError('unknown field {0!r}'.format(name))
+        if name not in self.fields:
+            self.fields.append(name)
+        return 'v[{{f{0}}}]'.format(self.fields.index(name))
+
+    def _constant(self, value):
+        self.constants.append(value)
+        return '{{c{0}}}'.format(len(self.constants) - 1)
+
+    def _comparison(self):
+        """(field placeholder, source) of a comparison or membership test."""
+        value = self._field()
+        op = self._next()
+        negate = op == 'not'
+        if negate:
+            op = self._next()
+            if op != 'in':
+                raise FilterError('expected in after not, got {0!r}'.format(op))
+        if op == 'in':
+            source = self._membership(value)
+            return value, '(not ' + source + ')' if negate else source
+        if op not in COMPARISONS:
+            raise FilterError('expected a comparison after the field, got {0!r}'.format(op))
+        token = self._next()
+        if '/' in token and token[0] not in '"\'':
+            raise FilterError('prefix {0} needs in'.format(token))
+        constant = self._constant(parse_value(token))
+        if op in ('==', '!='):
+            return value, '{0} {1} {2}'.format(value, op, constant)
+        # None and values of the other kind (int field, bytes constant) don't compare
+        return value, '({0}.__class__ is {1}.__class__ and {0} {2} {1})'.format(value, constant, op)
+
+    def _membership(self, value):
+        tokens = []
+        if self._peek() == '(':
+            self._position += 1
+            while self._peek() != ')':
+                tokens.append(self._next())
+                if self._peek() == ',':
+                    self._position += 1
+                elif self._peek() != ')':
+                    raise FilterError('expected , or ) in the list, got {0!r}'.format(self._peek()))
+            self._position += 1
+        else:
+            tokens.append(self._next())
+        if not tokens:
+            raise FilterError('empty list')
+
+        values = set()
+        networks = []
+        for token in tokens:
+            if '/' in token and token[0] not in '"\'':
+                try:
+                    networks.append(ipaddress.ip_network(token, strict=False))
+                except ValueError:
+                    raise FilterError('bad prefix {0!r}'.format(token))
+            else:
+                values.add(parse_value(token))
+
+        tests = []
+        if values:
+            tests.append('{0} in {1}'.format(value, self._constant(frozenset(values))))
+        if len(networks) == 1 and networks[0].version == 4:
+            # one IPv4 prefix: a mask inline
+            network = networks[0]
+            tests.append('({0}.__class__ is int and {0} & {1} == {2})'.format(
+                value, self._constant(int(network.netmask)), self._constant(int(network.network_address))))
+        elif networks:
+            tests.append('{0}({1})'.format(self._constant(prefix_matcher(networks)), value))
+        return tests[0] if len(tests) == 1 else '(' + ' or '.join(tests) + ')'
+
+
+def compile_routes(filters):
+    """Routes of `Filter`s or None (everything), for `nf.Parser`.
+
+        `make(decode)`, given the decoder of a `fields` projection, returns
+    match(buffer, offset): whether the record matches, or with several
+    routes a tuple of that per route. Source is generated once here,
+    templates only bind their decoder. Without any filter `make` is None.
+    """
+    filters = tuple(filters)
+    if all(route is None for route in filters):
+        return Routes(len(filters), (), None)
+    fields = []
+    for route in filters:
+        if route is not None:
+            fields.extend(name for name in route.fields if name not in fields)
+
+    namespace = {}
+    tests = []
+    for number, route in enumerate(filters):
+        if route is None:
+            tests.append('True')
+            continue
+        names = {'f{0}'.format(index): fields.index(name) for index, name in enumerate(route.fields)}
+        for index, constant in enumerate(route.constants):
+            names['c{0}'.format(index)] = 'r{0}c{1}'.format(number, index)
+            namespace['r{0}c{1}'.format(number, index)] = constant
+        tests.append(route.source.format(**names))
+    result = tests[0] if len(tests) == 1 else '(' + ', '.join(tests) + ',)'
+
+    source = ('def make(decode):\n'
+              '    def match(buffer, offset):\n'
+              '        v = decode(buffer, offset)\n'
+              '        return {0}\n'
+              '    return match\n').format(result)
+    exec(source, namespace)
+    return Routes(len(filters), tuple(fields), namespace['make'])
@@ -0,0 +1,142 @@
+"""Subscriber lookups: who used a public address and port at a given time.
+
+    `nfc-lookup` answers from whichever table the collector fills:
+log_items (session create events), port_blocks (`--events port-blocks`)
+or sessions (`--events sessions`). Queries are sent in batches, a batch
+is one statement and one round trip: a VALUES list joined laterally to
+one index probe per query, see the composite indexes in the schemas.
+"""
+import datetime
+import ipaddress
+
+import click
+import psycopg2
+import psycopg2.extras
+
+
+COLUMNS = ('addr', 'port', 'time', 'start_time', 'end_time', 'src_addr', 'dst_addr', 'dst_port', 'protocol')
+
+# source: lateral subquery of the matches of query q (addr, port, t), `{window}` bounds the index range scanned
+SOURCES = {
+    # the latest session create for the address and port before the time
+    'log-items': """
+        SELECT event_time AS start_time, NULL::int8 AS end_time, src_addr, dst_addr, dst_port, protocol
+        FROM nfcollect.log_items
+        WHERE xlate_src_addr = q.addr AND xlate_src_port = q.port AND event_time BETWEEN q.t - {window} AND q.t
+        ORDER BY event_time DESC LIMIT 1""",
+    # port blocks held at the time, a block or range holds at most `window` seconds
+    'port-blocks': """
+        SELECT start_time, end_time, src_addr, NULL::inet AS dst_addr, NULL::int4 AS dst_port, NULL::int4 AS protocol
+        FROM nfcollect.port_blocks
+        WHERE xlate_src_addr = q.addr AND end_time BETWEEN q.t AND q.t + {window} AND start_time <= q.t
+            AND q.port BETWEEN port_start AND port_end""",
+    # sessions open at the time
+    'sessions': """
+        SELECT start_time, end_time, src_addr, dst_addr, dst_port, protocol
+        FROM nfcollect.sessions
+        WHERE xlate_src_addr = q.addr AND xlate_src_port = q.port AND end_time BETWEEN q.t AND q.t + {window}
+            AND start_time <= q.t""",
+}
+
+QUERY = """
+    SELECT q.n, host(q.addr), q.port, q.t, r.start_time, r.end_time, host(r.src_addr), host(r.dst_addr), r.dst_port,
+        r.protocol
+    FROM (VALUES %s) AS q (n, addr, port, t)
+    LEFT JOIN LATERAL ({0}) AS r ON true
+    ORDER BY q.n, r.start_time"""
+
+
+def parse_time(value):
+    """Epoch seconds or ISO 8601, UTC unless the offset is given."""
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    moment = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    return int(moment.timestamp())
+
+
+def parse_query(line):
+    """(addr, port, time) of 'addr port time' or 'addr:port time', blanks or commas between."""
+    tokens = line.replace(',', ' ').split()
+    if len(tokens) == 2:
+        addr, _, port = tokens[0].rpartition(':')
+        tokens = [addr.strip('[]'), port, tokens[1]]
+    elif len(tokens) == 4:
+        # ISO date and time apart
+        tokens = tokens[:2] + ['T'.join(tokens[2:])]
+    if len(tokens) != 3:
+        raise ValueError('expected address, port and time')
+    addr, port, moment = tokens
+    return str(ipaddress.ip_address(addr)), int(port), parse_time(moment)
+
+
+def read_queries(lines):
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            yield parse_query(line)
+        except ValueError as e:
+            raise click.BadParameter('line {0}: {1}: {2}'.format(number, line, e))
+
+
+def lookup(cur, source, queries, window):
+    """Rows of COLUMNS for every match, a row of the query alone if nothing matched, in query order."""
+    sql = QUERY.format(SOURCES[source].format(window=int(window)))
+    values = [(n, addr, port, moment) for n, (addr, port, moment) in enumerate(queries)]
+    rows = psycopg2.extras.execute_values(
+        cur, sql, values, template='(%s, %s::inet, %s::int4, %s::int8)', page_size=len(values), fetch=True)
+    return [row[1:] for row in rows]
+
+
+def format_value(value):
+    return '' if value is None else str(value)
+
+
+@click.command()
+@click.option('-h', '--host')
+@click.option('-p', '--port', default='5432')
+@click.option('-u', '--user', required=True)
+@click.option('-w', '--password')
+@click.option('-n', '--database', required=True)
+@click.option('-s', '--source', type=click.Choice(sorted(SOURCES)), default='log-items',
+              help='Table to search: session creates, port blocks or paired sessions.')
+@click.option('-f', '--file', 'query_file', type=click.File('r'),
+              help='Queries, one "address port time" per line, - for stdin.')
+@click.option('--window', default=86400, help='Longest session or port block, seconds searched around the time.')
+@click.option('--batch-size', default=10000, help='Queries per statement.')
+@click.argument('query', nargs=-1)
+def main(host, port, user, password, database, source, query_file, window, batch_size, query):
+    """Who used a public address and port at a time.
+
+        QUERY is ADDRESS PORT TIME or ADDRESS:PORT TIME, TIME in epoch
+    seconds or ISO 8601 (UTC unless given). Prints tab separated matches:
+    the query, session or block start and end, inside address and the
+    destination when the table has it. Unanswered queries are printed
+    with empty fields.
+    """
+    if query_file is not None:
+        queries = list(read_queries(query_file))
+    elif query:
+        queries = list(read_queries([' '.join(query)]))
+    else:
+        raise click.UsageError('give a query or --file')
+
+    conn = psycopg2.connect(database=database, user=user, password=password, host=host, port=port)
+    try:
+        with conn.cursor() as cur:
+            click.echo('\t'.join(COLUMNS))
+            for start in range(0, len(queries), batch_size):
+                for row in lookup(cur, source, queries[start:start + batch_size], window):
+                    click.echo('\t'.join(format_value(value) for value in row))
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
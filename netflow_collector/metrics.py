@@ -0,0 +1,194 @@
+import asyncio
+import bisect
+import logging
+import os
+import threading
+
+
+class Metric:
+    """Named metric with label values as plain tuples.
+
+        Values are either updated in place (`Counter.inc`, `Histogram.observe`)
+    or read at scrape time from functions given to `set_function`, which
+    suits objects already keeping their own monotonic totals.
+    """
+    TYPE = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def set_function(self, labels, function):
+        """Value for `labels` is `function()` at scrape time."""
+        self._functions[tuple(labels)] = function
+
+    def samples(self):
+        """Yields (name suffix, labels, value)."""
+        for labels, value in list(self.values.items()):
+            yield '', labels, value
+        for labels, function in list(self._functions.items()):
+            try:
+                value = function()
+            except Exception as e:
+                logging.error('metrics: failed to collect {0}: {1}'.format(self.name, e))
+                continue
+            if value is not None:
+                yield '', labels, value
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, labels=(), value=1):
+        """Lock-free, meant for the event loop thread, other threads use `add`."""
+        values = self.values
+        values[labels] = values.get(labels, 0) + value
+
+    def add(self, labels=(), value=1):
+        with self._lock:
+            self.inc(labels, value)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Bucket counts kept per label values as [bucket..., +Inf, sum]."""
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, buckets, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [0] * (len(self.buckets) + 1) + [0]
+            state[bisect.bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def samples(self):
+        for labels, state in list(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state):
+                total += count
+                yield '_bucket', labels + (('le', bound),), total
+            yield '_count', labels, total
+            yield '_sum', labels, state[-1]
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, cls, name, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args)
+        elif not isinstance(metric, cls):
+            raise ValueError('metric {0} is already registered as {1}'.format(name, metric.TYPE))
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, buckets, labelnames=()):
+        return self._register(Histogram, name, help, buckets, labelnames)
+
+    def render(self):
+        """Prometheus text exposition format 0.0.4."""
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append('# HELP {0} {1}'.format(name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(name, metric.TYPE))
+            for suffix, labels, value in metric.samples():
+                pairs = list(zip(metric.labelnames, labels[:len(metric.labelnames)])) + list(labels[len(metric.labelnames):])
+                if pairs:
+                    label_str = '{' + ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+                else:
+                    label_str = ''
+                lines.append('{0}{1}{2} {3}'.format(name, suffix, label_str, value))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """Serves GET /metrics of a registry over HTTP on the asyncio loop."""
+    TIMEOUT = 10
+
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+
+    def start(self, loop, host, port):
+        server = loop.run_until_complete(asyncio.start_server(self._handle, host, port))
+        logging.info('MetricsServer: listening on {0}:{1}'.format(host, port))
+        return server
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.TIMEOUT)
+            method, path = request.split(b' ', 2)[:2]
+            if method != b'GET':
+                status, body = '405 Method Not Allowed', b''
+            elif path.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b''
+            writer.write('HTTP/1.0 {0}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {1}\r\n'
+                         'Connection: close\r\n\r\n'.format(status, len(body)).encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def udp_drops(sock):
+    """Datagrams the kernel dropped on a socket's full receive buffer.
+
+        asyncio receives with recvfrom, which can't ask for SO_RXQ_OVFL,
+    so the per-socket drops column of /proc/net/udp is read instead.
+    `receiver.BatchReceiver` gets the count with the datagrams.
+    """
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for name in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(name) as f:
+                next(f)
+                for line in f:
+                    columns = line.split()
+                    if columns[9] == inode:
+                        return int(columns[-1])
+        except OSError:
+            pass
+    return None
+
+
+SOCKET_DROPS = REGISTRY.counter('nfc_socket_drops_total', 'Datagrams dropped by the kernel, receive buffer full.')
+
+
+def track_socket(sock, listener=None):
+    def drops():
+        value = getattr(listener, 'drops', None)
+        return value if value is not None else udp_drops(sock)
+    SOCKET_DROPS.set_function((), drops)
@@ -0,0 +1,251 @@
+"""NAT event modes: how a sink turns NEL records into rows of its table.
+
+    A mode is created by `NelProtocol` with the callback taking rows and
+replaces its record handling. Time is taken from the events, so replayed
+captures are handled like live traffic.
+"""
+import itertools
+
+from . import pgstore
+
+# natEvent values (IANA IPFIX registry)
+SESSION_CREATE = 1
+SESSION_DELETE = 2
+BLOCK_ALLOCATE = 13
+BLOCK_RELEASE = 14
+
+
+class PortBlocks:
+    """Port block allocation (PBA) events paired into intervals.
+
+        An allocate (natEvent 13) opens a block of a public address, its
+    release (14) closes it and makes a `pgstore.PORT_BLOCK_TABLE` row. A
+    release without its allocate, e.g. after a restart, gets start_time
+    0. Blocks still open at `close` are written with end_time of the last
+    event seen: the block was held at least until then.
+
+        With `aggregate` seconds per-session create events (natEvent 1)
+    are folded into the same rows: ports an inside address got on a
+    public address within the window make one port range. Unlike port
+    blocks, ranges of hosts sharing a public address may overlap, lookups
+    then return every candidate. At most `max_ranges` windows are open,
+    the oldest are written early beyond that.
+    """
+    FIELDS = ('NAT_EVENT', 'EVENT_TIME_MSEC', ('IPV4_SRC_ADDR', 'IPV6_SRC_ADDR'),
+              ('XLATE_SRC_ADDR_IPV4', 'XLATE_SRC_ADDR_IPV6'), 'XLATE_PORT_BLOCK_START', 'XLATE_PORT_BLOCK_END',
+              'XLATE_PORT_BLOCK_SIZE', 'XLATE_SRC_PORT')
+    REQUIRED = FIELDS[:4]
+    TABLE = pgstore.PORT_BLOCK_TABLE
+    STATS_FORMAT = ('port blocks: open {open_blocks} closed {closed_blocks} unmatched releases {unmatched_releases}, '
+                    'session ranges: open {open_ranges} written {ranges} of {sessions} sessions')
+    STATS = ('closed_blocks', 'unmatched_releases', 'ranges', 'sessions')
+
+    def __init__(self, emit, aggregate=0, max_ranges=1 << 20):
+        self.emit = emit
+        self.aggregate = aggregate * 1000
+        self.max_ranges = max_ranges
+        self.stats = dict.fromkeys(self.STATS, 0)
+        # (xlate addr, block start) -> (allocated msec, inside addr, block end)
+        self._blocks = {}
+        # (inside addr, xlate addr) -> [first msec, last msec, port min, port max], oldest first
+        self._ranges = {}
+        self._last = 0
+        self._expire_at = 0
+
+    @staticmethod
+    def _block_end(start, end, size):
+        if end:
+            return end
+        if size:
+            return start + size - 1
+        return start
+
+    def handle(self, addr, header, fs):
+        nat_event, time_msec, src_addr, xlate_addr, block_start, block_end, block_size, xlate_port = fs
+        if time_msec > self._last:
+            self._last = time_msec
+
+        if nat_event == SESSION_CREATE:
+            if self.aggregate and xlate_port is not None:
+                self._add_session(time_msec, src_addr, xlate_addr, xlate_port)
+        elif block_start is None:
+            # template without PBA fields
+            return
+        elif nat_event == BLOCK_ALLOCATE:
+            self._blocks[(xlate_addr, block_start)] = (
+                time_msec, src_addr, self._block_end(block_start, block_end, block_size))
+        elif nat_event == BLOCK_RELEASE:
+            allocated = self._blocks.pop((xlate_addr, block_start), None)
+            if allocated is None:
+                self.stats['unmatched_releases'] += 1
+                allocated = (0, src_addr, self._block_end(block_start, block_end, block_size))
+            started, src_addr, block_end = allocated
+            self.stats['closed_blocks'] += 1
+            self.emit((started // 1000, time_msec // 1000, src_addr, xlate_addr, block_start, block_end))
+
+    def _add_session(self, time_msec, src_addr, xlate_addr, xlate_port):
+        self.stats['sessions'] += 1
+        key = (src_addr, xlate_addr)
+        window = self._ranges.get(key)
+        if window is not None and time_msec - window[0] >= self.aggregate:
+            # expire runs only a few times per window
+            self._write_range(key)
+            window = None
+        if window is None:
+            self._ranges[key] = [time_msec, time_msec, xlate_port, xlate_port]
+            if len(self._ranges) > self.max_ranges:
+                self._write_range(next(iter(self._ranges)))
+        else:
+            if time_msec > window[1]:
+                window[1] = time_msec
+            if xlate_port < window[2]:
+                window[2] = xlate_port
+            elif xlate_port > window[3]:
+                window[3] = xlate_port
+        if time_msec >= self._expire_at:
+            self.expire(time_msec)
+
+    def _write_range(self, key):
+        first, last, port_min, port_max = self._ranges.pop(key)
+        self.stats['ranges'] += 1
+        self.emit((first // 1000, last // 1000, key[0], key[1], port_min, port_max))
+
+    def expire(self, now_msec):
+        """Write session ranges whose window ended by `now_msec`."""
+        ranges = self._ranges
+        deadline = now_msec - self.aggregate
+        while ranges:
+            key = next(iter(ranges))
+            if ranges[key][0] > deadline:
+                break
+            self._write_range(key)
+        # windows open in event order, checking a few times per window is enough
+        self._expire_at = now_msec + self.aggregate // 4
+
+    def close(self):
+        while self._ranges:
+            self._write_range(next(iter(self._ranges)))
+        for (xlate_addr, block_start), (started, src_addr, block_end) in self._blocks.items():
+            self.emit((started // 1000, self._last // 1000, src_addr, xlate_addr, block_start, block_end))
+        self._blocks = {}
+
+    def pop_stats(self):
+        stats = dict(self.stats, open_blocks=len(self._blocks), open_ranges=len(self._ranges))
+        for key in self.STATS:
+            self.stats[key] = 0
+        return stats
+
+
+def _pack_addr(value):
+    """IPv4 int as is, IPv6 bytes as an int above 2 ** 128."""
+    return value if value.__class__ is int else int.from_bytes(value, 'big') | 1 << 128
+
+
+def _unpack_addr(value):
+    return value if value < 1 << 128 else (value & ((1 << 128) - 1)).to_bytes(16, 'big')
+
+
+class Sessions:
+    """Session create and delete events (natEvent 1, 2) paired into one row.
+
+        Open sessions are kept by translation 5-tuple (public address and
+    port, destination address and port, protocol) packed into an int,
+    the inside address and create time into another: about 130 bytes an
+    IPv4 session. With IPv6 addresses (NAT64) the key is a tuple. A delete
+    closes its session into a `pgstore.SESSION_TABLE` row with deleted 1;
+    a delete without its create gets start_time 0. Sessions without a
+    delete are written with deleted 0 and end_time of when they were given
+    up: `timeout` seconds after the create, when more than `max_sessions`
+    are open (oldest first) or at `close`.
+    """
+    FIELDS = ('NAT_EVENT', 'EVENT_TIME_MSEC', ('IPV4_SRC_ADDR', 'IPV6_SRC_ADDR'), ('IPV4_DST_ADDR', 'IPV6_DST_ADDR'),
+              'L4_DST_PORT', ('XLATE_SRC_ADDR_IPV4', 'XLATE_SRC_ADDR_IPV6'), 'XLATE_SRC_PORT', 'PROTOCOL')
+    REQUIRED = FIELDS
+    TABLE = pgstore.SESSION_TABLE
+    STATS_FORMAT = ('sessions: open {open_sessions} paired {paired} unmatched deletes {unmatched_deletes} '
+                    'timed out {timed_out} evicted {evicted}')
+    STATS = ('paired', 'unmatched_deletes', 'timed_out', 'evicted')
+    # create msec in the low bits of a value
+    TIME_MASK = (1 << 48) - 1
+
+    def __init__(self, emit, timeout=86400, max_sessions=1 << 22):
+        self.emit = emit
+        self.timeout = timeout * 1000
+        self.max_sessions = max_sessions
+        self.stats = dict.fromkeys(self.STATS, 0)
+        # key -> inside addr << 48 | created msec, in create order
+        self._open = {}
+        self._last = 0
+        self._expire_at = 0
+
+    @staticmethod
+    def _key(dst_addr, dst_port, xlate_addr, xlate_port, protocol):
+        if dst_addr.__class__ is int and xlate_addr.__class__ is int:
+            return xlate_addr << 72 | xlate_port << 56 | dst_addr << 24 | dst_port << 8 | protocol
+        return xlate_addr, xlate_port, dst_addr, dst_port, protocol
+
+    def _row(self, key, value, end_msec, deleted):
+        if key.__class__ is tuple:
+            xlate_addr, xlate_port, dst_addr, dst_port, protocol = key
+        else:
+            xlate_addr, xlate_port, dst_addr, dst_port, protocol = \
+                key >> 72, key >> 56 & 0xffff, key >> 24 & 0xffffffff, key >> 8 & 0xffff, key & 0xff
+        return ((value & self.TIME_MASK) // 1000, end_msec // 1000, _unpack_addr(value >> 48), dst_addr, dst_port,
+                xlate_addr, xlate_port, protocol, deleted)
+
+    def handle(self, addr, header, fs):
+        nat_event, time_msec, src_addr, dst_addr, dst_port, xlate_addr, xlate_port, protocol = fs
+        if time_msec > self._last:
+            self._last = time_msec
+        if time_msec >= self._expire_at:
+            self.expire(time_msec)
+
+        if nat_event == SESSION_CREATE:
+            key = self._key(dst_addr, dst_port, xlate_addr, xlate_port, protocol)
+            sessions = self._open
+            previous = sessions.pop(key, None)
+            if previous is not None:
+                # the delete got lost, the tuple is reused
+                self.emit(self._row(key, previous, time_msec, 0))
+            sessions[key] = _pack_addr(src_addr) << 48 | time_msec
+            if len(sessions) > self.max_sessions:
+                self.stats['evicted'] += 1
+                key = next(iter(sessions))
+                self.emit(self._row(key, sessions.pop(key), self._last, 0))
+        elif nat_event == SESSION_DELETE:
+            key = self._key(dst_addr, dst_port, xlate_addr, xlate_port, protocol)
+            value = self._open.pop(key, None)
+            if value is None:
+                self.stats['unmatched_deletes'] += 1
+                value = _pack_addr(src_addr) << 48
+            else:
+                self.stats['paired'] += 1
+            self.emit(self._row(key, value, time_msec, 1))
+
+    def expire(self, now_msec):
+        """Give up sessions created `timeout` before `now_msec`."""
+        deadline = now_msec - self.timeout
+        mask = self.TIME_MASK
+        expired = list(itertools.takewhile(lambda item: item[1] & mask <= deadline, self._open.items()))
+        for key, value in expired:
+            del self._open[key]
+            self.emit(self._row(key, value, (value & mask) + self.timeout, 0))
+        self.stats['timed_out'] += len(expired)
+        self._expire_at = now_msec + min(self.timeout // 8, 60000)
+
+    def close(self):
+        for key, value in self._open.items():
+            self.emit(self._row(key, value, self._last, 0))
+        self._open = {}
+
+    def pop_stats(self):
+        stats = dict(self.stats, open_sessions=len(self._open))
+        for key in self.STATS:
+            self.stats[key] = 0
+        return stats
+
+
+MODES = {
+    'port-blocks': PortBlocks,
+    'sessions': Sessions,
+}
@@ -1,4 +1,14 @@
 import collections
+import operator
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import metrics
 from . import util
 
 
@@ -6,6 +16,20 @@ PacketHeader = util.structuple('NfHeader', '!HHIIII', 'version count sysUpTime u
 FlowSetHeader = util.structuple('NfFlowSetHeader', '!HH', 'flowSetId length')
 FlowSetTplHeader = util.structuple('NfFlowSetTplHeader', '!HH', 'templateId fieldCount')
 FlowSetTplRecord = util.structuple('NfFlowSetTplRecord', '!HH', 'fieldType fieldLength')
+# IPFIX (RFC 7011) message header, fields named after their v9 counterparts
+IpfixHeader = util.structuple('IpfixHeader', '!HHIII', 'version length unixSecs seqNumber srcId')
+IpfixOptionsTplHeader = util.structuple('IpfixOptionsTplHeader', '!HHH', 'templateId fieldCount scopeFieldCount')
+# v9 options template, scope and option lengths in bytes
+FlowSetOptionsTplHeader = util.structuple('NfFlowSetOptionsTplHeader', '!HHH', 'templateId scopeLength optionLength')
+EnterpriseNumber = struct.Struct('!L')
+
+VERSIONS = (9, 10)
+# IPFIX field length of variable-length fields, the length is then given per record
+VARIABLE_LENGTH = 65535
+# IPFIX field type bit announcing an enterprise number, such elements are kept as enterprise << 16 | element ID
+ENTERPRISE_BIT = 0x8000
+# v9 options scope types (system, interface, line card, cache, template) as the IPFIX elements they stand for
+V9_SCOPES = {1: 144, 2: 10, 3: 141, 4: 143, 5: 145}
 
 
 def u_int(length):
@@ -18,7 +42,8 @@ def u_int(length):
     elif length == 8:
         return 'Q'
     else:
-        return byte_a(length)
+        # IPv6 addresses, MACs and the like stay one bytes value
+        return '{0}s'.format(length)
 
 
 def byte_a(length):
@@ -135,6 +160,17 @@ class FieldTypeTable:
             (362, 2, u_int, 'XLATE_PORT_BLOCK_END'),
             (363, 2, u_int, 'XLATE_PORT_BLOCK_STEP'),
             (364, 2, u_int, 'XLATE_PORT_BLOCK_SIZE'),
+            (283, 4, u_int, 'NAT_POOL_ID'),
+            (284, 0, byte_a, 'NAT_POOL_NAME'),
+            # options scopes and metadata
+            (141, 4, u_int, 'LINE_CARD_ID'),
+            (143, 4, u_int, 'METERING_PROCESS_ID'),
+            (144, 4, u_int, 'EXPORTING_PROCESS_ID'),
+            (145, 2, u_int, 'TEMPLATE_ID'),
+            (149, 4, u_int, 'OBSERVATION_DOMAIN_ID'),
+            (236, 32, byte_a, 'VRF_NAME'),
+            (302, 4, u_int, 'SELECTOR_ID'),
+            (305, 4, u_int, 'SAMPLING_PACKET_INTERVAL'),
         ]
         self._lookup_id = {}
         self._lookup_name = {}
@@ -144,106 +180,976 @@ class FieldTypeTable:
             self._lookup_name[item[3]] = item
 
     def get(self, fieldType):
-        return self._lookup_id.get(fieldType, (fieldType, 0, u_int, 'FIELD_{0}'.format(fieldType)))
+        item = self._lookup_id.get(fieldType)
+        if item is not None:
+            return item
+        if fieldType > 0xffff:
+            # enterprise-specific element
+            return fieldType, 0, u_int, 'FIELD_{0}_{1}'.format(fieldType >> 16, fieldType & 0xffff)
+        return fieldType, 0, u_int, 'FIELD_{0}'.format(fieldType)
 
     def get_by_name(self, name):
         return self._lookup_name.get(name)
 
 
-class TemplateMatcher:
-    FIELDS = FieldTypeTable()
+def projection_format(fmtr, length):
+    """Struct format for a projected field: always exactly one value."""
+    fmt = fmtr(length)
+    if len(fmt) == 1 or fmt.endswith('s'):
+        return fmt
+    return '{0}s'.format(length)
+
+
+def dtype_format(fmtr, length):
+    """NumPy big-endian dtype for a projected field."""
+    if fmtr is u_int and length in (1, 2, 4, 8):
+        return '>u{0}'.format(length)
+    return 'V{0}'.format(length)
+
+
+EXPORTER_LABELS = ('parser', 'exporter', 'source_id', 'template')
+FLOWSETS = metrics.REGISTRY.counter('nfc_flowsets_total', 'Data flowsets decoded.', EXPORTER_LABELS)
+RECORDS = metrics.REGISTRY.counter('nfc_records_total', 'Data records decoded.', EXPORTER_LABELS)
+TEMPLATE_MISSES = metrics.REGISTRY.counter(
+    'nfc_template_misses_total', 'Data flowsets that arrived before their template.', EXPORTER_LABELS)
+
+SEQUENCE_LABELS = ('parser', 'exporter', 'source_id')
+PACKETS_LOST = metrics.REGISTRY.counter(
+    'nfc_packets_lost_total', 'Export packets missing from the sequence.', SEQUENCE_LABELS)
+PACKETS_DUPLICATE = metrics.REGISTRY.counter(
+    'nfc_packets_duplicate_total', 'Export packets received twice.', SEQUENCE_LABELS)
+PACKETS_REORDERED = metrics.REGISTRY.counter(
+    'nfc_packets_reordered_total', 'Export packets received after a later one.', SEQUENCE_LABELS)
+SEQUENCE_RESETS = metrics.REGISTRY.counter(
+    'nfc_sequence_resets_total', 'Sequence jumps treated as an exporter restart.', SEQUENCE_LABELS)
+
+
+FlowSetBatch = collections.namedtuple('FlowSetBatch', 'header template count columns')
+
+
+class ExporterMetadata:
+    """What options records of one exporter (address, source ID) told about it.
+
+        Sampling intervals by sampler ID (None for the exporter-wide one),
+    interface names by ifIndex and VRF names by VRF ID, names as valid
+    UTF-8 bytes without NUL padding (see `name`). The dicts are updated in
+    place as options arrive: compiled templates hold them to enrich
+    records (see `ENRICHED`).
+    """
+    # options template projection
+    FIELDS = (('FLOW_SAMPLER_ID', 'SELECTOR_ID'),
+              ('SAMPLING_INTERVAL', 'FLOW_SAMPLER_RANDOM_INTERVAL', 'SAMPLING_PACKET_INTERVAL'),
+              'INPUT_SNMP', ('IF_NAME', 'IF_DESC'), 'INGRESS_VRFID', 'VRF_NAME')
+    # dicts with a value under None, used when a template lacks the key field
+    EXPORTER_WIDE = ('samplers',)
+    # dicts of names, the same fields found in data templates are cleaned up by `name`
+    NAMES = ('interfaces', 'vrfs')
+    MAX_NAMES = 4096
 
     def __init__(self):
-        self._dyn_templates = collections.defaultdict(dict)
-        self._static_templates = {}
+        self.samplers = {}
+        self.interfaces = {}
+        self.vrfs = {}
+        self._names = {}
+
+    def name(self, value):
+        """Name as exported (NUL terminated or padded, any bytes) as valid UTF-8, memoized."""
+        if value is None:
+            return None
+        name = self._names.get(value)
+        if name is None:
+            if len(self._names) >= self.MAX_NAMES:
+                self._names.clear()
+            name = self._names[value] = value.split(b'\x00', 1)[0].decode('utf-8', 'replace').encode()
+        return name
+
+    def update(self, records):
+        for sampler_id, interval, if_index, if_name, vrf_id, vrf_name in records:
+            if interval is not None:
+                self.samplers[sampler_id] = interval
+            if if_index is not None and if_name is not None:
+                self.interfaces[if_index] = self.name(if_name)
+            if vrf_id is not None and vrf_name is not None:
+                self.vrfs[vrf_id] = self.name(vrf_name)
+
+
+# fields filled from ExporterMetadata when a template lacks them: (key field, metadata dict)
+ENRICHED = {
+    'SAMPLING_INTERVAL': (('FLOW_SAMPLER_ID', 'SELECTOR_ID'), 'samplers'),
+    'IF_NAME': ('INPUT_SNMP', 'interfaces'),
+    'VRF_NAME': ('INGRESS_VRFID', 'vrfs'),
+}
+
+
+class Template:
+    """Compiled data template.
+
+        Without `fields` records are decoded into a structuple with every
+    template field. With `fields` the template is compiled once into a
+    projection: unused fields are skipped with pad bytes and records are
+    plain tuples in `fields` order (None for fields absent from template).
+    A tuple of names in `fields` takes the first of them the template has,
+    e.g. ('IPV4_SRC_ADDR', 'IPV6_SRC_ADDR'). Templates missing any of
+    `required` fields are marked with `skip`, so are options templates
+    (`scope` fields), their records describe the exporter, not flows.
+    Given the exporter's `metadata`, `ENRICHED` fields the template lacks
+    are looked up by their key field as records are decoded. With
+    `routes` (`filters.Routes`) `match(buffer, offset)` tells which routes
+    the record at offset goes to, from a projection of the filter fields
+    only; it is None without filters.
+
+        Templates with variable-length fields (IPFIX) can't be a struct:
+    they are `variable` and decoded field by field with a cursor, `size`
+    is then the shortest record.
+    """
+    FIELDS = FieldTypeTable()
+
+    def __init__(self, template_id, records, fields=None, required=(), scope=0, metadata=None, routes=None):
+        self.template_id = template_id
+        self.records = tuple((fieldType, fieldLength) for fieldType, fieldLength in records)
+        self.names = [self.FIELDS.get(fieldType)[3] for fieldType, _ in self.records]
+        self.scope = scope
+        self.variable = any(fieldLength == VARIABLE_LENGTH for _, fieldLength in self.records)
+        self.missing = ()
+        self.skip = False
+        self._batch = None
+        self._enrich = ()
+        if fields is not None and metadata is not None:
+            fields = self._enrichment(fields, metadata)
+        self.fields = fields
+
+        if self.variable:
+            self._compile_variable(fields, required)
+        elif fields is None:
+            self._compile_full()
+        else:
+            self._compile_projection(fields, required)
+        if self._enrich:
+            if self.variable:
+                self._record = self._enriched(self._record)
+            else:
+                self.decode = self._compile_enriched()
+        if scope:
+            self.skip = True
+
+        self.match = None
+        if routes is not None and routes.make is not None and not scope:
+            self.match = routes.make(Template(template_id, records, routes.fields, metadata=metadata).decode)
+
+    def _enrichment(self, fields, metadata):
+        """Swap `ENRICHED` fields the template lacks for their key fields, remember how to look them up."""
+        names = set(self.names)
+        fields = list(fields)
+        enrich = []
+        for index, name in enumerate(fields):
+            if name not in ENRICHED:
+                continue
+            key, table = ENRICHED[name]
+            if name in names:
+                if table in metadata.NAMES:
+                    enrich.append((index, index, metadata.name))
+                continue
+            if table not in metadata.EXPORTER_WIDE and names.isdisjoint(key if isinstance(key, tuple) else (key,)):
+                continue
+            get = getattr(metadata, table).get
+            if key in fields:
+                enrich.append((index, fields.index(key), get))
+            else:
+                fields[index] = key
+                enrich.append((index, index, get))
+        self._enrich = tuple(enrich)
+        return tuple(fields)
 
-    def update_teplate(self, addr, template_id, records):
+    def _compile_enriched(self):
+        """Projection decoder doing the lookups, its source is built once per template."""
+        st, positions, _ = self._batch
+        values = ['v[{0}]'.format(positions[name]) if name in positions else 'None' for name in self.fields]
+        items = list(values)
+        namespace = {'unpack_from': st.unpack_from}
+        for index, key, get in self._enrich:
+            namespace['get{0}'.format(index)] = get
+            items[index] = 'get{0}({1})'.format(index, values[key])
+        source = 'def decode(buffer, offset=0):\n    v = unpack_from(buffer, offset)\n    return ({0},)\n'
+        exec(source.format(', '.join(items)), namespace)
+        return namespace['decode']
+
+    def _enriched(self, record):
+        enrich = self._enrich
+
+        def enriched(values):
+            values = list(record(values))
+            for index, key, get in enrich:
+                values[index] = get(values[key])
+            return tuple(values)
+        return enriched
+
+    def _selection(self, fields):
+        """Entry of `fields` decoded from each template field, None for skipped fields."""
+        wanted = {}
+        for entry in fields:
+            if isinstance(entry, tuple):
+                for rank, name in enumerate(entry):
+                    wanted.setdefault(name, (entry, rank))
+            else:
+                wanted.setdefault(entry, (entry, 0))
+        # for alternatives the first one the template has wins, wherever it is
+        chosen = {}
+        for name in self.names:
+            if name in wanted:
+                entry, rank = wanted[name]
+                if entry not in chosen or rank < chosen[entry]:
+                    chosen[entry] = rank
+
+        selection = []
+        taken = set()
+        for name in self.names:
+            entry, rank = wanted.get(name, (None, None))
+            if entry is not None and chosen[entry] == rank and entry not in taken:
+                taken.add(entry)
+                selection.append(entry)
+            else:
+                selection.append(None)
+        return selection
+
+    def _layout(self, fields):
+        """Projection of `fields` onto the template: (struct, positions, dtype spec).
+
+            Positions map entries of `fields` to their value index, the
+        dtype spec names the fields actually found.
+        """
         fmt_list = ['!']
-        names = []
-        for record in records:
-            fieldType, _, fmtr, name = self.FIELDS.get(record.fieldType)
-            names.append(name)
-            fmt_list.append(fmtr(record.fieldLength))
+        positions = {}
+        dt_spec = {'names': [], 'formats': [], 'offsets': [], 'itemsize': 0}
+        pad = 0
+        offset = 0
+        for (fieldType, fieldLength), name, entry in zip(self.records, self.names, self._selection(fields)):
+            if entry is not None:
+                if pad:
+                    fmt_list.append('{0}x'.format(pad))
+                    pad = 0
+                fmtr = self.FIELDS.get(fieldType)[2]
+                positions[entry] = len(positions)
+                fmt_list.append(projection_format(fmtr, fieldLength))
+                dt_spec['names'].append(name)
+                dt_spec['formats'].append(dtype_format(fmtr, fieldLength))
+                dt_spec['offsets'].append(offset)
+            else:
+                pad += fieldLength
+            offset += fieldLength
+        if pad:
+            fmt_list.append('{0}x'.format(pad))
+        dt_spec['itemsize'] = offset
 
-        nf_template = util.structuple('Template_{0}'.format(template_id), ''.join(fmt_list), names)
-        self._dyn_templates[addr][template_id] = nf_template
+        return struct.Struct(''.join(fmt_list)), positions, dt_spec
 
-    def add_static_template(self, field_names):
+    def _compile_full(self):
         fmt_list = ['!']
-        for name in field_names:
-            field_len = 0
-            try:
-                name, field_len = name.split(':')
-            except ValueError:
-                pass
-            fieldType, default_len, fmtr, _ = self.FIELDS.get_by_name(name)
-            field_len = field_len or default_len
-            fmt_list.append(fmtr(field_len))
-        template = util.structuple('Template_dynamic', ''.join(fmt_list), field_names)
-        self._static_templates[template.size + FlowSetHeader.size] = template
-        # print('template: %d %s' % (template.size + FlowSetHeader.size, template.format))
-
-    def match(self, addr, template_id):
-        if addr in self._dyn_templates and template_id in self._dyn_templates[addr]:
-            return self._dyn_templates[addr][template_id]
+        for fieldType, fieldLength in self.records:
+            fmt_list.append(projection_format(self.FIELDS.get(fieldType)[2], fieldLength))
+
+        st = util.structuple('Template_{0}'.format(self.template_id), ''.join(fmt_list), self.names)
+        self.size = st.size
+        self.format = st.format
+        self.decode = st
+
+    def _compile_projection(self, fields, required):
+        st, positions, dt_spec = self._layout(fields)
+        self.size = st.size
+        self.format = st.format
+        self.missing = tuple(name for name in fields if name not in positions)
+        self.skip = any(name not in positions for name in required)
+        self._batch = (st, positions, dt_spec)
+
+        order = [positions.get(name, len(positions)) for name in fields]
+        unpack_from = st.unpack_from
+        if order == list(range(len(positions))):
+            self.decode = unpack_from
+        elif order[:len(positions)] == list(range(len(positions))):
+            # only optional fields at the end are absent
+            nones = (None,) * len(self.missing)
+            self.decode = lambda buffer, offset=0: unpack_from(buffer, offset) + nones
+        elif len(order) == 1:
+            index = order[0]
+            if self.missing:
+                self.decode = lambda buffer, offset=0: (None,)
+            else:
+                self.decode = lambda buffer, offset=0: (unpack_from(buffer, offset)[index],)
+        elif self.missing:
+            getter = operator.itemgetter(*order)
+            self.decode = lambda buffer, offset=0: getter(unpack_from(buffer, offset) + (None,))
+        else:
+            getter = operator.itemgetter(*order)
+            self.decode = lambda buffer, offset=0: getter(unpack_from(buffer, offset))
+
+    def _compile_variable(self, fields, required):
+        """Cursor decoder: runs of fixed-size fields are still one struct each."""
+        if fields is None:
+            selection = list(range(len(self.records)))
+        else:
+            selection = self._selection(fields)
+
+        # [(struct, None) for fixed runs, (None, wanted) for variable-length fields]
+        steps = []
+        fmt_list = ['!']
+        positions = {}
+        pad = 0
+        size = 0
+        for (fieldType, fieldLength), entry in zip(self.records, selection):
+            if fieldLength == VARIABLE_LENGTH:
+                if pad:
+                    fmt_list.append('{0}x'.format(pad))
+                    pad = 0
+                if len(fmt_list) > 1:
+                    steps.append((struct.Struct(''.join(fmt_list)), None))
+                    fmt_list = ['!']
+                steps.append((None, entry is not None))
+                size += 1
+            elif entry is not None:
+                if pad:
+                    fmt_list.append('{0}x'.format(pad))
+                    pad = 0
+                fmt_list.append(projection_format(self.FIELDS.get(fieldType)[2], fieldLength))
+                size += fieldLength
+            else:
+                pad += fieldLength
+                size += fieldLength
+            if entry is not None:
+                positions[entry] = len(positions)
+        if pad:
+            fmt_list.append('{0}x'.format(pad))
+        if len(fmt_list) > 1:
+            steps.append((struct.Struct(''.join(fmt_list)), None))
+        self.size = size
+        self.format = None
+        self._steps = steps
+
+        if fields is None:
+            self._record = collections.namedtuple('Template_{0}'.format(self.template_id), self.names)._make
+        else:
+            self.missing = tuple(name for name in fields if name not in positions)
+            self.skip = any(name not in positions for name in required)
+            order = [positions.get(name, len(positions)) for name in fields]
+            if len(order) == 1:
+                index = order[0]
+                self._record = lambda values: ((values + [None])[index],)
+            else:
+                getter = operator.itemgetter(*order)
+                self._record = lambda values: getter(values + [None])
+        self.decode = lambda buffer, offset=0: self._decode_one(buffer, offset, len(buffer))[0]
+
+    def _decode_one(self, buffer, offset, end):
+        """Decode the variable template record at offset: (record, offset of the next one).
+
+            The record is None if it doesn't fit before `end`.
+        """
+        values = []
+        for st, wanted in self._steps:
+            if st is not None:
+                if offset + st.size > end:
+                    return None, end
+                values.extend(st.unpack_from(buffer, offset))
+                offset += st.size
+            else:
+                if offset >= end:
+                    return None, end
+                length = buffer[offset]
+                offset += 1
+                if length == 255:
+                    if offset + 2 > end:
+                        return None, end
+                    length = buffer[offset] << 8 | buffer[offset + 1]
+                    offset += 2
+                if offset + length > end:
+                    return None, end
+                if wanted:
+                    values.append(bytes(buffer[offset:offset + length]))
+                offset += length
+        return self._record(values), offset
+
+    def decode_records(self, buffer, start, end, stats=None):
+        """List of records of buffer[start:end], any template.
+
+            A truncated record (corrupt length or short flowset) ends it,
+        counted in `stats['malformed']` if given.
+        """
+        if not self.variable:
+            return [self.decode(buffer, offset) for offset in range(start, end - self.size + 1, self.size)]
+        records = []
+        offset = start
+        # anything shorter than a record is set padding
+        while offset + self.size <= end:
+            record, offset = self._decode_one(buffer, offset, end)
+            if record is None:
+                if stats is not None:
+                    stats['malformed'] += 1
+                break
+            records.append(record)
+        return records
+
+    def count(self, buffer, start, end):
+        """Number of records in buffer[start:end]."""
+        if not self.variable:
+            return (end - start) // self.size
+        return len(self.offsets(buffer, start, end))
+
+    def offsets(self, buffer, start, end):
+        """Offsets of the records in buffer[start:end]."""
+        if not self.variable:
+            return range(start, end - self.size + 1, self.size)
+        offsets = []
+        offset = start
+        while offset + self.size <= end:
+            record = offset
+            for st, _ in self._steps:
+                if st is not None:
+                    offset += st.size
+                else:
+                    length = buffer[offset] if offset < end else 0
+                    if length == 255 and offset + 2 < end:
+                        length = 2 + (buffer[offset + 1] << 8 | buffer[offset + 2])
+                    offset += 1 + length
+            if offset > end:
+                break
+            offsets.append(record)
+        return offsets
+
+    def decode_batch(self, buffer, start, end):
+        """Decode all records of buffer[start:end] at once.
+
+            Returns (count, columns), columns follow `fields` (or `names`
+        for a full template). With NumPy columns are views into one
+        structured big-endian array, otherwise tuples built from
+        `struct.iter_unpack`. Absent fields have None column. Records of
+        variable templates are decoded one by one into tuple columns, so
+        are enriched columns.
+        """
+        fields = self.fields if self.fields is not None else self.names
+        if self.variable:
+            records = self.decode_records(buffer, start, end)
+            by_position = list(zip(*records)) if records else [()] * len(fields)
+            return len(records), tuple(by_position)
+        count, columns = self._decode_columns(buffer, start, end, fields)
+        if self._enrich:
+            columns = list(columns)
+            for index, key, get in self._enrich:
+                keys = columns[key]
+                if keys is None:
+                    columns[index] = (get(None),) * count
+                else:
+                    columns[index] = tuple(map(get, keys.tolist() if numpy is not None else keys))
+            columns = tuple(columns)
+        return count, columns
+
+    def _decode_columns(self, buffer, start, end, fields):
+        if self._batch is None:
+            self._batch = self._layout(fields)
+        st, positions, dt_spec = self._batch
+
+        count = (end - start) // self.size
+        if numpy is not None:
+            if 'dtype' not in dt_spec:
+                dt_spec['dtype'] = numpy.dtype({k: dt_spec[k] for k in ('names', 'formats', 'offsets', 'itemsize')})
+            records = numpy.frombuffer(buffer, dtype=dt_spec['dtype'], count=count, offset=start)
+            names = dt_spec['names']
+            columns = tuple(records[names[positions[name]]] if name in positions else None for name in fields)
+        else:
+            rows = st.iter_unpack(memoryview(buffer)[start:start + count * self.size])
+            by_position = list(zip(*rows)) or [()] * len(positions)
+            columns = tuple(by_position[positions[name]] if name in positions else None for name in fields)
+        return count, columns
+
+
+class TemplateMatcher:
+    FIELDS = Template.FIELDS
+
+    def __init__(self, fields=None, required=(), routes=None):
+        self._dyn_templates = collections.defaultdict(dict)
+        self.metadata = collections.defaultdict(ExporterMetadata)
+        self._fields = tuple(fields) if fields is not None else None
+        self._required = tuple(required)
+        self._routes = routes
+        self._listeners = []
+        self._resolver = None
+
+    def add_listener(self, callback):
+        """callback(exporter, src_id, template_id, records) is called for every template seen."""
+        self._listeners.append(callback)
+
+    def set_resolver(self, resolver):
+        """resolver(exporter, src_id, template_id) -> records or None, asked on unknown templates."""
+        self._resolver = resolver
+
+    def update_teplate(self, exporter, src_id, template_id, records, notify=True, scope=0):
+        """Learn a template of `exporter`, its address without the port (which changes on restarts)."""
+        records = tuple((fieldType, fieldLength) for fieldType, fieldLength in records)
+        templates = self._dyn_templates[(exporter, src_id)]
+        current = templates.get(template_id)
+        if current is None or current.records != records or current.scope != scope:
+            if scope:
+                template = Template(template_id, records, ExporterMetadata.FIELDS, scope=scope)
+            else:
+                template = Template(template_id, records, self._fields, self._required,
+                                    metadata=self.metadata[(exporter, src_id)] if self._fields is not None else None,
+                                    routes=self._routes)
+            templates[template_id] = template
+
+        # options templates are only kept where they came, exporters resend them anyway
+        if notify and not scope:
+            for callback in self._listeners:
+                callback(exporter, src_id, template_id, records)
+
+    def match(self, exporter, src_id, template_id):
+        source = (exporter, src_id)
+        if source in self._dyn_templates and template_id in self._dyn_templates[source]:
+            return self._dyn_templates[source][template_id]
+        if self._resolver is not None:
+            records = self._resolver(exporter, src_id, template_id)
+            if records:
+                self.update_teplate(exporter, src_id, template_id, records, notify=False)
+                return self._dyn_templates[source][template_id]
         return None
 
 
+class PendingFlowSets:
+    """Holds data flowsets that arrived before their template.
+
+        Flowsets are copied (the buffer they came in may be reused or
+    unmapped) and kept per exporter (address, source ID), bounded by
+    `max_bytes` per exporter and by `max_age` seconds, and handed back by
+    `release` once the template is known. Source IDs are whatever the
+    sender says, so `max_total_bytes` bounds all of them together: the
+    oldest flowsets of any exporter are evicted beyond it.
+    """
+    def __init__(self, stats, max_bytes=1 << 20, max_age=120, max_total_bytes=16 << 20):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_total_bytes = max_total_bytes
+        self._stats = stats
+        self._held = {}
+        self._bytes = {}
+        self._count = 0
+        self._total = 0
+        # (source, item) in arrival order, items released or dropped meanwhile are skipped
+        self._order = collections.deque()
+        self._swept = 0
+
+    def __len__(self):
+        return self._count
+
+    def hold(self, source, pkt_header, template_id, data):
+        now = time.monotonic()
+        if now - self._swept > 1:
+            self.expire(now)
+
+        held = self._held.get(source)
+        if held is None:
+            held = self._held[source] = collections.deque()
+            self._bytes[source] = 0
+        item = (now, pkt_header, template_id, bytes(data))
+        held.append(item)
+        self._order.append((source, item))
+        self._bytes[source] += len(data)
+        self._total += len(data)
+        self._count += 1
+        self._stats['held'] += 1
+
+        while self._bytes[source] > self.max_bytes:
+            self._drop(source, held)
+            self._stats['dropped'] += 1
+        while self._total > self.max_total_bytes:
+            source, item = self._order.popleft()
+            held = self._held.get(source)
+            if held and held[0] is item:
+                self._drop(source, held)
+                self._stats['evicted'] += 1
+
+    def _drop(self, source, held):
+        """Forget the oldest flowset of `source`."""
+        _, _, _, data = held.popleft()
+        self._bytes[source] -= len(data)
+        self._total -= len(data)
+        self._count -= 1
+
+    def release(self, source, template_id):
+        """Remove and return [(pkt_header, data), ...] waiting for the template."""
+        held = self._held.get(source)
+        if not held:
+            return []
+        released = [(pkt_header, data) for _, pkt_header, tid, data in held if tid == template_id]
+        if released:
+            kept = [item for item in held if item[2] != template_id]
+            held.clear()
+            held.extend(kept)
+            self._total -= sum(len(data) for _, data in released)
+            self._bytes[source] = sum(len(item[3]) for item in kept)
+            self._count -= len(released)
+            self._stats['replayed'] += len(released)
+        return released
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._swept = now
+        for source, held in list(self._held.items()):
+            while held and now - held[0][0] > self.max_age:
+                self._drop(source, held)
+                self._stats['expired'] += 1
+            if not held:
+                del self._held[source]
+                del self._bytes[source]
+        order = self._order
+        while order and now - order[0][1][0] > self.max_age:
+            order.popleft()
+
+
+class SequenceTracker:
+    """Export packet sequence accounting per exporter (address, source ID).
+
+        Sequence numbers are compared modulo 2**32. The last `window`
+    numbers before the expected one are remembered as a bitmask, so a late
+    packet within the window counts as reordered (or duplicate if already
+    seen) and a number is only counted lost once it leaves the window
+    unseen. A jump forward by more than `max_gap` or back by more than
+    `window` is counted as a reset (exporter restart) and starts over
+    once `confirm` packets in a row follow the new sequence; a stray one
+    the old sequence goes on after counts as reordered. The exporter's
+    port is left out like for templates: an exporter changing it keeps
+    its sequence and its metric labels rather than adding new ones.
+    """
+    def __init__(self, stats, name='', window=64, max_gap=1 << 16, confirm=3):
+        self.window = window
+        self.max_gap = max_gap
+        self.confirm = confirm
+        self.name = name
+        self._stats = stats
+        self._mask = (1 << window) - 1
+        self._sources = {}
+
+    def track(self, addr, src_id, seq):
+        source = (addr[0], src_id)
+        state = self._sources.get(source)
+        if state is None:
+            # [expected, seen bitmask, positions of the bitmask in use, [next, count] of a new sequence or None]
+            self._sources[source] = [(seq + 1) & 0xffffffff, 1, 1, None]
+            return
+        expected, seen, used, candidate = state
+        window = self.window
+
+        ahead = (seq - expected) & 0xffffffff
+        behind = (expected - seq) & 0xffffffff
+        if ahead > self.max_gap and behind > window:
+            if candidate is not None and seq == candidate[0]:
+                candidate[0] = (seq + 1) & 0xffffffff
+                candidate[1] += 1
+                if candidate[1] >= self.confirm:
+                    self._sources[source] = [candidate[0], (1 << candidate[1]) - 1, candidate[1], None]
+                    self._count('seq_resets', SEQUENCE_RESETS, addr, src_id)
+                return
+            if candidate is not None:
+                self._count('reordered', PACKETS_REORDERED, addr, src_id, candidate[1])
+            state[3] = [(seq + 1) & 0xffffffff, 1]
+            return
+        if candidate is not None:
+            # the old sequence goes on, what looked like a restart were late packets
+            state[3] = None
+            self._count('reordered', PACKETS_REORDERED, addr, src_id, candidate[1])
+
+        if ahead == 0:
+            state[0] = (seq + 1) & 0xffffffff
+            state[1] = ((seen << 1) | 1) & self._mask
+            if used < window:
+                state[2] = used + 1
+            elif not seen >> (window - 1):
+                self._count('lost', PACKETS_LOST, addr, src_id)
+        elif ahead <= self.max_gap:
+            shift = ahead + 1
+            # positions before the first packet are unknown, not lost
+            seen_or_unknown = seen | (self._mask ^ ((1 << used) - 1))
+            if shift < window:
+                gone = seen_or_unknown >> (window - shift)
+                lost = shift - bin(gone).count('1')
+            else:
+                lost = window - bin(seen_or_unknown).count('1') + ahead - (window - 1)
+            state[0] = (seq + 1) & 0xffffffff
+            state[1] = ((seen << shift) | 1) & self._mask
+            state[2] = min(used + shift, window)
+            if lost:
+                self._count('lost', PACKETS_LOST, addr, src_id, lost)
+        elif behind <= used:
+            bit = 1 << (behind - 1)
+            if seen & bit:
+                self._count('duplicate', PACKETS_DUPLICATE, addr, src_id)
+            else:
+                state[1] = seen | bit
+                self._count('reordered', PACKETS_REORDERED, addr, src_id)
+        else:
+            # late packet sent before the first one we saw
+            self._count('reordered', PACKETS_REORDERED, addr, src_id)
+
+    def _count(self, stat, counter, addr, src_id, value=1):
+        self._stats[stat] += value
+        counter.inc((self.name, addr[0], src_id), value)
+
+
+def flow_set_ids(buffer):
+    """Yields flowset (IPFIX set) IDs of a packet without decoding anything."""
+    offset = IpfixHeader.size if buffer[:2] == b'\x00\x0a' else PacketHeader.size
+    pkt_len = len(buffer)
+    while offset + FlowSetHeader.size <= pkt_len:
+        flow_set_id, length = FlowSetHeader(buffer, offset)
+        if length < FlowSetHeader.size:
+            return
+        yield flow_set_id
+        offset += length
+
+
 class Parser:
-    def __init__(self, version):
-        self.version = version
-        self._tpl_matcher = TemplateMatcher()
-        self._lastSeqId = 0
+    """NetFlow v9 and IPFIX packet parser.
+
+        `version` is the export version or a tuple of them (`VERSIONS`),
+    packets of other versions are ignored. IPFIX templates may have
+    enterprise-specific and variable-length fields (see `Template`),
+    options records of both versions update the exporter's
+    `ExporterMetadata`, which fills `ENRICHED` fields of projections.
+
+        `fields` switches decoding to compiled projections (see `Template`):
+    `parse` then yields plain tuples with only the requested fields and
+    silently skips flowsets whose template lacks any of `required`.
+
+        Data flowsets with an unknown template are held in `PendingFlowSets`
+    and decoded as soon as the template shows up.
+
+        `routes` (`filters.compile_routes`) split records between sinks
+    with `route`, records no route wants are not decoded.
+
+        `name` labels the parser's metrics, it names the sinks sharing the
+    parser. Sequence accounting covers v9 only: IPFIX numbers records, not
+    messages.
+    """
+    STATS = ('held', 'replayed', 'expired', 'dropped', 'lost', 'duplicate', 'reordered', 'seq_resets', 'options',
+             'filtered', 'malformed', 'evicted')
+
+    def __init__(self, version, fields=None, required=(), pending_bytes=1 << 20, pending_age=120, name='',
+                 routes=None, pending_total_bytes=16 << 20):
+        self.versions = (version,) if isinstance(version, int) else tuple(version)
+        self.name = name
+        self.routes = routes.count if routes is not None else 1
+        self._tpl_matcher = TemplateMatcher(fields, required, routes)
+        self.stats = dict.fromkeys(self.STATS, 0)
+        self._pending = PendingFlowSets(self.stats, pending_bytes, pending_age, pending_total_bytes)
+        self._sequences = SequenceTracker(self.stats, name)
+
+    def add_template_listener(self, callback):
+        self._tpl_matcher.add_listener(callback)
+
+    def set_template_resolver(self, resolver):
+        self._tpl_matcher.set_resolver(resolver)
+
+    def learn_template(self, exporter, src_id, template_id, records):
+        """Register a template learned elsewhere (another worker, template store).
+
+            `exporter` is the exporter address without the port, like in
+        template listeners and resolvers: templates outlive a change of
+        the exporter's source port.
+        """
+        self._tpl_matcher.update_teplate(exporter, src_id, template_id, records, notify=False)
+
+    def metadata(self, exporter, src_id):
+        """ExporterMetadata learned from options records of the exporter."""
+        return self._tpl_matcher.metadata[(exporter, src_id)]
 
-    def add_template(self, *field_names):
-        self._tpl_matcher.add_static_template(field_names)
+    def pop_stats(self):
+        stats = dict(self.stats)
+        for key in self.stats:
+            self.stats[key] = 0
+        return stats
 
     def parse(self, buffer, addr):
+        for pkt_header, fs_template, data, start, end in self._data_flow_sets(buffer, addr):
+            if fs_template.variable:
+                for record in fs_template.decode_records(data, start, end, self.stats):
+                    yield (pkt_header, record)
+                continue
+            decode = fs_template.decode
+            size = fs_template.size
+            for fs_record_offset in range(start, end - size + 1, size):
+                yield (pkt_header, decode(data, fs_record_offset))
+
+    def route(self, buffer, addr):
+        """Records of the packet by route: a list of [(pkt_header, record), ...] per route.
+
+            A record matching several routes is the same tuple in each.
+        Unlike `parse` and `parse_batch`, applies the filters.
+        """
+        routed = [[] for _ in range(self.routes)]
+        filtered = 0
+        for pkt_header, fs_template, data, start, end in self._data_flow_sets(buffer, addr):
+            decode = fs_template.decode
+            match = fs_template.match
+            offsets = fs_template.offsets(data, start, end)
+            if match is None:
+                records = [(pkt_header, decode(data, offset)) for offset in offsets]
+                for records_of_route in routed:
+                    records_of_route.extend(records)
+            elif self.routes == 1:
+                append = routed[0].append
+                for offset in offsets:
+                    if match(data, offset):
+                        append((pkt_header, decode(data, offset)))
+                    else:
+                        filtered += 1
+            else:
+                for offset in offsets:
+                    hits = match(data, offset)
+                    if True in hits:
+                        item = (pkt_header, decode(data, offset))
+                        for records_of_route, hit in zip(routed, hits):
+                            if hit:
+                                records_of_route.append(item)
+                    else:
+                        filtered += 1
+        self.stats['filtered'] += filtered
+        return routed
+
+    def parse_batch(self, buffer, addr):
+        """Decode every data flowset of the packet with one call per flowset.
+
+            Returns a list of FlowSetBatch(header, template, count, columns),
+        see `Template.decode_batch` for the columns layout.
+        """
+        batches = []
+        for pkt_header, fs_template, data, start, end in self._data_flow_sets(buffer, addr):
+            count, columns = fs_template.decode_batch(data, start, end)
+            batches.append(FlowSetBatch(pkt_header, fs_template, count, columns))
+        return batches
+
+    def _data_flow_sets(self, buffer, addr):
+        """Walk the packet, learn templates, yield decodable data flowsets.
+
+            Yields (pkt_header, template, data, start, end): records of the
+        flowset occupy data[start:end], where data is either the packet
+        buffer or a held flowset being replayed.
+        """
         offset = 0
         pkt_len = len(buffer)
-        pkt_header = PacketHeader(buffer, offset)
-        offset += PacketHeader.size
+        ipfix = pkt_len >= 2 and buffer[0] == 0 and buffer[1] == 10
+        if pkt_len < (IpfixHeader.size if ipfix else PacketHeader.size):
+            return
+        if ipfix:
+            pkt_header = IpfixHeader(buffer, offset)
+            offset += IpfixHeader.size
+            # the rest of the datagram is not part of the message
+            pkt_len = min(pkt_len, pkt_header.length)
+            template_set, options_set = 2, 3
+        else:
+            pkt_header = PacketHeader(buffer, offset)
+            offset += PacketHeader.size
+            template_set, options_set = 0, 1
 
-        if pkt_header.version != self.version:
+        if pkt_header.version not in self.versions:
             # show warning and exit
             return
+        if not ipfix:
+            self._sequences.track(addr, pkt_header.srcId, pkt_header.seqNumber)
+        exporter = addr[0]
 
-        while offset < pkt_len:
+        while offset + FlowSetHeader.size <= pkt_len:
             fs_header = FlowSetHeader(buffer, offset)
             fs_offset = offset + FlowSetHeader.size
             offset += fs_header.length
 
-            # if self._lastSeqId and pkt_header.seqNumber - self._lastSeqId > 1:
-            #     print('!!! LOST PACKETS: %d' % (pkt_header.seqNumber - self._lastSeqId - 1))
-            # self._lastSeqId = pkt_header.seqNumber
+            if fs_header.length < FlowSetHeader.size:
+                # malformed flowset, the rest of the packet can't be trusted
+                self.stats['malformed'] += 1
+                return
 
-            if fs_header.flowSetId == 0:
-                while fs_offset < offset:
-                    fs_tpl_header = FlowSetTplHeader(buffer, fs_offset)
-                    fs_offset += FlowSetTplHeader.size
+            if fs_header.flowSetId == template_set or fs_header.flowSetId == options_set:
+                options = fs_header.flowSetId == options_set
+                if not options:
+                    tpl_header = FlowSetTplHeader
+                elif ipfix:
+                    tpl_header = IpfixOptionsTplHeader
+                else:
+                    tpl_header = FlowSetOptionsTplHeader
+                end = min(offset, pkt_len)
+                # anything shorter than a template header is set padding
+                while fs_offset + tpl_header.size <= end:
+                    if not options:
+                        template_id, field_count = FlowSetTplHeader(buffer, fs_offset)
+                        scope = 0
+                    elif ipfix:
+                        template_id, field_count, scope = IpfixOptionsTplHeader(buffer, fs_offset)
+                    else:
+                        template_id, scope_length, option_length = FlowSetOptionsTplHeader(buffer, fs_offset)
+                        scope = scope_length // FlowSetTplRecord.size
+                        field_count = scope + option_length // FlowSetTplRecord.size
+                    fs_offset += tpl_header.size
 
                     tpl_records = []
-                    for _ in range(fs_tpl_header.fieldCount):
-                        record = FlowSetTplRecord(buffer, fs_offset)
+                    for index in range(field_count):
+                        fieldType, fieldLength = FlowSetTplRecord(buffer, fs_offset)
                         fs_offset += FlowSetTplRecord.size
-                        tpl_records.append(record)
-                    self._tpl_matcher.update_teplate(addr, fs_tpl_header.templateId, tpl_records)
-
-            elif fs_header.flowSetId == 1:
-                pass
+                        if ipfix and fieldType & ENTERPRISE_BIT:
+                            enterprise, = EnterpriseNumber.unpack_from(buffer, fs_offset)
+                            fs_offset += EnterpriseNumber.size
+                            fieldType = enterprise << 16 | fieldType ^ ENTERPRISE_BIT
+                        elif index < scope and not ipfix:
+                            fieldType = V9_SCOPES.get(fieldType, fieldType)
+                        tpl_records.append((fieldType, fieldLength))
+                    if options and not scope:
+                        # options without scope are malformed
+                        continue
+                    if not field_count:
+                        # IPFIX template withdrawal, the template stays until redefined
+                        continue
+                    self._tpl_matcher.update_teplate(exporter, pkt_header.srcId, template_id, tpl_records, scope=scope)
+                    if self._pending:
+                        yield from self._replay(exporter, pkt_header.srcId, template_id)
 
             elif fs_header.flowSetId > 255:
-                fs_template = self._tpl_matcher.match(addr, fs_header.flowSetId)
-                if fs_template:
-                    fs_record_offset = fs_offset
-                    counter = 0
-                    while fs_record_offset + fs_template.size <= offset:
-                        fs = fs_template(buffer, fs_record_offset)
-                        fs_record_offset += fs_template.size
-                        counter += 1
-                        yield (pkt_header, fs)
-                    # print('=== fs_record_offset CHECK %d:%d %d-%d' % (pkt_header.count, counter, fs_record_offset, offset))
-                    # print(struct.unpack_from('!{0}B'.format(offset - fs_record_offset), buffer, fs_record_offset))
+                fs_template = self._tpl_matcher.match(exporter, pkt_header.srcId, fs_header.flowSetId)
+                if fs_template is None:
+                    TEMPLATE_MISSES.inc((self.name, exporter, pkt_header.srcId, fs_header.flowSetId))
+                    self._pending.hold(
+                        (exporter, pkt_header.srcId), pkt_header, fs_header.flowSetId,
+                        memoryview(buffer)[fs_offset:min(offset, pkt_len)])
+                    continue
+
+                if self._pending:
+                    # template learned out of band (another worker, template store)
+                    yield from self._replay(exporter, pkt_header.srcId, fs_header.flowSetId)
+                if fs_template.scope:
+                    self._options(exporter, pkt_header.srcId, fs_template, buffer, fs_offset, min(offset, pkt_len))
+                elif fs_template.size and not fs_template.skip:
+                    end = min(offset, pkt_len)
+                    key = (self.name, exporter, pkt_header.srcId, fs_header.flowSetId)
+                    FLOWSETS.inc(key)
+                    RECORDS.inc(key, fs_template.count(buffer, fs_offset, end))
+                    yield (pkt_header, fs_template, buffer, fs_offset, end)
 
             else:
                 pass
+
+    def _replay(self, exporter, src_id, template_id):
+        released = self._pending.release((exporter, src_id), template_id)
+        if not released:
+            return
+        fs_template = self._tpl_matcher.match(exporter, src_id, template_id)
+        if fs_template.scope:
+            for pkt_header, data in released:
+                self._options(exporter, src_id, fs_template, data, 0, len(data))
+        elif fs_template.size and not fs_template.skip:
+            key = (self.name, exporter, src_id, template_id)
+            for pkt_header, data in released:
+                FLOWSETS.inc(key)
+                RECORDS.inc(key, fs_template.count(data, 0, len(data)))
+                yield (pkt_header, fs_template, data, 0, len(data))
+
+    def _options(self, exporter, src_id, fs_template, data, start, end):
+        try:
+            records = fs_template.decode_records(data, start, end, self.stats)
+            self._tpl_matcher.metadata[(exporter, src_id)].update(records)
+        except (struct.error, IndexError, TypeError, ValueError):
+            # a bad options set from one exporter must not take the packet down
+            self.stats['malformed'] += 1
+            return
+        self.stats['options'] += len(records)
@@ -1,7 +1,7 @@
-from __future__ import unicode_literals, print_function, division
-
 # read and parse pcap file
 # see http://wiki.wireshark.org/Development/LibpcapFileFormat
+import mmap
+import socket
 import struct
 
 __author__ = 'dongliu'
@@ -15,77 +15,201 @@ class UnsupportFileFormat(Exception):
     pass
 
 
-def get_parser(infile):
-    head = infile.read(4)
-
-    if len(head) < 4:
-        raise NoDataInInputBuffer()
-
-    magic_num, = struct.unpack(b'<I', head)
-    if magic_num == 0xA1B2C3D4 or magic_num == 0x4D3C2B1A:
-        return PcapFile(infile, head)
-    else:
-        raise UnsupportFileFormat()
-
-
-class PcapFile(object):
-    def __init__(self, infile, head):
-        self.infile = infile
-        self.byteorder = b'@'
-        self.link_type = None
-
-        self.pcap_check(head)
-
-    # http://www.winpcap.org/ntar/draft/PCAP-DumpFileFormat.html
-    def pcap_check(self, head):
-        """check the header of cap file, see it is a ledge pcap file.."""
-
-        # default, auto
-        # read 24 bytes header
-        pcap_file_header_len = 24
-        global_head = head + self.infile.read(pcap_file_header_len - len(head))
-
-        if not global_head:
-            raise UnsupportFileFormat()
-
-        magic_num, = struct.unpack(b'<I', global_head[0:4])
-        # judge the endian of file.
-        if magic_num == 0xA1B2C3D4:
-            self.byteorder = b'<'
-        elif magic_num == 0x4D3C2B1A:
-            self.byteorder = b'>'
+# magic number -> (byte order, timestamp fraction units per second)
+MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),
+}
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101)
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+
+IPPROTO_UDP = 17
+
+
+class PcapFile:
+    """Memory mapped pcap file.
+
+        `packets` walks the record headers in place and yields memoryview
+    slices of the mapping, nothing is copied. Views still referenced at
+    `close` keep the mapping alive until they are collected.
+    """
+    FILE_HEADER = 24
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file can't be mapped
+                raise NoDataInInputBuffer()
+
+        if len(self._map) < self.FILE_HEADER:
+            raise NoDataInInputBuffer()
+        if self._map[:4] not in MAGIC:
+            raise UnsupportFileFormat('{0} is not a pcap file (pcapng is not supported)'.format(path))
+
+        byteorder, self.ts_units = MAGIC[self._map[:4]]
+        self.version_major, self.version_minor, self.timezone, self.sigfigs, self.snaplen, self.link_type = \
+            struct.unpack_from(byteorder + '4xHHiIII', self._map)
+        self._record = struct.Struct(byteorder + 'IIII')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # a packet view is still referenced, unmapped when it is collected
+            pass
+
+    def packets(self):
+        """Yields (timestamp, captured packet) for every complete record."""
+        data = self._map
+        view = memoryview(data)
+        unpack_from = self._record.unpack_from
+        header_len = self._record.size
+        ts_units = self.ts_units
+        offset = self.FILE_HEADER
+        end = len(data)
+        try:
+            while offset + header_len <= end:
+                seconds, fraction, caplen, _ = unpack_from(data, offset)
+                offset += header_len
+                if offset + caplen > end:
+                    # truncated by a capture still being written
+                    return
+                yield seconds + fraction / ts_units, view[offset:offset + caplen]
+                offset += caplen
+        finally:
+            view.release()
+
+
+class UdpExtractor:
+    """Finds UDP datagrams in captured packets of one link type.
+
+        Handles Ethernet with any number of VLAN tags, Linux cooked capture
+    (SLL and SLL2), BSD loopback and raw IP links, IPv4 with options and
+    IPv6 without extension headers. Fragments and truncated packets are
+    counted and skipped. `stats` counts what was skipped and why.
+    """
+    STATS = ('packets', 'datagrams', 'not_udp', 'fragments', 'truncated', 'other_port')
+
+    def __init__(self, link_type, ports=None):
+        self.link_type = link_type
+        self.ports = set(ports) if ports else None
+        self.stats = dict.fromkeys(self.STATS, 0)
+        if link_type == LINKTYPE_ETHERNET:
+            self._network = self._ethernet
+        elif link_type == LINKTYPE_LINUX_SLL:
+            self._network = self._linux_sll
+        elif link_type == LINKTYPE_LINUX_SLL2:
+            self._network = self._linux_sll2
+        elif link_type == LINKTYPE_NULL:
+            self._network = self._null
+        elif link_type in LINKTYPE_RAW:
+            self._network = self._raw
+        else:
+            raise UnsupportFileFormat('link type {0} is not supported'.format(link_type))
+
+    @staticmethod
+    def _ethernet(packet):
+        offset = 12
+        while len(packet) >= offset + 2:
+            ethertype = packet[offset] << 8 | packet[offset + 1]
+            if ethertype not in ETHERTYPE_VLAN:
+                return ethertype, offset + 2
+            offset += 4
+        return None, 0
+
+    @staticmethod
+    def _linux_sll(packet):
+        if len(packet) < 16:
+            return None, 0
+        return packet[14] << 8 | packet[15], 16
+
+    @staticmethod
+    def _linux_sll2(packet):
+        if len(packet) < 20:
+            return None, 0
+        return packet[0] << 8 | packet[1], 20
+
+    @staticmethod
+    def _null(packet):
+        if len(packet) < 4:
+            return None, 0
+        # address family in the capturing host byte order
+        family = packet[0] if packet[0] else packet[3]
+        if family == socket.AF_INET:
+            return ETHERTYPE_IPV4, 4
+        return ETHERTYPE_IPV6, 4
+
+    @staticmethod
+    def _raw(packet):
+        if not len(packet):
+            return None, 0
+        return ETHERTYPE_IPV4 if packet[0] >> 4 == 4 else ETHERTYPE_IPV6, 0
+
+    def extract(self, packet):
+        """Returns (src addr, src port, dst port, payload view) or None."""
+        stats = self.stats
+        stats['packets'] += 1
+        ethertype, offset = self._network(packet)
+
+        if ethertype == ETHERTYPE_IPV4:
+            if len(packet) < offset + 20:
+                stats['truncated'] += 1
+                return None
+            ihl = (packet[offset] & 0x0f) * 4
+            if packet[offset + 9] != IPPROTO_UDP:
+                stats['not_udp'] += 1
+                return None
+            if (packet[offset + 6] & 0x3f) or packet[offset + 7]:
+                # more fragments flag or non-zero fragment offset
+                stats['fragments'] += 1
+                return None
+            total = packet[offset + 2] << 8 | packet[offset + 3]
+            ip_end = offset + total
+            src_addr = socket.inet_ntoa(packet[offset + 12:offset + 16])
+            offset += ihl
+        elif ethertype == ETHERTYPE_IPV6:
+            if len(packet) < offset + 40:
+                stats['truncated'] += 1
+                return None
+            if packet[offset + 6] != IPPROTO_UDP:
+                stats['not_udp'] += 1
+                return None
+            ip_end = offset + 40 + (packet[offset + 4] << 8 | packet[offset + 5])
+            src_addr = socket.inet_ntop(socket.AF_INET6, packet[offset + 8:offset + 24])
+            offset += 40
         else:
-            raise UnsupportFileFormat()
-
-        self.version_major, self.version_minor, self.timezone, self.timestamp, self.max_package_len, self.link_type \
-            = struct.unpack(self.byteorder + b'4xHHIIII', global_head)
-
-    def read_pcap_pac(self):
-        """
-        read pcap header.
-        return the total package length.
-        """
-        # package header
-        pcap_header_len = 16
-        package_header = self.infile.read(pcap_header_len)
-
-        # end of file.
-        if not package_header:
-            return None, None
-
-        seconds, suseconds, packet_len, raw_len = struct.unpack(self.byteorder + b'IIII',
-                                                                package_header)
-        micro_second = seconds * 1000000 + suseconds
-        # note: packet_len contains padding.
-        link_packet = self.infile.read(packet_len)
-        if len(link_packet) < packet_len:
-            return None, None
-        return micro_second, link_packet
-
-    def read_packet(self):
-        while True:
-            micro_second, link_packet = self.read_pcap_pac()
-            if link_packet:
-                yield self.link_type, micro_second, link_packet
-            else:
-                return
+            stats['not_udp'] += 1
+            return None
+
+        # ip length drops Ethernet padding, capture must hold the whole datagram
+        if ip_end > len(packet) or offset + 8 > ip_end:
+            stats['truncated'] += 1
+            return None
+        src_port = packet[offset] << 8 | packet[offset + 1]
+        dst_port = packet[offset + 2] << 8 | packet[offset + 3]
+        if self.ports is not None and dst_port not in self.ports:
+            stats['other_port'] += 1
+            return None
+        udp_end = offset + (packet[offset + 4] << 8 | packet[offset + 5])
+        if udp_end > ip_end or udp_end < offset + 8:
+            udp_end = ip_end
+        stats['datagrams'] += 1
+        return src_addr, src_port, dst_port, packet[offset + 8:udp_end]
@@ -0,0 +1,936 @@
+import collections
+import io
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+import psycopg2
+import psycopg2.errors
+
+from . import metrics
+from . import spool
+
+
+_ipv4 = struct.Struct('!I').pack
+# what encoders raise for a value out of range of its column, e.g. an IPv4 address exported in 8 bytes
+ENCODE_ERRORS = (struct.error, ValueError, OverflowError, TypeError)
+
+
+def format_inet(value):
+    """Text of an address: IPv4 int, IPv6 16 bytes, None is NULL."""
+    if value.__class__ is int:
+        return socket.inet_ntoa(_ipv4(value))
+    if value is None:
+        return '\\N'
+    return socket.inet_ntop(socket.AF_INET6, value)
+
+
+def format_text(value):
+    """COPY text of UTF-8 bytes, None is NULL. NULs are cut out: PostgreSQL rejects the whole COPY for one."""
+    if value is None:
+        return '\\N'
+    return value.replace(b'\x00', b'').decode('utf-8', 'replace').replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+class Table:
+    """COPY target: table name and (column, type) pairs.
+
+        Types are 'int8', 'int4', 'inet' and 'text'. Rows are tuples in
+    column order holding plain ints, inet columns hold IPv4 addresses as
+    ints, IPv6 addresses as 16 bytes and may be None, text columns hold
+    UTF-8 bytes or None.
+    `time_column` (epoch seconds) picks partitions and file time ranges,
+    `alias` prefixes file names.
+    """
+    # binary COPY size of a value incl. length prefix, used to account queued bytes
+    TYPE_BYTES = {'int8': 12, 'int4': 8, 'inet': 12, 'text': 20}
+
+    def __init__(self, name, columns, time_column='event_time', alias='nel'):
+        self.name = name
+        self.time_column = time_column
+        self.alias = alias
+        self.columns = tuple(column for column, _ in columns)
+        self.types = tuple(type_ for _, type_ in columns)
+        self.row_bytes = 2 + sum(self.TYPE_BYTES[type_] for type_ in self.types)
+
+
+NEL_TABLE = Table('nfcollect.log_items', (
+    ('event_time', 'int8'),
+    ('src_addr', 'inet'),
+    ('dst_addr', 'inet'),
+    ('dst_port', 'int4'),
+    ('xlate_src_addr', 'inet'),
+    ('xlate_src_port', 'int4'),
+    ('protocol', 'int4'),
+    ('xlate_dst_addr', 'inet'),
+    ('vrf_name', 'text'),
+))
+
+# port block intervals and aggregated session port ranges, see nat.PortBlocks
+PORT_BLOCK_TABLE = Table('nfcollect.port_blocks', (
+    ('start_time', 'int8'),
+    ('end_time', 'int8'),
+    ('src_addr', 'inet'),
+    ('xlate_src_addr', 'inet'),
+    ('port_start', 'int4'),
+    ('port_end', 'int4'),
+), time_column='end_time', alias='pba')
+
+# create and delete events paired, see nat.Sessions
+SESSION_TABLE = Table('nfcollect.sessions', (
+    ('start_time', 'int8'),
+    ('end_time', 'int8'),
+    ('src_addr', 'inet'),
+    ('dst_addr', 'inet'),
+    ('dst_port', 'int4'),
+    ('xlate_src_addr', 'inet'),
+    ('xlate_src_port', 'int4'),
+    ('protocol', 'int4'),
+    ('deleted', 'int4'),
+), time_column='end_time', alias='sessions')
+
+
+class TextCopy:
+    """Tab separated COPY payload, addresses formatted only here.
+
+        Rows with a value out of range of its column are left out and
+    counted in `rejected`.
+    """
+    FORMATTERS = {
+        'int8': str,
+        'int4': str,
+        'inet': format_inet,
+        'text': format_text,
+    }
+
+    def __init__(self, table):
+        self.table = table
+        self.sql = self.copy_sql(table.name)
+        self._formatters = [self.FORMATTERS[type_] for type_ in table.types]
+        self.rejected = 0
+
+    def copy_sql(self, name):
+        return 'COPY {0} ({1}) FROM STDIN'.format(name, ', '.join(self.table.columns))
+
+    def encode(self, records):
+        formatters = self._formatters
+        try:
+            return '\n'.join(
+                ['\t'.join(
+                    [fmt(i) for fmt, i in zip(formatters, rec)]
+                ) for rec in records]
+            ).encode()
+        except ENCODE_ERRORS:
+            pass
+        # one bad row fails the batch, format it again row by row
+        lines = []
+        for rec in records:
+            try:
+                lines.append('\t'.join([fmt(i) for fmt, i in zip(formatters, rec)]))
+            except ENCODE_ERRORS:
+                self.rejected += 1
+        return '\n'.join(lines).encode()
+
+
+class BinaryCopy:
+    """PGCOPY binary payload packed into a reusable bytearray.
+
+        Every row is packed with one struct call: field lengths and the
+    inet header (family, bits, is_cidr, address length) are constants
+    of the row format, so the per-row packer is generated once per row
+    shape. The shape of IPv4 rows without NULLs (and NULL text) is the
+    default one, rows with IPv6 addresses, NULLs or text switch to packers
+    of their own, text ones per length. Text with NULs fails the packers
+    and is packed with the NULs cut out, see `format_text`. Rows no
+    packer takes (a value out of range of its column) are left out and
+    counted in `rejected`.
+    """
+    SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+    HEADER = SIGNATURE + struct.pack('!ii', 0, 0)
+    TRAILER = struct.pack('!h', -1)
+
+    # type: (struct format incl. length prefix, constant arguments before the value)
+    FIELDS = {
+        'int8': ('iq', (8,)),
+        'int4': ('ii', (4,)),
+        'inet': ('iBBBBI', (8, 2, 32, 0, 4)),  # PGSQL_AF_INET, /32, not cidr, 4 bytes
+        'inet6': ('iBBBB16s', (20, 3, 128, 0, 16)),  # PGSQL_AF_INET6, /128
+    }
+    VALUE = {'int8': struct.Struct('!q'), 'int4': struct.Struct('!i')}
+
+    def __init__(self, table):
+        self.table = table
+        self.sql = self.copy_sql(table.name)
+        self._packers = {}
+        self._text = tuple(index for index, type_ in enumerate(table.types) if type_ == 'text')
+        self._row, self._pack_row = self._packer(tuple(None if type_ == 'text' else type_ for type_ in table.types))
+        self._buffer = bytearray()
+        self.rejected = 0
+
+    def _packer(self, shape):
+        """(struct, packer) of rows with column kinds `shape`, see `_shape`; text kinds are lengths."""
+        packer = self._packers.get(shape)
+        if packer is None:
+            fmt = ['!h']
+            args = [str(len(shape))]
+            for index, kind in enumerate(shape):
+                if kind is None:
+                    # a value where this shape has NULL must fail the pack too
+                    fmt.append('i')
+                    args.append('-1 if row[{0}] is None else None'.format(index))
+                elif kind.__class__ is int:
+                    # text of this length, other lengths must fail the pack
+                    fmt.append('i{0}s'.format(kind))
+                    args.append(str(kind))
+                    args.append('row[{0}] if len(row[{0}] or b"") == {1} and b"\\0" not in (row[{0}] or b"") '
+                                'else None'.format(index, kind))
+                else:
+                    field_fmt, consts = self.FIELDS[kind]
+                    fmt.append(field_fmt)
+                    args.extend(str(c) for c in consts)
+                    args.append('row[{0}]'.format(index))
+            # same trick as collections.namedtuple: build the packer source once
+            packer = self._packers[shape] = (struct.Struct(''.join(fmt)), eval(
+                'lambda pack_into, buffer, offset, row: pack_into(buffer, offset, {0})'.format(', '.join(args))))
+        return packer
+
+    def _clean(self, row):
+        """Row with NULs cut out of its text values."""
+        if not any(row[index] and b'\0' in row[index] for index in self._text):
+            return row
+        row = list(row)
+        for index in self._text:
+            if row[index]:
+                row[index] = row[index].replace(b'\0', b'')
+        return tuple(row)
+
+    def _shape(self, row):
+        return tuple(
+            None if value is None else 'inet6' if type_ == 'inet' and value.__class__ is not int else
+            len(value) if type_ == 'text' else type_
+            for type_, value in zip(self.table.types, row))
+
+    def copy_sql(self, name):
+        return 'COPY {0} ({1}) FROM STDIN WITH (FORMAT binary)'.format(name, ', '.join(self.table.columns))
+
+    def _pack(self, records, prefix, suffix):
+        default_size = self._row.size
+        size = len(prefix) + len(records) * default_size + len(suffix)
+        buffer = self._buffer
+        if len(buffer) < size:
+            buffer.extend(bytes(size - len(buffer)))
+
+        buffer[:len(prefix)] = prefix
+        offset = len(prefix)
+        row = self._row
+        pack_row = self._pack_row
+        pack_into = row.pack_into
+        row_size = row.size
+        for index, rec in enumerate(records):
+            try:
+                pack_row(pack_into, buffer, offset, rec)
+            except struct.error:
+                # another row shape, or a bigger one ran out of room
+                rec = self._clean(rec)
+                try:
+                    row, pack_row = self._packer(self._shape(rec))
+                    pack_into = row.pack_into
+                    row_size = row.size
+                    needed = offset + (len(records) - index) * max(row_size, default_size) + len(suffix)
+                    if len(buffer) < needed:
+                        buffer.extend(bytes(needed - len(buffer)))
+                    pack_row(pack_into, buffer, offset, rec)
+                except ENCODE_ERRORS:
+                    self.rejected += 1
+                    continue
+            offset += row_size
+        buffer[offset:offset + len(suffix)] = suffix
+
+        return memoryview(buffer)[:offset + len(suffix)]
+
+    def encode(self, records):
+        return self._pack(records, self.HEADER, self.TRAILER)
+
+    def encode_rows(self, records):
+        """Rows only, without PGCOPY header and trailer (see `stream`)."""
+        return self._pack(records, b'', b'')
+
+    def decode_rows(self, data):
+        """Inverse of `encode_rows`."""
+        rows = []
+        types = self.table.types
+        length_at = struct.Struct('!i').unpack_from
+        offset = 0
+        end = len(data)
+        while offset < end:
+            offset += 2
+            row = []
+            for type_ in types:
+                length, = length_at(data, offset)
+                offset += 4
+                if length < 0:
+                    row.append(None)
+                    continue
+                if type_ == 'inet':
+                    address = bytes(data[offset + 4:offset + length])
+                    row.append(int.from_bytes(address, 'big') if len(address) == 4 else address)
+                elif type_ == 'text':
+                    row.append(bytes(data[offset:offset + length]))
+                else:
+                    row.append(self.VALUE[type_].unpack_from(data, offset)[0])
+                offset += length
+            rows.append(tuple(row))
+        return rows
+
+    def stream(self, chunks):
+        """File-like object reading a COPY payload made of `encode_rows` chunks."""
+        return ChunksReader([self.HEADER] + list(chunks) + [self.TRAILER])
+
+
+class ChunksReader:
+    """Minimal file-like object over a list of bytes-like chunks for copy_expert."""
+    def __init__(self, chunks):
+        self._chunks = collections.deque(chunks)
+
+    def read(self, size=-1):
+        parts = []
+        while self._chunks and (size < 0 or size > 0):
+            chunk = self._chunks.popleft()
+            if 0 <= size < len(chunk):
+                self._chunks.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            parts.append(bytes(chunk))
+            if size >= 0:
+                size -= len(chunk)
+        return b''.join(parts)
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+COPY_FORMATS = {
+    'text': TextCopy,
+    'binary': BinaryCopy,
+}
+
+
+class DailyPartitions:
+    """Declarative range partitions of a table, one per UTC day of its time column.
+
+        Batches are split by day in Python and COPYed straight into the
+    child tables (see db-schema-partitioned.sql), so PostgreSQL doesn't
+    route every row through a trigger. Partitions are created ahead of
+    time by `PartitionMaintainer` and on demand for late or early rows.
+    """
+    DAY = 86400
+
+    def __init__(self, table, ahead=3):
+        self.table = table
+        self.ahead = ahead
+        self._index = table.columns.index(table.time_column)
+        # days whose partitions exist
+        self.known = set()
+        self._lock = threading.Lock()
+
+    def name(self, day):
+        return '{0}_{1}'.format(self.table.name, time.strftime('%Y%m%d', time.gmtime(day * self.DAY)))
+
+    def split(self, records):
+        index = self._index
+        day = self.DAY
+        by_day = collections.defaultdict(list)
+        for rec in records:
+            by_day[rec[index] // day].append(rec)
+        return by_day
+
+    def create_sql(self, day):
+        return 'CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} FOR VALUES FROM ({2}) TO ({3})'.format(
+            self.name(day), self.table.name, day * self.DAY, (day + 1) * self.DAY)
+
+    def ensure(self, db_conn, day):
+        """Create partition of the day if needed, in its own transaction."""
+        if day in self.known:
+            return
+        with self._lock:
+            if day in self.known:
+                return
+            cur = db_conn.cursor()
+            try:
+                cur.execute(self.create_sql(day))
+                db_conn.commit()
+            except (psycopg2.errors.DuplicateTable, psycopg2.errors.UniqueViolation):
+                # another worker process created it meanwhile, IF NOT EXISTS doesn't cover the race
+                db_conn.rollback()
+            finally:
+                cur.close()
+            self.known.add(day)
+
+    def ensure_ahead(self, db_conn):
+        today = int(time.time()) // self.DAY
+        for day in range(today - 1, today + self.ahead + 1):
+            self.ensure(db_conn, day)
+
+
+class PartitionMaintainer(threading.Thread):
+    """Pre-creates partitions for the next days once an hour."""
+    PERIOD = 3600
+
+    def __init__(self, partitions, dsn):
+        threading.Thread.__init__(self)
+        self.partitions = partitions
+        self.dsn = dsn
+        self.setDaemon(True)
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                db_conn = psycopg2.connect(**self.dsn)
+                try:
+                    self.partitions.ensure_ahead(db_conn)
+                finally:
+                    db_conn.close()
+            except psycopg2.Error as e:
+                logging.error('PartitionMaintainer: failed to create partitions: {0}'.format(e))
+            time.sleep(self.PERIOD)
+
+
+BATCH_RECORDS = metrics.REGISTRY.histogram(
+    'nfc_batch_records', 'Records per batch handed to a sink.',
+    (100, 1000, 5000, 10000, 50000, 100000), ('sink',))
+QUEUE_BATCHES = metrics.REGISTRY.gauge('nfc_queue_batches', 'Batches waiting in a sink queue.', ('sink',))
+QUEUE_BYTES = metrics.REGISTRY.gauge('nfc_queue_bytes', 'Size of batches waiting in a sink queue.', ('sink',))
+DROPPED_RECORDS = metrics.REGISTRY.counter(
+    'nfc_dropped_records_total', 'Records dropped on queue overflow.', ('sink',))
+SPILLED_RECORDS = metrics.REGISTRY.counter(
+    'nfc_spilled_records_total', 'Records spilled to the spool on queue overflow.', ('sink',))
+COPY_SECONDS = metrics.REGISTRY.histogram(
+    'nfc_copy_seconds', 'Time to COPY and commit a batch.',
+    (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10), ('table',))
+REJECTED_RECORDS = metrics.REGISTRY.counter(
+    'nfc_rejected_records_total', 'Records dropped because the db rejected them.', ('table',))
+DB_ERRORS = metrics.REGISTRY.counter('nfc_db_errors_total', 'Failed batch writes.', ('table',))
+REPLAYED_RECORDS = metrics.REGISTRY.counter('nfc_replayed_records_total', 'Records replayed from the spool.', ('table',))
+SPOOL_BYTES = metrics.REGISTRY.gauge('nfc_spool_bytes', 'Size of spool segments waiting for replay.', ('table',))
+
+
+class BatchQueue:
+    """Bounded batch hand-off from the event loop to DB threads.
+
+        `put` never blocks: when `max_batches` or `max_bytes` would be
+    exceeded the `overflow` policy applies: 'drop-newest' discards the
+    incoming batch, 'drop-oldest' discards the oldest queued batches and
+    'spill' appends the incoming batch to the disk `spool.Spool`, the
+    default given a spool. Dropped and spilled records are counted, the
+    totals only grow. `name` labels the queue metrics.
+    """
+    OVERFLOW_POLICIES = ('drop-newest', 'drop-oldest', 'spill')
+
+    def __init__(self, max_batches, max_bytes, row_bytes, overflow=None, spill=None, name='pg'):
+        if overflow is None:
+            overflow = 'drop-newest' if spill is None else 'spill'
+        if overflow == 'spill' and spill is None:
+            raise ValueError('spill overflow policy requires a spool')
+        self.max_batches = max_batches
+        self.max_bytes = max_bytes
+        self.row_bytes = row_bytes
+        self.overflow = overflow
+        self.spill = spill
+        self.dropped = 0
+        self.spilled = 0
+        self._batches = collections.deque()
+        self._bytes = 0
+        self._unfinished = 0
+        self._cond = threading.Condition()
+
+        self.name = name
+        QUEUE_BATCHES.set_function((name,), self.qsize)
+        QUEUE_BYTES.set_function((name,), self.qbytes)
+        DROPPED_RECORDS.set_function((name,), lambda: self.dropped)
+        SPILLED_RECORDS.set_function((name,), lambda: self.spilled)
+
+    def put(self, batch):
+        size = len(batch) * self.row_bytes
+        BATCH_RECORDS.observe(len(batch), (self.name,))
+        with self._cond:
+            if self.overflow == 'drop-oldest':
+                while self._batches and self._full(size):
+                    dropped = self._batches.popleft()
+                    self._bytes -= len(dropped) * self.row_bytes
+                    self._unfinished -= 1
+                    self.dropped += len(dropped)
+            if self._batches and self._full(size):
+                if self.overflow == 'spill':
+                    # outside of the lock DB threads keep draining meanwhile
+                    self._cond.release()
+                    try:
+                        self.spill.append(batch)
+                        self.spilled += len(batch)
+                    except OSError as e:
+                        logging.error('BatchQueue: spill failed: {0}'.format(e))
+                        self.dropped += len(batch)
+                    finally:
+                        self._cond.acquire()
+                else:
+                    self.dropped += len(batch)
+                return False
+
+            self._batches.append(batch)
+            self._bytes += size
+            self._unfinished += 1
+            self._cond.notify()
+            return True
+
+    def _full(self, size):
+        return len(self._batches) >= self.max_batches or self._bytes + size > self.max_bytes
+
+    def get(self, timeout=None):
+        """Next batch, None if nothing came in `timeout` seconds."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._batches, timeout):
+                return None
+            batch = self._batches.popleft()
+            self._bytes -= len(batch) * self.row_bytes
+            return batch
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            if self._unfinished <= 0:
+                self._cond.notify_all()
+
+    def join(self):
+        with self._cond:
+            while self._unfinished > 0:
+                self._cond.wait()
+
+    def qsize(self):
+        return len(self._batches)
+
+    def qbytes(self):
+        return self._bytes
+
+
+class PgWriter:
+    """Database connection writing batches with COPY.
+
+        Connects on first write, so the daemon starts while the DB is down.
+    `write` raises psycopg2.Error and leaves the connection rolled back,
+    `reconnect` retries with exponential backoff until the DB answers.
+    Callers with somewhere else to put batches call `lost` instead and
+    skip writing while `down`, the backoff then runs between writes.
+    A connection idle for `HEALTH_CHECK` seconds is pinged before use,
+    one closed by the server or a failed ping is replaced. Records the
+    encoder left out of committed batches are counted in `rejected`.
+    """
+    BACKOFF_MAX = 60
+    HEALTH_CHECK = 30
+
+    def __init__(self, dsn, encoder, partitions=None):
+        self.dsn = dsn
+        self.encoder = encoder
+        self.partitions = partitions
+        self.db_conn = None
+        self._used = 0
+        self._delay = 1
+        self._retry_at = 0
+        self.rejected = 0
+
+    def reconnect(self):
+        delay = 1
+        while True:
+            if self.db_conn is not None:
+                self._close()
+            try:
+                self.db_conn = psycopg2.connect(**self.dsn)
+                self._used = time.monotonic()
+                logging.info('PgWriter: reconnected to db')
+                return
+            except psycopg2.Error as e:
+                logging.error('PgWriter: reconnect failed, next try in {0} seconds: {1}'.format(delay, e))
+                time.sleep(delay)
+                delay = min(delay * 2, self.BACKOFF_MAX)
+
+    def lost(self):
+        """Drop the connection after a connection error, `down` for the next backoff delay."""
+        if self.db_conn is not None:
+            self._close()
+        logging.error('PgWriter: db is down, next try in {0} seconds'.format(self._delay))
+        self._retry_at = time.monotonic() + self._delay
+        self._delay = min(self._delay * 2, self.BACKOFF_MAX)
+
+    def down(self):
+        return time.monotonic() < self._retry_at
+
+    def check(self):
+        """Ping an idle connection, drop it if the DB doesn't answer; False if dropped."""
+        if self.db_conn is None or time.monotonic() - self._used < self.HEALTH_CHECK:
+            return True
+        try:
+            if not self.db_conn.closed:
+                cur = self.db_conn.cursor()
+                try:
+                    cur.execute('SELECT 1')
+                finally:
+                    cur.close()
+                self.db_conn.rollback()
+                self._used = time.monotonic()
+                return True
+        except psycopg2.Error as e:
+            logging.error('PgWriter: health check failed: {0}'.format(e))
+        self._close()
+        return False
+
+    def _connect(self):
+        if self.db_conn is not None and self.db_conn.closed:
+            self._close()
+        self.check()
+        if self.db_conn is None:
+            self.db_conn = psycopg2.connect(**self.dsn)
+
+    def _close(self):
+        try:
+            self.db_conn.close()
+        except psycopg2.Error:
+            pass
+        self.db_conn = None
+
+    def write(self, records):
+        self._connect()
+        started = time.monotonic()
+        rejected = self.encoder.rejected
+        try:
+            if self.partitions is None:
+                self._copy(self.encoder.sql, io.BytesIO(self.encoder.encode(records)))
+            else:
+                by_day = self.partitions.split(records)
+                for day in by_day:
+                    self.partitions.ensure(self.db_conn, day)
+                for day, day_records in by_day.items():
+                    self._copy(self.encoder.copy_sql(self.partitions.name(day)), io.BytesIO(self.encoder.encode(day_records)))
+            self.db_conn.commit()
+        except Exception:
+            self._rollback()
+            raise
+        self._used = time.monotonic()
+        self._delay = 1
+        self.rejected += self.encoder.rejected - rejected
+        COPY_SECONDS.observe(self._used - started, (self.encoder.table.name,))
+
+    def write_stream(self, stream):
+        """COPY a prepared binary payload (no partitions) in one transaction."""
+        self._connect()
+        started = time.monotonic()
+        try:
+            self._copy(self.encoder.sql, stream)
+            self.db_conn.commit()
+        except psycopg2.Error:
+            self._rollback()
+            raise
+        self._used = time.monotonic()
+        COPY_SECONDS.observe(self._used - started, (self.encoder.table.name,))
+
+    def _copy(self, sql, f):
+        cur = self.db_conn.cursor()
+        try:
+            cur.copy_expert(sql, f)
+        finally:
+            cur.close()
+
+    def _rollback(self):
+        try:
+            self.db_conn.rollback()
+        except psycopg2.Error:
+            pass
+
+
+def is_connection_error(e):
+    """Whether retrying after a reconnect can help, unlike bad data or schema errors."""
+    return isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+class SpoolReplayer(threading.Thread):
+    """Drains spool segments into PostgreSQL in bulk.
+
+        Frames of a segment are already PGCOPY rows, so without partitions
+    a segment is streamed as a single COPY in chunks of `chunk_bytes`;
+    with partitions rows are decoded and split by day. A segment is
+    removed once committed; on connection errors the replayer reconnects
+    with backoff, segments the DB rejects are quarantined.
+    """
+    IDLE = 1
+
+    def __init__(self, spool, dsn, table, partitions=None, chunk_bytes=16 << 20):
+        threading.Thread.__init__(self)
+        self.spool = spool
+        self.dsn = dsn
+        self.table = table
+        self.partitions = partitions
+        self.chunk_bytes = chunk_bytes
+        self.replayed = 0
+        self.setDaemon(True)
+        self.start()
+
+    def run(self):
+        writer = None
+        while True:
+            segments = self.spool.closed_segments()
+            if not segments:
+                time.sleep(self.IDLE)
+                continue
+            if writer is None:
+                writer = PgWriter(self.dsn, BinaryCopy(self.table), self.partitions)
+
+            for path in segments:
+                try:
+                    started = time.monotonic()
+                    rows = self._replay(writer, path)
+                except psycopg2.Error as e:
+                    if is_connection_error(e):
+                        logging.error('SpoolReplayer: replay of {0} failed: {1}'.format(path, e))
+                        writer.reconnect()
+                    else:
+                        logging.error('SpoolReplayer: db rejected {0}, quarantined: {1}'.format(path, e))
+                        self.spool.quarantine(path)
+                    break
+                self.spool.remove(path)
+                self.replayed += rows
+                logging.info('SpoolReplayer: replayed {0} records from {1} in {2:.1f} seconds'.format(
+                    rows, path, time.monotonic() - started))
+
+    def _replay(self, writer, path):
+        """Write a whole segment, chunks commit separately so a retry may duplicate rows."""
+        total = 0
+        chunk, chunk_rows, chunk_bytes = [], 0, 0
+        for rows, payload in self.spool.read(path):
+            chunk.append(payload)
+            chunk_rows += rows
+            chunk_bytes += len(payload)
+            if chunk_bytes >= self.chunk_bytes:
+                self._write(writer, chunk)
+                total += chunk_rows
+                chunk, chunk_rows, chunk_bytes = [], 0, 0
+        if chunk:
+            self._write(writer, chunk)
+            total += chunk_rows
+        return total
+
+    def _write(self, writer, chunk):
+        if self.partitions is None:
+            writer.write_stream(writer.encoder.stream(chunk))
+        else:
+            records = []
+            for payload in chunk:
+                records.extend(writer.encoder.decode_rows(payload))
+            writer.write(records)
+
+
+class StorePgThreadPool:
+    class Worker(threading.Thread):
+        RETRIES = 3
+
+        def __init__(self, requests, writer, spool=None):
+            threading.Thread.__init__(self)
+            self.requests = requests
+            self.writer = writer
+            self.spool = spool
+            self.db_errors = 0
+            self.rejected = 0
+
+            self.setDaemon(True)
+            self.start()
+
+        def run(self):
+            while True:
+                records = self.requests.get(self.writer.HEALTH_CHECK)
+                if records is None:
+                    # idle: find a dead connection before the next batch does
+                    self.writer.check()
+                    continue
+                try:
+                    self.store(records)
+                except Exception:
+                    # whatever it was, the thread must go on with the next batch
+                    self.rejected += len(records)
+                    logging.exception('StorePgThreadPool: dropped batch of {0} records'.format(len(records)))
+                finally:
+                    self.requests.task_done()
+
+        def store(self, records):
+            if self.spool is not None and self.writer.down() and self._spool(records):
+                # db is down: drain the queue into the spool until the next try
+                return
+            attempt = 0
+            while True:
+                try:
+                    self.writer.write(records)
+                    logging.info('StorePgThreadPool: data batch commited to db')
+                    return
+                except psycopg2.Error as e:
+                    self.db_errors += 1
+                    attempt += 1
+                    connection_lost = is_connection_error(e)
+                    logging.error('StorePgThreadPool: db write failed (attempt {0}): {1}'.format(attempt, e))
+
+                if not connection_lost and attempt < self.RETRIES:
+                    # concurrent DDL, deadlocks and the like usually pass
+                    time.sleep(attempt)
+                    continue
+                if self.spool is not None and self._spool(records):
+                    if connection_lost:
+                        self.writer.lost()
+                    return
+                if not connection_lost:
+                    self.rejected += len(records)
+                    logging.error('StorePgThreadPool: dropped batch of {0} records rejected by db'.format(len(records)))
+                    return
+                # no spool: keep the batch until the db is back
+                self.writer.reconnect()
+
+        def _spool(self, records):
+            try:
+                self.spool.append(records)
+                return True
+            except OSError as e:
+                logging.error('StorePgThreadPool: spool failed: {0}'.format(e))
+                return False
+
+    def __init__(self, num_threads, db_conn_str, table=NEL_TABLE, copy_format='text', partitions_ahead=None,
+                 queue_batches=16, queue_bytes=64 << 20, overflow=None, spool_dir=None,
+                 spool_fsync='interval', spool_segment_bytes=64 << 20, name='pg'):
+        self.spool = None
+        if spool_dir:
+            self.spool = spool.Spool(spool_dir, BinaryCopy(table), spool_segment_bytes, spool_fsync)
+        self.requests = BatchQueue(queue_batches, queue_bytes, table.row_bytes, overflow, self.spool, name)
+        partitions = None
+        if partitions_ahead is not None:
+            partitions = DailyPartitions(table, ahead=partitions_ahead)
+            PartitionMaintainer(partitions, db_conn_str)
+        self.workers = []
+        for _ in range(num_threads):
+            # encoders keep a reusable buffer, one per thread
+            writer = PgWriter(db_conn_str, COPY_FORMATS[copy_format](table), partitions)
+            self.workers.append(self.Worker(self.requests, writer, self.spool))
+        self.replayer = None
+        if self.spool is not None:
+            self.replayer = SpoolReplayer(self.spool, db_conn_str, table, partitions)
+        self._db_errors = 0
+        self._replayed = 0
+        self._dropped = 0
+        self._spilled = 0
+
+        DB_ERRORS.set_function((table.name,), lambda: self.db_errors)
+        REJECTED_RECORDS.set_function((table.name,), lambda: self.rejected)
+        if self.spool is not None:
+            REPLAYED_RECORDS.set_function((table.name,), lambda: self.replayer.replayed)
+            SPOOL_BYTES.set_function((table.name,), self.spool.pending_bytes)
+
+    @property
+    def db_errors(self):
+        return sum(worker.db_errors for worker in self.workers)
+
+    @property
+    def rejected(self):
+        rejected = sum(worker.rejected + worker.writer.rejected for worker in self.workers)
+        return rejected + (self.spool.rejected if self.spool is not None else 0)
+
+    def addRequest(self, records_buf):
+        """Queue a batch without blocking, False if it was dropped or spilled."""
+        return self.requests.put(records_buf)
+
+    def waitCompletion(self): self.requests.join()
+
+    def getQueueSize(self):
+        return self.requests.qsize()
+
+    def pop_stats(self):
+        db_errors = self.db_errors
+        replayed = self.replayer.replayed if self.replayer else 0
+        dropped = self.requests.dropped
+        spilled = self.requests.spilled
+        stats = {
+            'queue_bytes': self.requests.qbytes(),
+            'dropped_records': dropped - self._dropped,
+            'spilled_records': spilled - self._spilled,
+            'db_errors': db_errors - self._db_errors,
+            'replayed_records': replayed - self._replayed,
+        }
+        self._dropped = dropped
+        self._spilled = spilled
+        self._db_errors = db_errors
+        self._replayed = replayed
+        return stats
+
+
+class ShardedPgStore:
+    """`pool` (StorePgThreadPool or alike) per database, batches split between them.
+
+        `by` 'xlate-addr' keeps every public /24 (IPv6 /64) on one shard,
+    so a subscriber lookup needs only the shard of the address; 'time'
+    sends each `interval` seconds of events to the next shard in turn.
+    Each shard has its own queue, threads and spool (a subdirectory of
+    `spool_dir`), so a shard that is down doesn't hold up the others.
+    """
+    SHARD_BY = ('xlate-addr', 'time')
+    ADDR_COLUMN = 'xlate_src_addr'
+
+    def __init__(self, num_threads, dsns, table=NEL_TABLE, by='xlate-addr', interval=60, spool_dir=None,
+                 pool=None, **pool_options):
+        pool = pool or StorePgThreadPool
+        self.pools = []
+        for n, dsn in enumerate(dsns):
+            shard_spool = os.path.join(spool_dir, 'shard{0}'.format(n)) if spool_dir else None
+            self.pools.append(pool(
+                num_threads, dsn, table, spool_dir=shard_spool, name='pg{0}'.format(n), **pool_options))
+        if by == 'time':
+            self._index = table.columns.index(table.time_column)
+            self._key = lambda value: value // interval
+        else:
+            self._index = table.columns.index(self.ADDR_COLUMN)
+            self._key = self._addr_key
+
+        # per pool functions of a table overwrite each other, report the sums
+        DB_ERRORS.set_function((table.name,), lambda: sum(pool.db_errors for pool in self.pools))
+        REJECTED_RECORDS.set_function((table.name,), lambda: sum(pool.rejected for pool in self.pools))
+        if spool_dir:
+            REPLAYED_RECORDS.set_function((table.name,), lambda: sum(pool.replayer.replayed for pool in self.pools))
+            SPOOL_BYTES.set_function((table.name,), lambda: sum(pool.spool.pending_bytes() for pool in self.pools))
+
+    @staticmethod
+    def _addr_key(value):
+        if value.__class__ is int:
+            return value >> 8
+        return int.from_bytes(value[:8], 'big')
+
+    def split(self, records):
+        """{shard number: records}."""
+        index = self._index
+        key = self._key
+        shards = len(self.pools)
+        by_shard = collections.defaultdict(list)
+        for rec in records:
+            by_shard[key(rec[index]) % shards].append(rec)
+        return by_shard
+
+    def addRequest(self, records_buf):
+        queued = True
+        for n, records in self.split(records_buf).items():
+            queued = self.pools[n].addRequest(records) and queued
+        return queued
+
+    def waitCompletion(self):
+        for pool in self.pools:
+            pool.waitCompletion()
+
+    def getQueueSize(self):
+        return sum(pool.getQueueSize() for pool in self.pools)
+
+    def pop_stats(self):
+        stats = collections.Counter()
+        for pool in self.pools:
+            stats.update(pool.pop_stats())
+        return dict(stats)
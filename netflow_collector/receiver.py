@@ -0,0 +1,211 @@
+import ctypes
+import ctypes.util
+import logging
+import socket
+import struct
+
+# Linux values, the socket module doesn't export them
+SO_RCVBUFFORCE = 33
+SO_RXQ_OVFL = 40
+MSG_DONTWAIT = 0x40
+
+DATAGRAM_MAX = 65535
+
+
+def set_receive_buffer(sock, size):
+    """Set SO_RCVBUF, past net.core.rmem_max if the process may, returns the size granted."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+    except OSError:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    # the kernel reports double the size for bookkeeping overhead
+    granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+    if granted < size:
+        logging.warning('receiver: receive buffer limited to {0} bytes, raise net.core.rmem_max'.format(granted))
+    return granted
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_iovec)), ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    recvmmsg.restype = ctypes.c_int
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    return recvmmsg
+
+
+_recvmmsg = _load_recvmmsg()
+
+ENGINES = ('recvmmsg', 'recvmsg')
+
+
+class BatchReceiver:
+    """Drains a UDP socket in batches into a preallocated ring of buffers.
+
+        Instead of one callback per datagram the protocol's
+    `datagrams_received` gets a list of (memoryview, addr) pairs. The
+    views point into buffers reused by the next batch: handlers must copy
+    whatever they keep. 'recvmmsg' fills the whole ring with one system
+    call (Linux, through ctypes), 'recvmsg' calls `socket.recvmsg_into`
+    per datagram. Both read SO_RXQ_OVFL, the kernel's count of datagrams
+    dropped on the socket, into `drops`.
+    """
+    # batches handled per loop wakeup, so timers and other sockets get their turn
+    MAX_BATCHES = 16
+    CONTROL = socket.CMSG_SPACE(4)
+    NAME = 128
+
+    def __init__(self, sock, protocol, batch=64, engine=None):
+        if engine is None:
+            engine = 'recvmmsg' if _recvmmsg is not None else 'recvmsg'
+        if engine == 'recvmmsg' and _recvmmsg is None:
+            raise OSError('recvmmsg is not available')
+        self.sock = sock
+        self.protocol = protocol
+        self.batch = batch
+        self.engine = engine
+        self.drops = None
+        self._loop = None
+        self._buffers = [bytearray(DATAGRAM_MAX) for _ in range(batch)]
+        self._views = [memoryview(buffer) for buffer in self._buffers]
+        self._addrs = {}
+
+        sock.setblocking(False)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        except OSError:
+            pass
+
+        if engine == 'recvmmsg':
+            self._setup_recvmmsg()
+            self._receive = self._receive_recvmmsg
+        else:
+            self._receive = self._receive_recvmsg
+
+    def _setup_recvmmsg(self):
+        count = self.batch
+        self._msgs = (_mmsghdr * count)()
+        self._iovs = (_iovec * count)()
+        self._names = ctypes.create_string_buffer(self.NAME * count)
+        self._controls = ctypes.create_string_buffer(self.CONTROL * count)
+        names = ctypes.addressof(self._names)
+        controls = ctypes.addressof(self._controls)
+        # keep the ctypes views alive, they pin the bytearrays
+        self._pinned = [(ctypes.c_char * DATAGRAM_MAX).from_buffer(buffer) for buffer in self._buffers]
+        for i in range(count):
+            self._iovs[i].iov_base = ctypes.addressof(self._pinned[i])
+            self._iovs[i].iov_len = DATAGRAM_MAX
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = names + i * self.NAME
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_control = controls + i * self.CONTROL
+
+    def start(self, loop):
+        self._loop = loop
+        loop.add_reader(self.sock.fileno(), self._read)
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self.sock.fileno())
+            self._loop = None
+        self.sock.close()
+
+    def _read(self):
+        for _ in range(self.MAX_BATCHES):
+            batch = self._receive()
+            if batch:
+                self.protocol.datagrams_received(batch)
+            if len(batch) < self.batch:
+                return
+
+    def _receive_recvmsg(self):
+        batch = []
+        recvmsg_into = self.sock.recvmsg_into
+        control = None
+        for view in self._views:
+            try:
+                nbytes, ancdata, _, addr = recvmsg_into([view], self.CONTROL)
+            except (BlockingIOError, InterruptedError):
+                break
+            batch.append((view[:nbytes], addr))
+            control = ancdata
+        if control:
+            for level, type_, data in control:
+                if level == socket.SOL_SOCKET and type_ == SO_RXQ_OVFL and len(data) >= 4:
+                    self.drops = struct.unpack('=I', data[:4])[0]
+        return batch
+
+    def _receive_recvmmsg(self):
+        msgs = self._msgs
+        for i in range(self.batch):
+            hdr = msgs[i].msg_hdr
+            hdr.msg_namelen = self.NAME
+            hdr.msg_controllen = self.CONTROL
+        received = _recvmmsg(self.sock.fileno(), msgs, self.batch, MSG_DONTWAIT, None)
+        if received <= 0:
+            return []
+
+        batch = []
+        names = self._names.raw
+        addrs = self._addrs
+        for i in range(received):
+            msg = msgs[i]
+            offset = i * self.NAME
+            name = names[offset:offset + msg.msg_hdr.msg_namelen]
+            addr = addrs.get(name)
+            if addr is None:
+                addr = addrs[name] = self._sockaddr(name)
+            batch.append((self._views[i][:msg.msg_len], addr))
+
+        hdr = msgs[received - 1].msg_hdr
+        if hdr.msg_controllen >= socket.CMSG_LEN(4):
+            offset = (received - 1) * self.CONTROL
+            # struct cmsghdr: size_t len, int level, int type, data
+            length, level, type_, drops = struct.unpack_from('@NiiI', self._controls.raw, offset)
+            if level == socket.SOL_SOCKET and type_ == SO_RXQ_OVFL:
+                self.drops = drops
+        return batch
+
+    def _sockaddr(self, name):
+        """Address tuple as asyncio would report it."""
+        family = struct.unpack_from('=H', name)[0]
+        port = struct.unpack_from('!H', name, 2)[0]
+        if family == socket.AF_INET:
+            return socket.inet_ntop(socket.AF_INET, name[4:8]), port
+        flowinfo, = struct.unpack_from('!I', name, 4)
+        scope_id, = struct.unpack_from('=I', name, 24)
+        return socket.inet_ntop(socket.AF_INET6, name[8:24]), port, flowinfo, scope_id
+
+
+def listen(loop, sock, protocol, batch=0, engine=None):
+    """Receive on a bound socket with the asyncio endpoint or, given `batch`, a BatchReceiver.
+
+        Returns the transport or receiver, both have `close`.
+    """
+    if batch:
+        receiver = BatchReceiver(sock, protocol, batch, engine)
+        receiver.start(loop)
+        logging.info('receiver: {0} batches of {1} datagrams'.format(receiver.engine, batch))
+        return receiver
+    transport, _ = loop.run_until_complete(loop.create_datagram_endpoint(lambda: protocol, sock=sock))
+    return transport
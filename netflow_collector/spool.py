@@ -0,0 +1,111 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+class Spool:
+    """Append-only segmented spool of COPY batches on local disk.
+
+        Batches are written when PostgreSQL is down or the queue is full
+    and drained later by `pgstore.SpoolReplayer`. A segment is a sequence
+    of frames: header (magic, payload length, crc32 of payload, rows)
+    followed by the rows in PGCOPY binary encoding, so a whole segment
+    can be streamed into one COPY. A torn frame at the end of a segment
+    (crash during write) is detected by length and crc and ignored.
+
+        `fsync` is 'always' (every batch), 'interval' (at most once per
+    `fsync_interval` seconds) or 'never' (leave it to the OS). Records
+    the encoder leaves out are counted in `rejected`.
+    """
+    FRAME = struct.Struct('!4sIIi')
+    MAGIC = b'NFSP'
+    SUFFIX = '.seg'
+    FSYNC_POLICIES = ('always', 'interval', 'never')
+
+    def __init__(self, directory, encoder, segment_bytes=64 << 20, fsync='interval', fsync_interval=1.0):
+        self.directory = directory
+        self.encoder = encoder
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.spooled = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._synced = 0
+        self._written = 0
+        os.makedirs(directory, exist_ok=True)
+
+        segments = self._segments()
+        self._seq = int(segments[-1][:-len(self.SUFFIX)]) if segments else 0
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(self.SUFFIX))
+
+    def _open(self):
+        self._seq += 1
+        path = os.path.join(self.directory, '{0:010d}{1}'.format(self._seq, self.SUFFIX))
+        self._file = open(path, 'ab')
+        self._path = path
+
+    def append(self, records):
+        with self._lock:
+            if self._file is None:
+                self._open()
+            rejected = self.encoder.rejected
+            payload = self.encoder.encode_rows(records)
+            rows = len(records) - (self.encoder.rejected - rejected)
+            self._file.write(self.FRAME.pack(self.MAGIC, len(payload), zlib.crc32(payload), rows))
+            self._file.write(payload)
+            self._file.flush()
+            self._written = time.monotonic()
+            self.spooled += rows
+            self.rejected += len(records) - rows
+
+            if self.fsync == 'always' or (self.fsync == 'interval' and self._written - self._synced >= self.fsync_interval):
+                os.fsync(self._file.fileno())
+                self._synced = self._written
+            if self._file.tell() >= self.segment_bytes:
+                self._close()
+
+    def _close(self):
+        if self.fsync != 'never':
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def closed_segments(self, idle=1.0):
+        """Segments ready to replay; the open one is closed if idle for `idle` seconds."""
+        with self._lock:
+            if self._file is not None and time.monotonic() - self._written >= idle:
+                self._close()
+            current = os.path.basename(self._path) if self._file is not None else None
+            return [os.path.join(self.directory, name) for name in self._segments() if name != current]
+
+    def read(self, path):
+        """Yields (rows, payload) of every intact frame of a segment."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        view = memoryview(data)
+        offset = 0
+        while offset + self.FRAME.size <= len(data):
+            magic, length, crc, rows = self.FRAME.unpack_from(data, offset)
+            payload = view[offset + self.FRAME.size:offset + self.FRAME.size + length]
+            if magic != self.MAGIC or len(payload) != length or zlib.crc32(payload) != crc:
+                logging.error('Spool: {0} is damaged at offset {1}, rest of it ignored'.format(path, offset))
+                return
+            yield rows, payload
+            offset += self.FRAME.size + length
+
+    def remove(self, path):
+        os.unlink(path)
+
+    def quarantine(self, path):
+        """Move a segment the DB refuses aside so it doesn't block the replay."""
+        os.rename(path, path + '.bad')
+
+    def pending_bytes(self):
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in self._segments())
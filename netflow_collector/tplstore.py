@@ -0,0 +1,153 @@
+import ast
+import logging
+import os
+import sqlite3
+import struct
+import time
+
+
+class TemplateStore:
+    """NetFlow templates persisted in a local SQLite database.
+
+        Templates are keyed by (exporter address, source ID, template ID),
+    the address without the port so they outlive an exporter restart from
+    another source port, and stamped with the time they were last seen.
+    They are loaded into the parsers at startup, saved whenever a template
+    arrives (unchanged templates at most once per `refresh` seconds) and
+    looked up on a template miss, so workers sharing the file learn from
+    each other. Entries not seen for `max_age` seconds are evicted.
+    """
+    EVICT_PERIOD = 3600
+    # PRAGMA user_version of the schema, 0 keyed exporters by repr((host, port))
+    VERSION = 1
+
+    def __init__(self, path, max_age=86400, refresh=600, miss_retry=10):
+        self.path = path
+        self.max_age = max_age
+        self.refresh = refresh
+        self.miss_retry = miss_retry
+        self._db = None
+        self._pid = None
+        self._saved = {}
+        self._misses = {}
+        self._evicted = 0
+
+    def _connect(self):
+        # connection must not be shared with forked workers
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS templates ('
+                ' exporter TEXT, source_id INTEGER, template_id INTEGER, records BLOB, updated REAL,'
+                ' PRIMARY KEY (exporter, source_id, template_id))')
+            if self._db.execute('PRAGMA user_version').fetchone()[0] < self.VERSION:
+                self._migrate()
+            self._pid = os.getpid()
+            self._saved = {}
+            self._misses = {}
+        return self._db
+
+    def _migrate(self):
+        """Rekey version 0 rows by the exporter host, the latest of several ports wins."""
+        db = self._db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # another worker may have done it meanwhile
+            if db.execute('PRAGMA user_version').fetchone()[0] < self.VERSION:
+                rows = db.execute(
+                    "SELECT exporter, source_id, template_id, records, updated FROM templates"
+                    " WHERE exporter LIKE '(%' ORDER BY updated").fetchall()
+                db.execute("DELETE FROM templates WHERE exporter LIKE '(%'")
+                db.executemany('INSERT OR REPLACE INTO templates VALUES (?, ?, ?, ?, ?)',
+                               [(ast.literal_eval(row[0])[0],) + row[1:] for row in rows])
+                db.execute('PRAGMA user_version = {0}'.format(self.VERSION))
+                logging.info('TemplateStore: rekeyed {0} templates of {1} by exporter address'.format(
+                    len(rows), self.path))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _pack(records):
+        if any(fieldType > 0xffff for fieldType, _ in records):
+            # IPFIX enterprise-specific elements don't fit, kept as text
+            return repr(records)
+        return struct.pack('!{0}H'.format(len(records) * 2), *[v for record in records for v in record])
+
+    @staticmethod
+    def _unpack(blob):
+        if isinstance(blob, str):
+            return ast.literal_eval(blob)
+        values = struct.unpack('!{0}H'.format(len(blob) // 2), blob)
+        return tuple(zip(values[::2], values[1::2]))
+
+    def attach(self, parsers):
+        """Load stored templates into parsers and keep the store up to date."""
+        if not parsers:
+            return
+        self.evict()
+        count = 0
+        for exporter, src_id, template_id, records in self.load():
+            for parser in parsers:
+                parser.learn_template(exporter, src_id, template_id, records)
+            count += 1
+        logging.info('TemplateStore: loaded {0} templates from {1}'.format(count, self.path))
+
+        parsers[0].add_template_listener(self.save)
+        for parser in parsers:
+            parser.set_template_resolver(self.lookup)
+
+    def load(self):
+        rows = self._connect().execute(
+            'SELECT exporter, source_id, template_id, records FROM templates WHERE updated >= ?',
+            (time.time() - self.max_age,))
+        for exporter, src_id, template_id, blob in rows:
+            yield exporter, src_id, template_id, self._unpack(blob)
+
+    def save(self, exporter, src_id, template_id, records):
+        now = time.time()
+        key = (exporter, src_id, template_id)
+        saved = self._saved.get(key)
+        if saved and saved[0] == records and now - saved[1] < self.refresh:
+            return
+
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO templates VALUES (?, ?, ?, ?, ?)',
+                (exporter, src_id, template_id, self._pack(records), now))
+        except sqlite3.Error as e:
+            logging.error('TemplateStore: failed to save template: {0}'.format(e))
+            return
+        self._saved[key] = (records, now)
+        self._misses.pop(key, None)
+
+        if now - self._evicted > self.EVICT_PERIOD:
+            self.evict()
+
+    def lookup(self, exporter, src_id, template_id):
+        now = time.time()
+        key = (exporter, src_id, template_id)
+        if now - self._misses.get(key, 0) < self.miss_retry:
+            return None
+
+        try:
+            row = self._connect().execute(
+                'SELECT records FROM templates WHERE exporter = ? AND source_id = ? AND template_id = ? AND updated >= ?',
+                (exporter, src_id, template_id, now - self.max_age)).fetchone()
+        except sqlite3.Error as e:
+            logging.error('TemplateStore: failed to look up template: {0}'.format(e))
+            row = None
+
+        if row is None:
+            self._misses[key] = now
+            return None
+        return self._unpack(row[0])
+
+    def evict(self):
+        self._evicted = time.time()
+        try:
+            self._connect().execute('DELETE FROM templates WHERE updated < ?', (self._evicted - self.max_age,))
+        except sqlite3.Error as e:
+            logging.error('TemplateStore: failed to evict templates: {0}'.format(e))
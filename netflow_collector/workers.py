@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import multiprocessing
+import pickle
+import queue
+import signal
+import socket
+import sys
+import time
+
+from . import metrics
+from . import receiver
+
+
+def bind_udp(host, port, reuse_port=False):
+    family, type_, proto, _, sockaddr = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+    sock = socket.socket(family, type_, proto)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(sockaddr)
+    return sock
+
+
+class TemplateExchange:
+    """Shares NetFlow templates between worker processes.
+
+        SO_REUSEPORT balances by source address and port, so an exporter
+    normally sticks to one worker, but after a worker restart or a change
+    of exporter source port the data may land on a worker that never saw
+    the template. Every worker broadcasts templates it learns to the
+    others over a unix datagram socket pair created before the fork, keyed
+    by exporter address without the port. A worker (re)started by the
+    supervisor asks its siblings for the templates they know, so it only
+    misses templates no live worker has seen.
+    """
+    # templates per message when handing over what is known
+    CHUNK = 16
+
+    def __init__(self, count):
+        self._pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(count)]
+        for rx, tx in self._pairs:
+            rx.setblocking(False)
+            tx.setblocking(False)
+        self._known = {}
+        self._parsers = []
+
+    def attach(self, index, loop, parsers):
+        if not parsers:
+            return
+        self._parsers = parsers
+        self._index = index
+        self._rx = self._pairs[index][0]
+        self._tx = [tx for i, (rx, tx) in enumerate(self._pairs) if i != index]
+        loop.add_reader(self._rx, self._receive)
+        parsers[0].add_template_listener(self._broadcast)
+        self._send(self._tx, ('hello', index))
+
+    def _broadcast(self, exporter, src_id, template_id, records):
+        key = (exporter, src_id, template_id)
+        if self._known.get(key) == records:
+            return
+        self._known[key] = records
+        self._send(self._tx, ('templates', [(exporter, src_id, template_id, records)]))
+
+    def _send(self, targets, message):
+        message = pickle.dumps(message)
+        for tx in targets:
+            try:
+                tx.send(message)
+            except OSError:
+                # sibling is busy or gone, it will learn the template from the exporter
+                pass
+
+    def _hand_over(self, index):
+        known = [key + (records,) for key, records in self._known.items()]
+        for start in range(0, len(known), self.CHUNK):
+            self._send([self._pairs[index][1]], ('templates', known[start:start + self.CHUNK]))
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._rx.recv(1 << 18)
+            except BlockingIOError:
+                return
+            kind, payload = pickle.loads(message)
+            if kind == 'hello':
+                if payload != self._index:
+                    self._hand_over(payload)
+                continue
+            for exporter, src_id, template_id, records in payload:
+                self._known[(exporter, src_id, template_id)] = records
+                for parser in self._parsers:
+                    parser.learn_template(exporter, src_id, template_id, records)
+
+
+class Supervisor:
+    """Forks workers that bind the same UDP port with SO_REUSEPORT.
+
+        `make_protocol(report)` builds the datagram protocol inside a worker,
+    `report` is the stats callback it must use. Workers send their stats
+    to the supervisor, which sums them and passes them to `report_stats`.
+    With `metrics` (host, port) worker N serves its metrics on port + N.
+    `rcvbuf`, `recv_batch` and `recv_engine` set up receiving, see
+    `receiver.listen`.
+    """
+    STATS_PERIOD = 60
+    SHUTDOWN_TIMEOUT = 30
+
+    def __init__(self, bind, count, make_protocol, report_stats, metrics=None, rcvbuf=None, recv_batch=0,
+                 recv_engine=None):
+        self._bind = bind
+        self._count = count
+        self._make_protocol = make_protocol
+        self._report_stats = report_stats
+        self._context = multiprocessing.get_context('fork')
+        self._stats = self._context.Queue()
+        self._exchange = TemplateExchange(count)
+        self._workers = [None] * count
+        self._metrics = metrics
+        self._rcvbuf = rcvbuf
+        self._recv_batch = recv_batch
+        self._recv_engine = recv_engine
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        for index in range(self._count):
+            self._spawn(index)
+
+        round_stats = {}
+        round_started = time.monotonic()
+        try:
+            while True:
+                try:
+                    index, seconds, stats = self._stats.get(timeout=1)
+                    round_stats[index] = (seconds, stats)
+                except queue.Empty:
+                    pass
+
+                alive = [i for i, proc in enumerate(self._workers) if proc.is_alive()]
+                late = time.monotonic() - round_started > self.STATS_PERIOD * 1.5
+                if round_stats and (late or all(i in round_stats for i in alive)):
+                    self._report(round_stats)
+                    round_stats = {}
+                    round_started = time.monotonic()
+
+                for index, proc in enumerate(self._workers):
+                    if not proc.is_alive():
+                        logging.error('Supervisor: worker {0} exited with code {1}, restarting'.format(index, proc.exitcode))
+                        self._spawn(index)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            for proc in self._workers:
+                proc.terminate()
+            for proc in self._workers:
+                # workers write out what they hold, unless a sink hangs
+                proc.join(self.SHUTDOWN_TIMEOUT)
+                if proc.is_alive():
+                    logging.error('Supervisor: worker {0} did not stop in time, killed'.format(proc.name))
+                    proc.kill()
+                    proc.join()
+
+    def _report(self, round_stats):
+        seconds = max(seconds for seconds, _ in round_stats.values())
+        total = None
+        for _, stats in round_stats.values():
+            if total is None:
+                total = [(name, fmt, dict(values)) for name, fmt, values in stats]
+                continue
+            for (_, _, summed), (_, _, values) in zip(total, stats):
+                for key, value in values.items():
+                    summed[key] = summed.get(key, 0) + value
+        logging.info('Supervisor: stats of {0} workers'.format(len(round_stats)))
+        self._report_stats(seconds, total)
+
+    def _spawn(self, index):
+        proc = self._context.Process(target=self._worker, args=(index,), name='nfc-worker-{0}'.format(index))
+        proc.daemon = True
+        proc.start()
+        self._workers[index] = proc
+
+    def _worker(self, index):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        def report(seconds, stats):
+            self._stats.put((index, seconds, stats))
+
+        protocol = self._make_protocol(report)
+        self._exchange.attach(index, loop, protocol.parsers())
+
+        sock = bind_udp(*self._bind, reuse_port=True)
+        if self._rcvbuf:
+            receiver.set_receive_buffer(sock, self._rcvbuf)
+        listener = receiver.listen(loop, sock, protocol, self._recv_batch, self._recv_engine)
+        if self._metrics:
+            host, port = self._metrics
+            metrics.track_socket(sock, listener)
+            metrics.MetricsServer().start(loop, host, port + index)
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+
+        listener.close()
+        protocol.close()
+        loop.close()
@@ -9,8 +9,17 @@ setup(
         'click',
         'psycopg2',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'zstd': ['zstandard'],
+        'parquet': ['pyarrow'],
+        'asyncpg': ['asyncpg'],
+    },
     entry_points='''
         [console_scripts]
         nfc-daemon=netflow_collector.daemon:multi
+        nfc-replay=netflow_collector.daemon:replay
+        nfc-bench=netflow_collector.bench:main
+        nfc-lookup=netflow_collector.lookup:main
     ''',
 )
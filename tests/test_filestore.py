@@ -0,0 +1,47 @@
+import gzip
+import json
+import os
+
+from netflow_collector import filestore
+from netflow_collector import pgstore
+
+
+ROWS = [
+    (1600000000, 0x0a000001, 0x08080808, 53, 0x64400001, 1024, 17, None, None),
+    (1600000010, 0x0a000002, None, 80, 0x64400001, 1025, 6, 0x08080404, b'cust-a'),
+]
+# an IPv4 address exported in 8 bytes
+BAD_ROW = (1600000020, 1 << 40, 0x08080808, 53, 0x64400001, 1026, 17, None, None)
+
+
+def manifests(directory):
+    found = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.manifest.json'):
+            with open(os.path.join(directory, name)) as f:
+                found.append(json.load(f))
+    return found
+
+
+def test_files_by_event_time(tmp_path):
+    sink = filestore.FileSink(str(tmp_path), pgstore.NEL_TABLE, rotate=300)
+    sink.add(ROWS)
+    sink.add([(1600000300,) + ROWS[0][1:]])
+    sink.close()
+    assert [(m['rows'], m['first_event_time'], m['last_event_time']) for m in manifests(tmp_path)] == [
+        (2, 1600000000, 1600000010), (1, 1600000300, 1600000300)]
+    with gzip.open(os.path.join(str(tmp_path), manifests(tmp_path)[0]['file'])) as f:
+        assert f.read().splitlines()[0] == b'\t'.join(c.encode() for c in pgstore.NEL_TABLE.columns)
+
+
+def test_bad_rows_do_not_stop_the_sink(tmp_path):
+    sink = filestore.FileSink(str(tmp_path), pgstore.NEL_TABLE, rotate=300)
+    sink.add(ROWS + [BAD_ROW])
+    # no event time at all fails the whole batch
+    sink.add([(None,) + ROWS[0][1:]])
+    sink.add(ROWS)
+    sink.close()
+    assert sink.is_alive()
+    assert [m['rows'] for m in manifests(tmp_path)] == [4]
+    stats = sink.pop_stats()
+    assert (stats['written_records'], stats['rejected_records']) == (4, 2)
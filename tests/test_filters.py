@@ -0,0 +1,98 @@
+import ipaddress
+
+import pytest
+
+from netflow_collector import bench
+from netflow_collector import filters
+from netflow_collector import nf
+
+
+def ip(text):
+    addr = ipaddress.ip_address(text)
+    return int(addr) if addr.version == 4 else addr.packed
+
+
+def matches(text, **values):
+    """Whether a record with `values` (absent fields are None) passes the filter."""
+    routes = filters.compile_routes([filters.Filter(text)])
+    decode = lambda buffer, offset: tuple(values.get(name) for name in routes.fields)  # noqa: E731
+    return routes.make(decode)(None, 0)
+
+
+@pytest.mark.parametrize('text,values,result', [
+    ('NAT_EVENT == 1', {'NAT_EVENT': 1}, True),
+    ('NAT_EVENT == 1', {'NAT_EVENT': 2}, False),
+    ('NAT_EVENT != 1', {}, True),
+    ('NAT_EVENT == 1', {}, False),
+    ('L4_DST_PORT >= 1024 and L4_DST_PORT < 0x10000', {'L4_DST_PORT': 8080}, True),
+    ('L4_DST_PORT > 1024', {}, False),
+    ('NAT_EVENT in (1, 2) and XLATE_SRC_ADDR_IPV4 in 100.64.0.0/10',
+     {'NAT_EVENT': 2, 'XLATE_SRC_ADDR_IPV4': ip('100.127.1.1')}, True),
+    ('XLATE_SRC_ADDR_IPV4 in 100.64.0.0/10', {'XLATE_SRC_ADDR_IPV4': ip('100.128.0.1')}, False),
+    ('XLATE_SRC_ADDR_IPV4 in (10.0.0.0/8, 192.168.0.0/16, 1.2.3.4)', {'XLATE_SRC_ADDR_IPV4': ip('192.168.7.1')}, True),
+    ('XLATE_SRC_ADDR_IPV4 in (10.0.0.0/8, 192.168.0.0/16, 1.2.3.4)', {'XLATE_SRC_ADDR_IPV4': ip('1.2.3.4')}, True),
+    ('XLATE_SRC_ADDR_IPV4 not in (10.0.0.0/8, 1.2.3.4)', {'XLATE_SRC_ADDR_IPV4': ip('1.2.3.5')}, True),
+    ('XLATE_SRC_ADDR_IPV4 in 100.64.0.0/10', {}, False),
+    ('IPV6_SRC_ADDR in (2001:db8::/32, 64:ff9b::/96)', {'IPV6_SRC_ADDR': ip('2001:db8::1')}, True),
+    ('IPV6_SRC_ADDR in 2001:db8::/32', {'IPV6_SRC_ADDR': ip('2001:db9::1')}, False),
+    ('IPV4_SRC_ADDR == 10.0.0.1', {'IPV4_SRC_ADDR': ip('10.0.0.1')}, True),
+    ('VRF_NAME == "cust-a" or INGRESS_VRFID >= 100', {'VRF_NAME': b'cust-a'}, True),
+    ('VRF_NAME == "cust-a" or INGRESS_VRFID >= 100', {'VRF_NAME': b'cust-b', 'INGRESS_VRFID': 7}, False),
+    ("VRF_NAME in ('a/b', 'c')", {'VRF_NAME': b'a/b'}, True),
+    ('not (NAT_EVENT == 1 or NAT_EVENT == 2)', {'NAT_EVENT': 3}, True),
+    # negated comparisons don't match a missing field, negated groups are negated as is
+    ('not NAT_EVENT == 1', {'NAT_EVENT': 2}, True),
+    ('not NAT_EVENT == 1', {}, False),
+    ('not L4_DST_PORT < 1024', {}, False),
+    ('not NAT_EVENT in (1, 2)', {}, False),
+    ('not NAT_EVENT in (1, 2)', {'NAT_EVENT': 3}, True),
+    ('not NAT_EVENT not in (1, 2)', {}, False),
+    ('not not NAT_EVENT == 1', {}, False),
+    ('not not NAT_EVENT == 1', {'NAT_EVENT': 1}, True),
+    ('not not not NAT_EVENT == 1', {}, False),
+    ('not (NAT_EVENT == 1)', {}, True),
+    ('PROTOCOL == 6 and not L4_DST_PORT in (25, 465)', {'PROTOCOL': 6}, False),
+    ('NAT_EVENT == 1 and not PROTOCOL in (6, 17)', {'NAT_EVENT': 1, 'PROTOCOL': 1}, True),
+    ('FIELD_40000 == 5 and FIELD_9_1 == 1', {'FIELD_40000': 5, 'FIELD_9_1': 1}, True),
+])
+def test_filter(text, values, result):
+    assert matches(text, **values) is result
+
+
+@pytest.mark.parametrize('text', [
+    '', 'NAT_EVENT', 'NAT_EVENT ==', 'NO_SUCH_FIELD == 1', 'NAT_EVENT = 1', 'NAT_EVENT in 1,', 'NAT_EVENT in ()',
+    '(NAT_EVENT == 1', 'NAT_EVENT == 1)', 'NAT_EVENT == x', 'XLATE_SRC_ADDR_IPV4 == 10.0.0.0/8',
+    'XLATE_SRC_ADDR_IPV4 in 10.0.0.0/33', 'NAT_EVENT not == 1', 'and == 1',
+])
+def test_bad_filter(text):
+    with pytest.raises(filters.FilterError):
+        filters.Filter(text)
+
+
+def test_routes():
+    exporter = bench.SyntheticExporter(bench.LAYOUTS['nel'], 10)
+    template, data = exporter.packets(1)
+    routes = filters.compile_routes([filters.Filter('NAT_EVENT == 1'), None, filters.Filter('NAT_EVENT == 2')])
+    parser = nf.Parser(nf.VERSIONS, fields=('NAT_EVENT', 'L4_SRC_PORT'), routes=routes)
+    assert parser.route(template, bench.ADDR) == [[], [], []]
+
+    creates, everything, deletes = parser.route(data, bench.ADDR)
+    assert [record[0] for _, record in creates] == [1] * 5
+    assert [record[0] for _, record in deletes] == [2] * 5
+    assert sorted(everything) == sorted(creates + deletes)
+    assert parser.pop_stats()['filtered'] == 0
+
+
+def test_filtered_records_are_counted():
+    template, data = bench.SyntheticExporter(bench.LAYOUTS['nel'], 10).packets(1)
+    routes = filters.compile_routes([filters.Filter('NAT_EVENT == 1')])
+    parser = nf.Parser(nf.VERSIONS, fields=('NAT_EVENT',), routes=routes)
+    parser.route(template, bench.ADDR)
+    kept, = parser.route(data, bench.ADDR)
+    assert [record for _, record in kept] == [(1,)] * 5
+    assert parser.pop_stats()['filtered'] == 5
+
+
+def test_no_filters():
+    routes = filters.compile_routes([None, None])
+    assert (routes.count, routes.fields, routes.make) == (2, (), None)
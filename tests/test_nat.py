@@ -0,0 +1,95 @@
+from netflow_collector import nat
+
+
+ADDR = ('192.0.2.1', 2055)
+V6 = bytes(range(16))
+
+
+def block(event, msec, src, xlate, start, end=None, size=None, port=None):
+    return event, msec, src, xlate, start, end, size, port
+
+
+def session(event, msec, src=0x0a000001, dst=0x08080808, dst_port=53, xlate=0x64400001, port=1024, protocol=17):
+    return event, msec, src, dst, dst_port, xlate, port, protocol
+
+
+def run(mode, records):
+    rows = []
+    handler = mode(rows.append)
+    for record in records:
+        handler.handle(ADDR, None, record)
+    return handler, rows
+
+
+def test_port_blocks_pair_allocate_and_release():
+    handler, rows = run(nat.PortBlocks, [
+        block(nat.BLOCK_ALLOCATE, 1000, 0x0a000001, 0x64400001, 1024, end=1535),
+        block(nat.BLOCK_ALLOCATE, 2000, 0x0a000002, 0x64400001, 1536, size=512),
+        block(nat.BLOCK_RELEASE, 9000, 0x0a000001, 0x64400001, 1024, end=1535),
+        # released without the allocate, e.g. after a collector restart
+        block(nat.BLOCK_RELEASE, 9500, 0x0a000003, 0x64400002, 2048),
+    ])
+    assert rows == [(1, 9, 0x0a000001, 0x64400001, 1024, 1535), (0, 9, 0x0a000003, 0x64400002, 2048, 2048)]
+    handler.close()
+    # still open: held at least until the last event
+    assert rows[2:] == [(2, 9, 0x0a000002, 0x64400001, 1536, 2047)]
+    stats = handler.pop_stats()
+    assert (stats['closed_blocks'], stats['unmatched_releases'], stats['open_blocks']) == (2, 1, 0)
+
+
+def test_port_blocks_ignore_templates_without_blocks():
+    _, rows = run(nat.PortBlocks, [block(nat.BLOCK_ALLOCATE, 1000, 0x0a000001, 0x64400001, None)])
+    assert rows == []
+
+
+def test_sessions_aggregate_into_port_ranges():
+    rows = []
+    handler = nat.PortBlocks(rows.append, aggregate=60)
+    for msec, src, port in [(1000, 0x0a000001, 2000), (2000, 0x0a000001, 1990), (3000, 0x0a000002, 3000),
+                            (30000, 0x0a000001, 2010), (70000, 0x0a000001, 4000), (75000, 0x0a000001, 4001)]:
+        handler.handle(ADDR, None, block(nat.SESSION_CREATE, msec, src, 0x64400001, None, port=port))
+    # windows that started a minute before the last event are written
+    assert rows == [(1, 30, 0x0a000001, 0x64400001, 1990, 2010), (3, 3, 0x0a000002, 0x64400001, 3000, 3000)]
+    handler.close()
+    assert rows[2:] == [(70, 75, 0x0a000001, 0x64400001, 4000, 4001)]
+
+
+def test_sessions_pair_create_and_delete():
+    handler, rows = run(nat.Sessions, [
+        session(nat.SESSION_CREATE, 1000),
+        session(nat.SESSION_CREATE, 2000, port=1025),
+        session(nat.SESSION_DELETE, 5000),
+        session(nat.SESSION_DELETE, 6000, port=4000),
+        session(nat.SESSION_CREATE, 7000, src=V6, dst=V6, xlate=0x64400002),
+        session(nat.SESSION_DELETE, 8000, src=V6, dst=V6, xlate=0x64400002),
+    ])
+    assert rows == [
+        (1, 5, 0x0a000001, 0x08080808, 53, 0x64400001, 1024, 17, 1),
+        (0, 6, 0x0a000001, 0x08080808, 53, 0x64400001, 4000, 17, 1),
+        (7, 8, V6, V6, 53, 0x64400002, 1024, 17, 1),
+    ]
+    handler.close()
+    assert rows[3:] == [(2, 8, 0x0a000001, 0x08080808, 53, 0x64400001, 1025, 17, 0)]
+    stats = handler.pop_stats()
+    assert (stats['paired'], stats['unmatched_deletes'], stats['open_sessions']) == (2, 1, 0)
+
+
+def test_sessions_time_out_and_reuse():
+    rows = []
+    handler = nat.Sessions(rows.append, timeout=60)
+    handler.handle(ADDR, None, session(nat.SESSION_CREATE, 1000))
+    # the delete of the first one got lost, the tuple is taken again
+    handler.handle(ADDR, None, session(nat.SESSION_CREATE, 2000))
+    assert rows == [(1, 2, 0x0a000001, 0x08080808, 53, 0x64400001, 1024, 17, 0)]
+    handler.handle(ADDR, None, session(nat.SESSION_CREATE, 200000, port=1025))
+    assert rows[1:] == [(2, 62, 0x0a000001, 0x08080808, 53, 0x64400001, 1024, 17, 0)]
+    assert handler.pop_stats()['timed_out'] == 1
+
+
+def test_sessions_evict_oldest():
+    rows = []
+    handler = nat.Sessions(rows.append, max_sessions=2)
+    for port in (1024, 1025, 1026):
+        handler.handle(ADDR, None, session(nat.SESSION_CREATE, 1000 * port, port=port))
+    assert rows == [(1024, 1026, 0x0a000001, 0x08080808, 53, 0x64400001, 1024, 17, 0)]
+    assert handler.pop_stats()['evicted'] == 1
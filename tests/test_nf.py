@@ -0,0 +1,184 @@
+import struct
+
+import pytest
+
+from netflow_collector import bench
+from netflow_collector import nf
+
+
+ADDR = ('192.0.2.1', 2055)
+# alternatives, a field exported with 16 bytes and an optional field no layout has
+FIELDS = ('NAT_EVENT', 'EVENT_TIME_MSEC', ('IPV4_SRC_ADDR', 'IPV6_SRC_ADDR'), 'L4_DST_PORT',
+          ('XLATE_SRC_ADDR_IPV4', 'XLATE_SRC_ADDR_IPV6'), 'XLATE_SRC_PORT', 'PROTOCOL', 'IN_BYTES')
+LAYOUTS = [('nel', 9), ('nel-wide', 9), ('nat64', 9), ('nel', 10), ('nel-pool', 10)]
+
+
+def packets(layout, version, count=3, records=5):
+    return bench.SyntheticExporter(bench.LAYOUTS[layout], records, version=version).packets(count)
+
+
+def expected(record, fields):
+    """Values of `fields` from a full template record."""
+    values = []
+    for entry in fields:
+        names = entry if isinstance(entry, tuple) else (entry,)
+        values.append(next((getattr(record, name) for name in names if hasattr(record, name)), None))
+    return tuple(values)
+
+
+def column_values(column, count):
+    if column is None:
+        return [None] * count
+    return column.tolist() if hasattr(column, 'tolist') else list(column)
+
+
+@pytest.mark.parametrize('layout,version', LAYOUTS)
+def test_projection_matches_full_decode(layout, version):
+    full = nf.Parser(nf.VERSIONS)
+    projection = nf.Parser(nf.VERSIONS, fields=FIELDS)
+    for packet in packets(layout, version):
+        records = [record for _, record in full.parse(packet, ADDR)]
+        projected = [record for _, record in projection.parse(packet, ADDR)]
+        assert projected == [expected(record, FIELDS) for record in records]
+
+
+@pytest.mark.parametrize('layout,version', LAYOUTS)
+def test_parse_batch_matches_parse(layout, version):
+    parser = nf.Parser(nf.VERSIONS, fields=FIELDS)
+    batch_parser = nf.Parser(nf.VERSIONS, fields=FIELDS)
+    for packet in packets(layout, version):
+        records = [record for _, record in parser.parse(packet, ADDR)]
+        rows = []
+        for batch in batch_parser.parse_batch(packet, ADDR):
+            columns = [column_values(column, batch.count) for column in batch.columns]
+            rows.extend(zip(*columns))
+        assert rows == records
+
+
+def test_byte_array_fields_decode_as_one_value():
+    # INGRESS_VRFID, VRF_NAME (32), INGRESS_ACL_ID (12), IF_NAME of fixed length in v9
+    records = ((234, 4), (236, 32), (33000, 12), (82, 16))
+    data = struct.pack('!L', 5) + b'cust-a'.ljust(32, b'\0') + b'acl-12345678' + b'eth0'.ljust(16, b'\0')
+
+    full = nf.Template(256, records).decode(data, 0)
+    assert full.INGRESS_VRFID == 5
+    assert full.VRF_NAME == b'cust-a'.ljust(32, b'\0')
+    assert full.INGRESS_ACL_ID == b'acl-12345678'
+    assert full.IF_NAME == b'eth0'.ljust(16, b'\0')
+
+    projection = nf.Template(256, records, ('IF_NAME', 'INGRESS_ACL_ID', 'INGRESS_VRFID')).decode(data, 0)
+    assert projection == (b'eth0'.ljust(16, b'\0'), b'acl-12345678', 5)
+
+
+@pytest.mark.parametrize('version', [9, 10])
+def test_short_packets_are_ignored(version):
+    packet = packets('nel', version, count=1)[1]
+    parser = nf.Parser(nf.VERSIONS)
+    for size in range(len(packet)):
+        assert list(parser.parse(packet[:size], ADDR)) == []
+
+
+def test_templates_survive_exporter_port_change():
+    template, data = packets('nel', 9, count=1)
+    parser = nf.Parser(nf.VERSIONS, fields=FIELDS)
+    assert list(parser.parse(template, ADDR)) == []
+    assert len(list(parser.parse(data, (ADDR[0], ADDR[1] + 1)))) == 5
+
+
+def test_data_before_template_is_held_then_decoded():
+    template, data = packets('nel', 9, count=1)
+    parser = nf.Parser(nf.VERSIONS, fields=FIELDS)
+    assert list(parser.parse(data, ADDR)) == []
+    assert len(list(parser.parse(template, ADDR))) == 5
+    stats = parser.pop_stats()
+    assert (stats['held'], stats['replayed']) == (1, 1)
+
+
+def test_pending_flowsets_are_bounded_across_source_ids():
+    stats = dict.fromkeys(nf.Parser.STATS, 0)
+    pending = nf.PendingFlowSets(stats, max_bytes=300, max_total_bytes=1000)
+    for src_id in range(20):
+        pending.hold((ADDR[0], src_id), None, 256, bytes(100))
+    # the sender picks source IDs: only the newest ten fit
+    assert len(pending) == 10
+    assert [pending.release((ADDR[0], src_id), 256) for src_id in (0, 9)] == [[], []]
+    assert len(pending.release((ADDR[0], 10), 256)) == 1
+    # released and dropped flowsets are skipped, the oldest held one goes
+    for _ in range(4):
+        pending.hold((ADDR[0], 19), None, 257, bytes(100))
+    assert len(pending) == 10
+    assert (stats['held'], stats['evicted'], stats['dropped'], stats['replayed']) == (24, 11, 2, 1)
+    assert [len(pending.release((ADDR[0], src_id), 256)) for src_id in (11, 12, 19)] == [0, 1, 0]
+
+
+def ipfix(*sets):
+    body = b''.join(struct.pack('!HH', set_id, 4 + len(data)) + data for set_id, data in sets)
+    return struct.pack('!HHIII', 10, 16 + len(body), 0, 0, 0) + body
+
+
+@pytest.mark.parametrize('fields', [None, FIELDS])
+def test_truncated_variable_length_records_end_the_flowset(fields):
+    # IF_NAME of variable length before fixed fields
+    template = ipfix((2, struct.pack('!HHHHHHHH', 400, 3, 82, 65535, 8, 4, 7, 2)))
+    good = bytes([4]) + b'eth0' + struct.pack('!IH', 0x0a000001, 1024)
+    parser = nf.Parser(nf.VERSIONS, fields=fields)
+    list(parser.parse(template, ADDR))
+    for bad in (bytes([200]) + b'eth0' + struct.pack('!IH', 0x0a000001, 1024), bytes([255, 1]), bytes([4]) + b'eth0'):
+        packet = ipfix((400, good + bad))
+        assert len(list(parser.parse(packet, ADDR))) == 1
+        assert [batch.count for batch in parser.parse_batch(packet, ADDR)] == [1]
+        assert [len(records) for records in parser.route(packet, ADDR)] == [1]
+
+
+def test_truncated_options_record_is_skipped():
+    # INPUT_SNMP, IF_NAME and IF_DESC of variable length
+    template = ipfix((3, struct.pack('!HHHHHHHHH', 300, 3, 1, 10, 4, 82, 65535, 83, 65535)))
+    good = struct.pack('!I', 7) + bytes([4]) + b'eth0' + bytes([0])
+    parser = nf.Parser(nf.VERSIONS, fields=FIELDS)
+    parser.route(template, ADDR)
+    assert parser.route(ipfix((300, good + struct.pack('!I', 8) + bytes([40]) + b'eth')), ADDR) == [[]]
+    assert parser.metadata(ADDR[0], 0).interfaces == {7: b'eth0'}
+    stats = parser.pop_stats()
+    assert (stats['options'], stats['malformed']) == (1, 1)
+
+
+def track(seqs, **options):
+    stats = dict.fromkeys(nf.Parser.STATS, 0)
+    tracker = nf.SequenceTracker(stats, **options)
+    for seq in seqs:
+        tracker.track(ADDR, 0, seq)
+    return {key: value for key, value in stats.items() if value}
+
+
+def test_sequence_in_order():
+    assert track(range(1, 500)) == {}
+    # wraps around 2 ** 32
+    assert track([n & 0xffffffff for n in range(0xfffffff0, 0x100000010)]) == {}
+
+
+def test_sequence_loss_counted_once_out_of_window():
+    assert track(list(range(1, 50)) + list(range(53, 200))) == {'lost': 3}
+    # still within the window: could be reordered
+    assert track(list(range(1, 50)) + list(range(53, 60))) == {}
+
+
+def test_sequence_reordered_and_duplicate():
+    assert track([1, 2, 4, 3, 5, 5, 6]) == {'reordered': 1, 'duplicate': 1}
+
+
+def test_sequence_far_late_packet_is_not_a_reset():
+    assert track(list(range(1, 101)) + [10] + list(range(101, 110))) == {'reordered': 1}
+
+
+def test_sequence_restart_resets_once_confirmed():
+    assert track(list(range(1000, 1100)) + list(range(1, 200))) == {'seq_resets': 1}
+    assert track(list(range(1, 100)) + list(range(500000, 500100))) == {'seq_resets': 1}
+
+
+def test_sequence_survives_exporter_port_change():
+    stats = dict.fromkeys(nf.Parser.STATS, 0)
+    tracker = nf.SequenceTracker(stats)
+    for seq in range(1, 200):
+        tracker.track((ADDR[0], ADDR[1] + seq // 50), 0, seq)
+    assert not any(stats.values())
+    assert list(tracker._sources) == [(ADDR[0], 0)]
@@ -0,0 +1,93 @@
+import os
+
+from netflow_collector import pgstore
+
+
+V6 = bytes(range(16))
+ROWS = [
+    (1600000000, 0x0a000001, 0x08080808, 53, 0x64400001, 1024, 17, None, None),
+    # NULL shapes, then values again in the same columns
+    (1600000001, 0x0a000002, None, 80, 0x64400001, 1025, 6, None, None),
+    (1600000002, 0x0a000003, 0x08080404, 443, 0x64400002, 1026, 6, 0x08080404, None),
+    (1600000003, V6, V6, 443, 0x64400002, 1027, 6, 0x01020304, b'cust-a'),
+    (1600000004, 0x0a000004, 0x01010101, 53, 0x64400003, 1028, 17, None, b'cust-b'),
+    (1600000005, 0x0a000005, 0x01010101, 53, 0x64400003, 1029, 17, None, b'vrf-with-longer-name'),
+    (1600000006, 0x0a000006, 0x01010101, 53, 0x64400003, 1030, 17, 0x01010101, None),
+    (1600000007, 0x0a000007, 0x01010101, 53, 0x64400003, 1031, 17, None, b''),
+]
+
+
+def test_binary_copy_round_trip():
+    encoder = pgstore.BinaryCopy(pgstore.NEL_TABLE)
+    assert encoder.decode_rows(encoder.encode_rows(ROWS)) == ROWS
+    # rows packed with a NULL shape must not lose values of the next rows
+    for start in range(len(ROWS)):
+        rows = ROWS[start:] + ROWS[:start]
+        assert encoder.decode_rows(encoder.encode_rows(rows)) == rows
+
+
+def test_binary_copy_payload():
+    encoder = pgstore.BinaryCopy(pgstore.NEL_TABLE)
+    payload = bytes(encoder.encode(ROWS[:1]))
+    assert payload.startswith(pgstore.BinaryCopy.HEADER)
+    assert payload.endswith(pgstore.BinaryCopy.TRAILER)
+    assert payload[len(pgstore.BinaryCopy.HEADER):-2] == bytes(encoder.encode_rows(ROWS[:1]))
+
+
+def test_text_copy():
+    encoder = pgstore.TextCopy(pgstore.NEL_TABLE)
+    assert encoder.encode(ROWS[3:4]) == (
+        b'1600000003\t1:203:405:607:809:a0b:c0d:e0f\t1:203:405:607:809:a0b:c0d:e0f\t443\t100.64.0.2\t1027\t6\t'
+        b'1.2.3.4\tcust-a')
+    assert encoder.encode(ROWS[1:2]) == b'1600000001\t10.0.0.2\t\\N\t80\t100.64.0.1\t1025\t6\t\\N\t\\N'
+    assert pgstore.format_text(b'a\tb\\c\nd') == 'a\\tb\\\\c\\nd'
+
+
+def test_nuls_are_kept_out_of_copy():
+    row = ROWS[4][:-1] + (b'cu\x00st\x00',)
+    clean = ROWS[4][:-1] + (b'cust',)
+    encoder = pgstore.BinaryCopy(pgstore.NEL_TABLE)
+    assert encoder.decode_rows(encoder.encode_rows([ROWS[4], row, ROWS[5]])) == [ROWS[4], clean, ROWS[5]]
+    # a packer for the length is already there
+    assert encoder.decode_rows(encoder.encode_rows([ROWS[4][:-1] + (b'cust\x00\x00',)])) == [clean]
+    assert pgstore.TextCopy(pgstore.NEL_TABLE).encode([row]).endswith(b'\tcust')
+
+
+# an IPv4 address exported in 8 bytes, a port out of int4
+BAD_ROWS = [ROWS[0][:1] + (1 << 40,) + ROWS[0][2:], ROWS[3][:5] + (1 << 40,) + ROWS[3][6:]]
+
+
+def test_out_of_range_rows_are_left_out():
+    encoder = pgstore.BinaryCopy(pgstore.NEL_TABLE)
+    rows = [ROWS[0], BAD_ROWS[0], ROWS[3], BAD_ROWS[1], ROWS[4]]
+    assert encoder.decode_rows(encoder.encode_rows(rows)) == [ROWS[0], ROWS[3], ROWS[4]]
+    assert encoder.rejected == 2
+    text = pgstore.TextCopy(pgstore.NEL_TABLE)
+    assert text.encode(rows[:3]) == text.encode([ROWS[0], ROWS[3]])
+    assert text.rejected == 1
+
+
+def test_daily_partitions_split():
+    partitions = pgstore.DailyPartitions(pgstore.NEL_TABLE)
+    by_day = partitions.split([ROWS[0], (1600086400,) + ROWS[1][1:], ROWS[2]])
+    assert sorted(len(rows) for rows in by_day.values()) == [1, 2]
+
+
+def test_batch_queue_overflow():
+    queue = pgstore.BatchQueue(2, 1 << 20, pgstore.NEL_TABLE.row_bytes, name='test-drop')
+    assert [queue.put(ROWS[:1]) for _ in range(3)] == [True, True, False]
+    assert (queue.dropped, queue.qsize()) == (1, 2)
+
+
+def test_spool_takes_batches_while_db_is_down(tmp_path):
+    # nothing listens on port 1: every connection is refused
+    dsn = {'host': '127.0.0.1', 'port': 1, 'user': 'nfc', 'database': 'nfc', 'connect_timeout': 1}
+    pool = pgstore.StorePgThreadPool(2, dsn, queue_batches=2, spool_dir=str(tmp_path), name='test-down')
+    for _ in range(5):
+        pool.addRequest(ROWS)
+    pool.addRequest(BAD_ROWS)
+    pool.waitCompletion()
+    assert (pool.requests.dropped, pool.rejected) == (0, 2)
+    spooled = [row for name in sorted(os.listdir(tmp_path)) for _, payload in pool.spool.read(tmp_path / name)
+               for row in pool.spool.encoder.decode_rows(payload)]
+    assert spooled == ROWS * 5
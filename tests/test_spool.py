@@ -0,0 +1,86 @@
+import os
+
+from netflow_collector import pgstore
+from netflow_collector import spool
+
+
+ROWS = [
+    (1600000000, 0x0a000001, 0x08080808, 53, 0x64400001, 1024, 17, None, None),
+    (1600000001, 0x0a000002, None, 80, 0x64400001, 1025, 6, 0x08080404, b'cust-a'),
+]
+
+
+def make_spool(tmp_path, **options):
+    return spool.Spool(str(tmp_path), pgstore.BinaryCopy(pgstore.NEL_TABLE), fsync='never', **options)
+
+
+def read_all(store, path):
+    return [(rows, store.encoder.decode_rows(payload)) for rows, payload in store.read(path)]
+
+
+def test_round_trip(tmp_path):
+    store = make_spool(tmp_path)
+    store.append(ROWS)
+    store.append(ROWS[:1])
+    assert store.spooled == 3
+    # the open segment is held back until idle
+    assert store.closed_segments(idle=60) == []
+    path, = store.closed_segments(idle=0)
+    assert read_all(store, path) == [(2, ROWS), (1, ROWS[:1])]
+    # a new spool over the same directory goes on with the next segment
+    again = make_spool(tmp_path)
+    again.append(ROWS)
+    assert [os.path.basename(path) for path in again.closed_segments(idle=0)] == ['0000000001.seg', '0000000002.seg']
+
+
+def test_segments_roll_over(tmp_path):
+    store = make_spool(tmp_path, segment_bytes=1)
+    for _ in range(3):
+        store.append(ROWS)
+    paths = store.closed_segments()
+    assert len(paths) == 3
+    assert [read_all(store, path) for path in paths] == [[(2, ROWS)]] * 3
+
+
+def test_torn_frame_is_ignored(tmp_path):
+    store = make_spool(tmp_path)
+    store.append(ROWS)
+    store.append(ROWS)
+    path, = store.closed_segments(idle=0)
+    size = os.path.getsize(path)
+    for cut in (1, spool.Spool.FRAME.size, spool.Spool.FRAME.size + 1):
+        os.truncate(path, size - cut)
+        assert read_all(store, path) == [(2, ROWS)]
+        size -= cut
+
+
+def test_corrupted_frame_stops_reading(tmp_path):
+    store = make_spool(tmp_path)
+    for _ in range(3):
+        store.append(ROWS)
+    path, = store.closed_segments(idle=0)
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    frame = len(data) // 3
+    data[frame + spool.Spool.FRAME.size + 5] ^= 0xff
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert read_all(store, path) == [(2, ROWS)]
+
+    data[frame:frame + 4] = b'JUNK'
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert read_all(store, path) == [(2, ROWS)]
+
+
+def test_quarantine_and_remove(tmp_path):
+    store = make_spool(tmp_path)
+    store.append(ROWS)
+    path, = store.closed_segments(idle=0)
+    store.append(ROWS)
+    second, = store.closed_segments(idle=0)[1:]
+    store.quarantine(path)
+    assert store.closed_segments() == [second]
+    assert os.path.exists(path + '.bad')
+    store.remove(second)
+    assert (store.closed_segments(), store.pending_bytes()) == ([], 0)
@@ -0,0 +1,50 @@
+import sqlite3
+import time
+
+from netflow_collector import bench
+from netflow_collector import nf
+from netflow_collector import tplstore
+
+
+RECORDS = ((8, 4), (225, 4), (230, 1), (32000 | 0x8000 << 16, 2))
+
+
+def test_save_and_lookup(tmp_path):
+    store = tplstore.TemplateStore(str(tmp_path / 'templates.db'))
+    store.save('192.0.2.1', 0, 256, RECORDS[:3])
+    store.save('192.0.2.1', 0, 257, RECORDS)
+    assert store.lookup('192.0.2.1', 0, 256) == RECORDS[:3]
+    assert store.lookup('192.0.2.1', 0, 257) == RECORDS
+    assert store.lookup('192.0.2.2', 0, 256) is None
+    assert sorted(store.load()) == [('192.0.2.1', 0, 256, RECORDS[:3]), ('192.0.2.1', 0, 257, RECORDS)]
+
+
+def test_version_0_is_rekeyed_by_host(tmp_path):
+    path = str(tmp_path / 'templates.db')
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute('CREATE TABLE templates (exporter TEXT, source_id INTEGER, template_id INTEGER, records BLOB,'
+               ' updated REAL, PRIMARY KEY (exporter, source_id, template_id))')
+    now = time.time()
+    db.executemany('INSERT INTO templates VALUES (?, ?, ?, ?, ?)', [
+        (repr(('192.0.2.1', 40000)), 0, 256, tplstore.TemplateStore._pack(RECORDS[:2]), now - 10),
+        (repr(('192.0.2.1', 40001)), 0, 256, tplstore.TemplateStore._pack(RECORDS[:3]), now),
+        (repr(('2001:db8::1', 2055)), 1, 300, tplstore.TemplateStore._pack(RECORDS[:1]), now),
+    ])
+    db.close()
+
+    store = tplstore.TemplateStore(path)
+    assert sorted(store.load()) == [('192.0.2.1', 0, 256, RECORDS[:3]), ('2001:db8::1', 1, 300, RECORDS[:1])]
+    assert store._connect().execute('PRAGMA user_version').fetchone()[0] == tplstore.TemplateStore.VERSION
+
+
+def test_templates_outlive_port_change(tmp_path):
+    template, data = bench.SyntheticExporter(bench.LAYOUTS['nel'], 5).packets(1)
+    path = str(tmp_path / 'templates.db')
+    first = nf.Parser(nf.VERSIONS)
+    tplstore.TemplateStore(path).attach([first])
+    list(first.parse(template, ('192.0.2.1', 40000)))
+
+    # a restarted collector, the exporter came back from another port
+    second = nf.Parser(nf.VERSIONS)
+    tplstore.TemplateStore(path).attach([second])
+    assert len(list(second.parse(data, ('192.0.2.1', 40001)))) == 5